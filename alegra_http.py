@@ -0,0 +1,114 @@
+"""
+Cliente HTTP compartido para la API de Alegra
+---------------------------------------------
+
+Fábrica única de sesiones aiohttp para los extractores, con el conector y los timeouts
+ajustados para muchas páginas pequeñas contra un solo host:
+
+▶ Conexiones:
+   - keep-alive HTTP/1.1: las conexiones TLS se reutilizan entre páginas (sin handshake por página)
+   - límite total y por host del pool (ALEGRA_HTTP_LIMIT / ALEGRA_HTTP_LIMIT_PER_HOST)
+   - caché de DNS con TTL (ALEGRA_HTTP_DNS_TTL), para no resolver api.alegra.com en cada conexión
+▶ Compresión: `Accept-Encoding: gzip, deflate` y `br` si hay un decodificador de Brotli
+   instalado (aiohttp descomprime la respuesta de forma transparente).
+▶ Timeouts separados: conexión (ALEGRA_HTTP_CONNECT_TIMEOUT) y lectura entre bloques
+   (ALEGRA_HTTP_READ_TIMEOUT), sin timeout total para no cortar páginas lentas pero vivas.
+
+Una misma sesión se reutiliza dentro de una corrida (descubrimiento, descarga y re-envío),
+y varios extractores en el mismo event loop comparten un solo conector (pool de conexiones
+y caché de DNS), cada uno con su propia sesión y cabeceras de autorización:
+
+    async with alegra_http.shared_connector() as connector:
+        async with alegra_http.create_session(HEADERS, connector) as session:
+            ...
+            async with alegra_http.session_scope(session, HEADERS) as session:  # reutiliza o abre una
+                ...
+"""
+from __future__ import annotations
+
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Mapping, Optional
+
+import aiohttp
+
+# Decodificador opcional de Brotli (aiohttp usa cualquiera de los dos)
+try:
+    import brotli  # noqa: F401
+    BROTLI_AVAILABLE = True
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        BROTLI_AVAILABLE = True
+    except ImportError:
+        BROTLI_AVAILABLE = False
+
+DEFAULT_LIMIT = 100
+DEFAULT_LIMIT_PER_HOST = 20       # Por encima del techo del limitador adaptativo (16)
+DEFAULT_DNS_TTL = 300
+DEFAULT_KEEPALIVE_TIMEOUT = 30
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 30
+
+
+def accept_encoding() -> str:
+    """Codificaciones que el cliente puede descomprimir."""
+    return "gzip, deflate, br" if BROTLI_AVAILABLE else "gzip, deflate"
+
+
+def client_timeout() -> aiohttp.ClientTimeout:
+    """Timeouts separados de conexión y de lectura; sin límite total por petición."""
+    connect = float(os.getenv("ALEGRA_HTTP_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT))
+    return aiohttp.ClientTimeout(
+        total=None,
+        connect=connect,
+        sock_connect=connect,
+        sock_read=float(os.getenv("ALEGRA_HTTP_READ_TIMEOUT", DEFAULT_READ_TIMEOUT)),
+    )
+
+
+def create_connector() -> aiohttp.TCPConnector:
+    """Conector con pool acotado por host, keep-alive y caché de DNS."""
+    return aiohttp.TCPConnector(
+        limit=int(os.getenv("ALEGRA_HTTP_LIMIT", DEFAULT_LIMIT)),
+        limit_per_host=int(os.getenv("ALEGRA_HTTP_LIMIT_PER_HOST", DEFAULT_LIMIT_PER_HOST)),
+        ttl_dns_cache=int(os.getenv("ALEGRA_HTTP_DNS_TTL", DEFAULT_DNS_TTL)),
+        keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+    )
+
+
+@asynccontextmanager
+async def shared_connector() -> AsyncIterator[aiohttp.TCPConnector]:
+    """Conector para compartir entre varias sesiones del mismo event loop; se cierra al salir."""
+    connector = create_connector()
+    try:
+        yield connector
+    finally:
+        await connector.close()
+
+
+def create_session(headers: Optional[Mapping[str, str]] = None,
+                   connector: Optional[aiohttp.TCPConnector] = None) -> aiohttp.ClientSession:
+    """
+    Nueva sesión ajustada para Alegra. `headers` (p. ej. la autorización) se envían en
+    todas las peticiones; las cabeceras por petición se combinan con estas. Con un
+    `connector` compartido la sesión lo usa sin cerrarlo al salir.
+    Debe crearse dentro de un event loop en ejecución.
+    """
+    return aiohttp.ClientSession(
+        connector=connector or create_connector(),
+        connector_owner=connector is None,
+        timeout=client_timeout(),
+        headers={"Accept-Encoding": accept_encoding(), **(headers or {})},
+    )
+
+
+@asynccontextmanager
+async def session_scope(session: Optional[aiohttp.ClientSession] = None,
+                        headers: Optional[Mapping[str, str]] = None) -> AsyncIterator[aiohttp.ClientSession]:
+    """Reutilizar `session` si se pasa; si no, abrir una sesión nueva y cerrarla al salir."""
+    if session is not None:
+        yield session
+        return
+    async with create_session(headers) as own_session:
+        yield own_session
@@ -0,0 +1,137 @@
+"""
+Caché en disco de respuestas de la API de Alegra
+------------------------------------------------
+
+Guarda el cuerpo JSON de cada respuesta (comprimido con zlib) en un archivo SQLite
+local, indexado por URL, junto con ETag / Last-Modified para peticiones condicionales
+y la fecha de factura más reciente de la página.
+
+▶ Políticas:
+   - TTL: las entradas más viejas que `ttl_seconds` se descartan al leerlas.
+   - Tamaño: si el total supera `max_bytes`, se eliminan las entradas más antiguas.
+   - Confianza: una página completa cuya factura más reciente es anterior a
+     `trust_days` se sirve directamente, sin tocar la red ni el límite de peticiones.
+
+Un backfill reintentado vuelve a reproducir desde aquí las páginas ya descargadas.
+"""
+from __future__ import annotations
+
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(slots=True)
+class CachedResponse:
+    """Entrada de la caché."""
+
+    url: str
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    newest_date: Optional[str]
+    complete: bool
+    stored_at: float
+
+
+class ResponseCache:
+    """Caché de respuestas HTTP en SQLite, segura para uso desde varios hilos."""
+
+    def __init__(self, path: str, ttl_seconds: float, max_bytes: int, trust_days: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.trust_days = trust_days
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                newest_date TEXT,
+                complete INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_stored_at ON responses(stored_at)")
+        self._conn.commit()
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        """Entrada vigente para `url`, o None si no existe o venció su TTL."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, etag, last_modified, newest_date, complete, stored_at FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[5] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+                self._conn.commit()
+                return None
+        return CachedResponse(url, zlib.decompress(row[0]), row[1], row[2], row[3], bool(row[4]), row[5])
+
+    def put(self, url: str, body: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None,
+            newest_date: Optional[str] = None, complete: bool = False):
+        """Guardar (o reemplazar) la respuesta de `url` y aplicar el límite de tamaño."""
+        compressed = zlib.compress(body, 6)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, compressed, etag, last_modified, newest_date, int(complete), time.time(), len(compressed)),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def touch(self, url: str):
+        """Renovar el TTL de una entrada revalidada con 304."""
+        with self._lock:
+            self._conn.execute("UPDATE responses SET stored_at = ? WHERE url = ?", (time.time(), url))
+            self._conn.commit()
+
+    def is_trusted(self, entry: CachedResponse) -> bool:
+        """Una página completa con facturas anteriores a `trust_days` ya no cambia: se sirve sin red."""
+        if not entry.complete or not entry.newest_date:
+            return False
+        try:
+            newest = datetime.date.fromisoformat(entry.newest_date[:10])
+        except ValueError:
+            return False
+        return newest < datetime.date.today() - datetime.timedelta(days=self.trust_days)
+
+    def conditional_headers(self, entry: Optional[CachedResponse]) -> dict:
+        """Cabeceras If-None-Match / If-Modified-Since para revalidar `entry`."""
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def summary(self) -> str:
+        return f"{self.hits} hits, {self.revalidated} revalidadas (304), {self.misses} descargas"
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        for url, size in self._conn.execute("SELECT url, size FROM responses ORDER BY stored_at").fetchall():
+            self._conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+            freed += size
+            if freed >= excess:
+                break
+        logging.debug(f"Caché HTTP: liberados {freed} bytes")
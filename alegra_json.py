@@ -0,0 +1,84 @@
+"""
+Decodificación JSON de las respuestas de Alegra
+-----------------------------------------------
+
+Capa única de decodificación para los extractores: usa el decodificador más rápido
+instalado y cae a `json` de la librería estándar si no hay ninguno.
+
+▶ Orden de preferencia: orjson → msgspec → json (stdlib)
+▶ Variable de entorno ALEGRA_JSON_BACKEND para forzar uno ("orjson", "msgspec", "json").
+▶ Un cuerpo inválido lanza siempre `alegra_json.DecodeError` (subclase de ValueError),
+   sin importar el decodificador activo.
+
+Uso:
+    data = alegra_json.loads(await response.read())   # aiohttp
+    data = alegra_json.loads(response.content)         # requests
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, Union
+
+# Decodificadores opcionales
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import msgspec
+    MSGSPEC_AVAILABLE = True
+except ImportError:
+    MSGSPEC_AVAILABLE = False
+
+
+class DecodeError(ValueError):
+    """Cuerpo JSON inválido, con cualquiera de los decodificadores."""
+
+
+# Excepciones que lanzan los decodificadores ante un cuerpo inválido
+# (la de msgspec no es subclase de ValueError)
+_BACKEND_ERRORS = (ValueError, TypeError) + ((msgspec.DecodeError,) if MSGSPEC_AVAILABLE else ())
+
+
+def _stdlib_loads(data: Union[bytes, str]) -> Any:
+    return json.loads(data)
+
+
+def available_backends() -> Dict[str, Callable[[Union[bytes, str]], Any]]:
+    """Decodificadores instalados, del más rápido al más lento."""
+    backends = {}
+    if ORJSON_AVAILABLE:
+        backends["orjson"] = orjson.loads
+    if MSGSPEC_AVAILABLE:
+        backends["msgspec"] = msgspec.json.Decoder().decode
+    backends["json"] = _stdlib_loads
+    return backends
+
+
+def _select_backend():
+    backends = available_backends()
+    requested = os.getenv("ALEGRA_JSON_BACKEND")
+    if requested:
+        if requested in backends:
+            return requested, backends[requested]
+        logging.warning(f"Decodificador JSON '{requested}' no disponible; se usa {next(iter(backends))}")
+    name = next(iter(backends))
+    return name, backends[name]
+
+
+BACKEND, _loads = _select_backend()
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Decodificar un cuerpo JSON (bytes o str) con el decodificador seleccionado.
+    Lanza DecodeError si el cuerpo no es JSON válido.
+    """
+    try:
+        return _loads(data)
+    except _BACKEND_ERRORS as e:
+        raise DecodeError(f"JSON inválido ({BACKEND}): {e}") from e
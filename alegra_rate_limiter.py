@@ -0,0 +1,161 @@
+"""
+Limitador global de peticiones a la API de Alegra
+-------------------------------------------------
+
+Token bucket (peticiones por minuto + tamaño de ráfaga) compartido por todos los
+extractores que corren en el mismo proceso (`main.py` los ejecuta uno tras otro con
+runpy, así que el módulo y su instancia se comparten).
+
+▶ Uso:
+   - Código asíncrono:  `await get_alegra_rate_limiter().acquire()`
+   - Código síncrono:   `get_alegra_rate_limiter().acquire_sync()`
+   - Tras un 429:       `get_alegra_rate_limiter().penalize(segundos)`
+
+▶ Variables de entorno:
+   - ALEGRA_RATE_LIMIT_RPM    Peticiones por minuto para toda la cuenta. Sin definir (o 0) el
+                              bucket está desactivado: no se impone un ritmo propio y solo se
+                              respetan las pausas tras un 429 (el AIMD de cada extractor regula
+                              la concurrencia). Definirla con la cuota de peticiones por minuto
+                              que la documentación de la API de Alegra indica para el plan de
+                              la cuenta, para no llegar a los 429.
+   - ALEGRA_RATE_LIMIT_BURST  Ráfaga máxima permitida (default 10)
+   - ALEGRA_RATE_STATE_FILE   Archivo donde persistir el estado entre ejecuciones
+                              (default .alegra_rate_state.json; vacío para desactivar)
+
+Persistir el estado evita que dos ejecuciones seguidas arranquen con la ráfaga
+completa y se ganen una penalización de 60s por parte de la API.
+"""
+from __future__ import annotations
+
+import asyncio
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+DEFAULT_RATE_PER_MINUTE = 0   # 0 = sin ritmo propio (solo pausas tras 429), ver ALEGRA_RATE_LIMIT_RPM
+DEFAULT_BURST = 10
+DEFAULT_STATE_FILE = ".alegra_rate_state.json"
+
+
+class TokenBucket:
+    """
+    Token bucket seguro para hilos y corrutinas.
+
+    Cada `acquire` reserva un token (el saldo puede quedar negativo) y espera el tiempo
+    necesario para que ese token se genere, de modo que las peticiones se atienden en
+    orden de llegada sin bucles de sondeo. Con `rate_per_minute` <= 0 no se cuentan
+    tokens y `acquire` solo espera a que termine una pausa por 429.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int, state_file: Optional[str] = None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.enabled = rate_per_minute > 0
+        self.burst = burst
+        self.state_file = Path(state_file) if state_file else None
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+        self._load_state()
+
+    # ------------------------------------------------------------------
+    # Reservas
+    # ------------------------------------------------------------------
+    def _refill(self, now: float):
+        # Durante una pausa `updated_at` queda en el futuro: no se generan tokens hasta que termine
+        if now <= self.updated_at:
+            return
+        elapsed = now - self.updated_at
+        self.tokens = min(float(self.burst), self.tokens + elapsed * self.rate_per_second)
+        self.updated_at = now
+
+    def _reserve(self) -> float:
+        """Reservar un token y retornar cuántos segundos hay que esperar para usarlo."""
+        with self._lock:
+            now = time.time()
+            if not self.enabled:
+                return max(0.0, self.paused_until - now)
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate_per_second if self.tokens < 0 else 0.0
+            # Los tokens en deuda se generan a partir del reloj de recarga (el fin de la pausa)
+            return max(wait + max(0.0, self.updated_at - now), self.paused_until - now)
+
+    async def acquire(self):
+        """Esperar (sin bloquear el event loop) hasta tener permiso para una petición."""
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self):
+        """Esperar (bloqueando el hilo) hasta tener permiso para una petición."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def penalize(self, seconds: float):
+        """Registrar un 429: nadie vuelve a llamar a la API hasta que pasen `seconds`."""
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            self.tokens = min(self.tokens, 0.0)
+            self.paused_until = max(self.paused_until, now + seconds)
+            # Sin recarga durante la pausa: al terminar no hay ráfaga, se sigue al ritmo normal
+            self.updated_at = max(self.updated_at, self.paused_until)
+        logging.warning(f"🛑 Limitador global de Alegra en pausa por {seconds:.0f}s tras un 429")
+        self.save_state()
+
+    # ------------------------------------------------------------------
+    # Persistencia
+    # ------------------------------------------------------------------
+    def _load_state(self):
+        if not self.state_file or not self.state_file.exists():
+            return
+        try:
+            state = json.loads(self.state_file.read_text())
+            self.tokens = float(state.get("tokens", self.burst))
+            self.updated_at = float(state.get("updated_at", time.time()))
+            self.paused_until = float(state.get("paused_until", 0.0))
+            self._refill(time.time())
+            logging.debug(f"Estado del limitador cargado: {self.tokens:.1f} tokens disponibles")
+        except (OSError, ValueError, TypeError) as e:
+            logging.warning(f"No se pudo leer el estado del limitador ({self.state_file}): {e}")
+
+    def save_state(self):
+        """Guardar tokens y pausa vigente para la próxima ejecución."""
+        if not self.state_file:
+            return
+        with self._lock:
+            self._refill(time.time())
+            state = {
+                "tokens": self.tokens,
+                "updated_at": self.updated_at,
+                "paused_until": self.paused_until,
+            }
+        try:
+            self.state_file.write_text(json.dumps(state))
+        except OSError as e:
+            logging.warning(f"No se pudo guardar el estado del limitador ({self.state_file}): {e}")
+
+
+_LIMITER: Optional[TokenBucket] = None
+_LIMITER_LOCK = threading.Lock()
+
+
+def get_alegra_rate_limiter() -> TokenBucket:
+    """Retorna el limitador de la cuenta de Alegra compartido por todo el proceso."""
+    global _LIMITER
+    with _LIMITER_LOCK:
+        if _LIMITER is None:
+            _LIMITER = TokenBucket(
+                rate_per_minute=float(os.getenv("ALEGRA_RATE_LIMIT_RPM", DEFAULT_RATE_PER_MINUTE)),
+                burst=int(os.getenv("ALEGRA_RATE_LIMIT_BURST", DEFAULT_BURST)),
+                state_file=os.getenv("ALEGRA_RATE_STATE_FILE", DEFAULT_STATE_FILE) or None,
+            )
+            atexit.register(_LIMITER.save_state)
+        return _LIMITER
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Respaldo incremental de facturas en Parquet particionado por mes
+----------------------------------------------------------------
+
+En lugar de reescribir `facturas_backup.csv` completo en cada ejecución, el extractor
+de ventas agrega solo las líneas insertadas en la corrida a archivos Parquet
+particionados por mes de la factura:
+
+    backup/facturas/fecha=YYYY-MM/part-<timestamp>-<uuid>.parquet
+
+El costo del respaldo es proporcional al delta, no a la historia.
+
+Comandos
+--------
+```bash
+python backup_facturas_parquet.py compact                    # un archivo por partición, sin duplicados
+python backup_facturas_parquet.py restore                    # cargar todo el respaldo a PostgreSQL
+python backup_facturas_parquet.py restore --month 2024-05    # solo una partición
+```
+
+Como el extractor escribe en modo upsert, una misma línea (id, linea) puede aparecer en
+varias partes; la compactación y la restauración conservan la versión más reciente.
+
+Requisitos: `pip install pyarrow`
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import sys
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+import pandas as pd
+
+# Dependencia opcional para Parquet
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+    logging.warning("pyarrow no está disponible. El respaldo Parquet estará desactivado.")
+
+DEFAULT_BACKUP_DIR = "backup/facturas"
+NATURAL_KEY = ['id', 'linea']
+
+
+# ---------------------------------------------------------------------------
+# Escritura incremental
+# ---------------------------------------------------------------------------
+
+def _partition_dir(base_dir: Path, month: str) -> Path:
+    return base_dir / f"fecha={month}"
+
+
+def _new_part_name(prefix: str = "part") -> str:
+    # El timestamp al inicio hace que el orden alfabético sea el orden de escritura
+    return f"{prefix}-{datetime.now().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}.parquet"
+
+
+def append_partitioned(df: pd.DataFrame, base_dir: str = DEFAULT_BACKUP_DIR) -> int:
+    """
+    Agregar las líneas de `df` al respaldo, un archivo nuevo por mes presente en el lote.
+    Retorna la cantidad de archivos escritos.
+    """
+    if not PARQUET_AVAILABLE:
+        raise RuntimeError("pyarrow no está instalado")
+    if df.empty:
+        return 0
+
+    base = Path(base_dir)
+    months = pd.to_datetime(df['fecha']).dt.strftime('%Y-%m')
+    written = 0
+
+    for month, part_df in df.groupby(months, sort=True):
+        partition = _partition_dir(base, month)
+        partition.mkdir(parents=True, exist_ok=True)
+        part_df.to_parquet(partition / _new_part_name(), index=False)
+        written += 1
+
+    return written
+
+
+# ---------------------------------------------------------------------------
+# Lectura, compactación y restauración
+# ---------------------------------------------------------------------------
+
+def list_partitions(base_dir: str = DEFAULT_BACKUP_DIR) -> List[Path]:
+    """Particiones existentes, ordenadas por mes."""
+    base = Path(base_dir)
+    if not base.exists():
+        return []
+    return sorted(p for p in base.iterdir() if p.is_dir() and p.name.startswith("fecha="))
+
+
+def read_partition(partition: Path) -> pd.DataFrame:
+    """Leer todas las partes de una partición y conservar la última versión de cada línea."""
+    parts = sorted(partition.glob("*.parquet"))
+    if not parts:
+        return pd.DataFrame()
+
+    df = pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+    key = [col for col in NATURAL_KEY if col in df.columns]
+    if key:
+        df = df.drop_duplicates(subset=key, keep='last').sort_values(key)
+    return df.reset_index(drop=True)
+
+
+def compact(base_dir: str = DEFAULT_BACKUP_DIR) -> int:
+    """
+    Reescribir cada partición con varias partes como un único archivo sin duplicados.
+    El archivo compactado se escribe antes de borrar las partes, así que una
+    interrupción nunca deja la partición sin datos. Retorna las particiones compactadas.
+    """
+    compacted = 0
+    for partition in list_partitions(base_dir):
+        parts = sorted(partition.glob("*.parquet"))
+        if len(parts) <= 1:
+            continue
+
+        df = read_partition(partition)
+        target = partition / _new_part_name("compacted")
+        df.to_parquet(target, index=False)
+        for part in parts:
+            part.unlink()
+
+        logging.info(f"Partición {partition.name}: {len(parts)} partes → 1 ({len(df)} líneas)")
+        compacted += 1
+
+    return compacted
+
+
+def restore(base_dir: str = DEFAULT_BACKUP_DIR, month: Optional[str] = None) -> bool:
+    """
+    Restaurar el respaldo a la tabla facturas, una partición a la vez, usando el camino
+    de inserción del extractor (upsert por id + linea, así que es seguro re-ejecutarlo).
+    """
+    import extractor_facturas_alegra_sagrado as ventas
+
+    partitions = list_partitions(base_dir)
+    if month:
+        partitions = [p for p in partitions if p.name == f"fecha={month}"]
+    if not partitions:
+        logging.warning(f"No hay particiones para restaurar en {base_dir}")
+        return True
+
+    extractor = ventas.AlegraFacturasExtractor()
+    if not extractor.connect_database() or not extractor.create_table_if_not_exists():
+        logging.error("No se pudo preparar la base de datos para la restauración")
+        return False
+
+    success = True
+    for partition in partitions:
+        df = read_partition(partition)
+        columns = [col for col in ventas.FACTURAS_COLUMNS if col in df.columns]
+        logging.info(f"Restaurando {partition.name}: {len(df)} líneas")
+        if not extractor.insert_to_database(df[columns]):
+            logging.error(f"Falló la restauración de {partition.name}")
+            success = False
+
+    return success
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def main() -> int:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s | %(levelname)s | %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=DEFAULT_BACKUP_DIR, help="directorio base del respaldo")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("compact", help="compactar cada partición en un solo archivo")
+    restore_parser = subparsers.add_parser("restore", help="restaurar el respaldo a PostgreSQL")
+    restore_parser.add_argument("--month", help="restaurar solo la partición YYYY-MM")
+    args = parser.parse_args()
+
+    if not PARQUET_AVAILABLE:
+        logging.error("pyarrow no está instalado: pip install pyarrow")
+        return 1
+
+    if args.command == "compact":
+        logging.info(f"Particiones compactadas: {compact(args.dir)}")
+        return 0
+    return 0 if restore(args.dir, args.month) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+Benchmarks del extractor de facturas de ventas
+----------------------------------------------
+
+Micro-benchmarks reproducibles sobre datos sintéticos con la forma de las
+respuestas de la API de Alegra. No requieren acceso a la API.
+
+Uso
+---
+```bash
+python benchmark_facturas.py flatten --invoices 20000   # paridad + tiempos del aplanado
+python benchmark_facturas.py memory --invoices 20000    # bytes por factura: dicts crudos vs InvoiceRecord
+python benchmark_facturas.py decode --cache .alegra_http_cache.sqlite  # decodificadores JSON sobre páginas grabadas
+python benchmark_facturas.py load --rows 10000 100000    # to_sql vs COPY (requiere DATABASE_URL)
+python benchmark_facturas.py parallel --workers 1 2 4 8  # curva de escalado de la carga paralela
+python benchmark_facturas.py resume                      # reanudación del backfill (página fallida + cola incompleta)
+```
+
+Los benchmarks de carga escriben en una tabla temporal `facturas_bench` con la misma
+estructura que `facturas` y la eliminan al terminar; nunca tocan `facturas`.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+from sqlalchemy import text
+
+import alegra_json
+import extractor_facturas_alegra_sagrado as ventas
+
+
+# ---------------------------------------------------------------------------
+# Datos sintéticos
+# ---------------------------------------------------------------------------
+
+def generate_invoices(count: int, max_items: int = 6, seed: int = 42) -> List[Dict[str, Any]]:
+    """Genera facturas con la misma forma que la API (incluye campos que se descartan)."""
+    rng = random.Random(seed)
+    # Incluye valores que la API a veces manda sin nombre o con otro tipo (deben tomar el valor por defecto)
+    sellers = [{'id': '1', 'name': 'Vendedor A'}, {'id': '2', 'name': 'Vendedor B'}, None, '', {'id': '3'}, 7]
+    clients = [{'id': '1', 'name': 'Cliente A'}, {'id': '2', 'name': 'Cliente B'}, {'id': '3'}, None]
+    methods = ['cash', 'transfer', 'credit-card', None]
+    invoices = []
+
+    for n in range(1, count + 1):
+        day = f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        items = [
+            {
+                'id': str(rng.randint(1, 5000)),
+                'name': f"Producto {rng.randint(1, 5000)}",
+                'price': round(rng.uniform(1000, 500000), 2),
+                'quantity': rng.randint(1, 5),
+                'total': round(rng.uniform(1000, 900000), 2),
+                'discount': 0,
+                'tax': [{'id': '1', 'percentage': '19.00'}],
+                'reference': None,
+            }
+            for _ in range(rng.randint(1, max_items))
+        ]
+        invoices.append({
+            'id': str(n),
+            'date': day,
+            'datetime': f"{day} {rng.randint(8, 20):02d}:{rng.randint(0, 59):02d}:00",
+            'dueDate': day,
+            'client': (
+                {'id': str(rng.randint(1, 800)), 'name': f"Cliente {rng.randint(1, 800)}"}
+                if rng.random() < 0.9 else rng.choice(clients)
+            ),
+            'seller': rng.choice(sellers),
+            'paymentMethod': rng.choice(methods),
+            'totalPaid': round(sum(item['total'] for item in items), 2),
+            'items': items,
+            'observations': 'Sin observaciones',
+            'payments': [{'id': '1', 'amount': 1000}],
+            'stamp': {'legalStatus': 'STAMPED_AND_ACCEPTED', 'cufe': 'x' * 96},
+            'numberTemplate': {'prefix': 'FE', 'number': str(n)},
+            'status': 'closed',
+            'total': 0,
+        })
+
+    return invoices
+
+
+def generate_line_items(rows: int) -> pd.DataFrame:
+    """Genera `rows` líneas de facturas con el esquema de la tabla facturas."""
+    invoices = generate_invoices(max(1, rows // 3) + 1)
+    line_items = ventas.flatten_invoices(invoices)
+    while len(line_items) < rows:
+        line_items = pd.concat([line_items, line_items], ignore_index=True)
+    return line_items.head(rows)
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+def bench_flatten(args: argparse.Namespace) -> int:
+    """
+    Compara el aplanado legacy (apply/iterrows) contra el columnar y verifica paridad.
+
+    Los datos sintéticos siempre traen `datetime` y `totalPaid`: cuando faltan, la ruta
+    legacy deja NaN (el DataFrame intermedio los convierte) mientras que la columnar
+    aplica los valores por defecto, así que ahí no hay paridad por diseño.
+    """
+    invoices = generate_invoices(args.invoices)
+    extractor = ventas.AlegraFacturasExtractor()
+
+    def legacy(raw):
+        return extractor.transform_to_line_items(extractor.clean_invoice_data(pd.DataFrame(raw)))
+
+    legacy_df, legacy_s = _timed(legacy, invoices)
+    columnar_df, columnar_s = _timed(ventas.flatten_invoices, invoices)
+
+    pd.testing.assert_frame_equal(legacy_df, columnar_df)
+    print(f"Paridad OK: {len(columnar_df)} líneas idénticas desde {len(invoices)} facturas")
+    print(f"legacy   : {legacy_s:8.3f}s")
+    print(f"columnar : {columnar_s:8.3f}s  ({legacy_s / columnar_s:.1f}x)")
+    return 0
+
+
+BENCH_TABLE = "facturas_bench"
+
+
+def _bench_extractor():
+    """Extractor conectado, con `facturas_bench` recién creada (None si no hay BD)."""
+    extractor = ventas.AlegraFacturasExtractor()
+    if not extractor.connect_database() or not extractor.create_table_if_not_exists():
+        print("No se pudo conectar a la base de datos (revisa DATABASE_URL)")
+        return None
+
+    ventas.DB_WRITE_MODE = "append"  # se mide el método de carga, no el merge
+    with extractor.engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {BENCH_TABLE}"))
+        conn.execute(text(f"CREATE TABLE {BENCH_TABLE} (LIKE facturas)"))
+        conn.execute(text(f"ALTER TABLE {BENCH_TABLE} DROP COLUMN indx, DROP COLUMN created_at"))
+    return extractor
+
+
+def _truncate_bench(extractor):
+    with extractor.engine.begin() as conn:
+        conn.execute(text(f"TRUNCATE {BENCH_TABLE}"))
+
+
+def _drop_bench(extractor):
+    with extractor.engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {BENCH_TABLE}"))
+
+
+def _retained_bytes(build):
+    """Bytes que quedan asignados tras `build()` (lo que se retiene mientras espera la ventana)."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak
+
+
+def bench_memory(args: argparse.Namespace) -> int:
+    """
+    Memoria retenida por factura: páginas JSON decodificadas a dicts completos contra
+    páginas proyectadas a InvoiceRecord apenas se reciben (como en el modo streaming).
+    """
+    invoices = generate_invoices(args.invoices)
+    payloads = [
+        json.dumps(invoices[i:i + ventas.LIMIT]).encode()
+        for i in range(0, len(invoices), ventas.LIMIT)
+    ]
+    del invoices
+
+    raw, raw_bytes, raw_peak = _retained_bytes(lambda: [json.loads(body) for body in payloads])
+    records, compact_bytes, compact_peak = _retained_bytes(
+        lambda: [ventas.project_invoices(json.loads(body)) for body in payloads]
+    )
+
+    raw_df = ventas.flatten_invoices([invoice for page in raw for invoice in page])
+    compact_df = ventas.flatten_records([record for page in records for record in page])
+    pd.testing.assert_frame_equal(raw_df, compact_df)
+
+    count = sum(len(page) for page in raw)
+    print(f"Paridad OK: {len(compact_df)} líneas idénticas desde {count} facturas")
+    print(f"dicts crudos    : {raw_bytes / count:8.0f} bytes/factura (pico {raw_peak / 2**20:.1f} MiB)")
+    print(f"InvoiceRecord   : {compact_bytes / count:8.0f} bytes/factura (pico {compact_peak / 2**20:.1f} MiB)")
+    print(f"reducción       : {raw_bytes / compact_bytes:.1f}x")
+    return 0
+
+
+def _recorded_payloads(cache_file: str) -> List[bytes]:
+    """Cuerpos de respuestas de facturas grabados en la caché HTTP del extractor."""
+    import sqlite3
+    import zlib
+
+    conn = sqlite3.connect(cache_file)
+    try:
+        rows = conn.execute("SELECT body FROM responses WHERE url LIKE '%/invoices?%'").fetchall()
+    finally:
+        conn.close()
+    return [zlib.decompress(body) for (body,) in rows]
+
+
+def bench_decode(args: argparse.Namespace) -> int:
+    """
+    CPU por cada 1.000 facturas con cada decodificador JSON instalado, solo decodificando
+    y decodificando + proyectando a InvoiceRecord. Usa páginas grabadas en la caché HTTP
+    (--cache) o, si no se indica, páginas sintéticas.
+    """
+    if args.cache:
+        payloads = _recorded_payloads(args.cache)
+        source = f"{len(payloads)} páginas grabadas en {args.cache}"
+    else:
+        invoices = generate_invoices(args.invoices)
+        payloads = [
+            json.dumps(invoices[i:i + ventas.LIMIT]).encode()
+            for i in range(0, len(invoices), ventas.LIMIT)
+        ]
+        source = f"{len(payloads)} páginas sintéticas"
+
+    count = sum(len(json.loads(body)) for body in payloads)
+    if not count:
+        print("No hay facturas en las páginas")
+        return 1
+    print(f"{source}, {count} facturas (decodificador activo: {alegra_json.BACKEND})")
+
+    results = {}
+    for name, loads in alegra_json.available_backends().items():
+        def decode():
+            for body in payloads:
+                loads(body)
+
+        def decode_and_project():
+            for body in payloads:
+                ventas.project_invoices(loads(body))
+
+        decode_s = min(_cpu_time(decode) for _ in range(args.repeat))
+        project_s = min(_cpu_time(decode_and_project) for _ in range(args.repeat))
+        results[name] = (decode_s * 1e6 / count, project_s * 1e6 / count)
+
+    stdlib_decode, _ = results['json']
+    for name, (decode_ms, project_ms) in results.items():
+        print(
+            f"{name:<8}: {decode_ms:7.2f} ms CPU/1.000 facturas decodificando "
+            f"(ahorro {stdlib_decode - decode_ms:6.2f} ms vs json), {project_ms:7.2f} ms con proyección"
+        )
+    return 0
+
+
+def _cpu_time(func) -> float:
+    start = time.process_time()
+    func()
+    return time.process_time() - start
+
+
+def bench_load(args: argparse.Namespace) -> int:
+    """Compara la carga con to_sql (executemany) contra COPY FROM STDIN."""
+    extractor = _bench_extractor()
+    if extractor is None:
+        return 1
+
+    try:
+        for rows in args.rows:
+            df = generate_line_items(rows)
+            for method in args.methods:
+                _truncate_bench(extractor)
+                ventas.DB_INSERT_METHOD = method
+                _, seconds = _timed(extractor._write_frame, df, BENCH_TABLE)
+                print(f"{rows:>9} filas | {method:<7}: {seconds:8.2f}s ({rows / seconds:,.0f} filas/s)")
+    finally:
+        _drop_bench(extractor)
+    return 0
+
+
+def bench_parallel(args: argparse.Namespace) -> int:
+    """Curva de escalado de la carga paralela por rangos de id (COPY, una conexión por shard)."""
+    extractor = _bench_extractor()
+    if extractor is None:
+        return 1
+
+    ventas.DB_INSERT_METHOD = "copy"
+    df = generate_line_items(args.rows)
+    baseline = None
+    try:
+        for workers in args.workers:
+            _truncate_bench(extractor)
+            (shards, failed), seconds = _timed(extractor._parallel_load, df, BENCH_TABLE, workers)
+            if failed or not extractor._verify_shard_counts(shards, BENCH_TABLE):
+                print(f"{workers:>3} conexiones: la carga no quedó completa")
+                return 1
+            baseline = baseline or seconds
+            print(
+                f"{workers:>3} conexiones: {seconds:8.2f}s ({args.rows / seconds:,.0f} filas/s, "
+                f"{baseline / seconds:.2f}x)"
+            )
+    finally:
+        _drop_bench(extractor)
+    return 0
+
+
+class _FakeResponse:
+    def __init__(self, status: int, body: bytes):
+        self.status = status
+        self.headers = {}
+        self._body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def read(self) -> bytes:
+        return self._body
+
+
+class _FakeInvoicesAPI:
+    """API de facturas en memoria: `start` se interpreta como id inicial, como en el extractor."""
+
+    def __init__(self, last_id: int, failing_starts=()):
+        self.last_id = last_id
+        self.failing_starts = set(failing_starts)
+
+    def get(self, url: str, **kwargs):
+        query = parse_qs(urlparse(url).query)
+        start, limit = int(query['start'][0]), int(query['limit'][0])
+        if start in self.failing_starts:
+            return _FakeResponse(400, b"{}")
+        ids = range(start, min(start + limit, self.last_id + 1))
+        page = [
+            {'id': str(i), 'date': '2024-01-01', 'datetime': '2024-01-01 10:00:00', 'client': {'name': 'c'},
+             'seller': None, 'paymentMethod': 'cash', 'totalPaid': 1,
+             'items': [{'id': '1', 'name': 'x', 'price': 1, 'quantity': 1, 'total': 1}]}
+            for i in ids
+        ]
+        return _FakeResponse(200, json.dumps(page).encode())
+
+
+def bench_resume(args: argparse.Namespace) -> int:
+    """
+    Reanudación de un backfill con una página fallida y una página final incompleta: la
+    segunda corrida debe volver a pedir ambas y recuperar las facturas creadas entre
+    corridas. Usa los checkpoints de la llave `facturas_bench` (no toca `facturas`).
+    """
+    extractor = ventas.AlegraFacturasExtractor()
+    if not extractor.connect_database() or not extractor.create_table_if_not_exists():
+        print("No se pudo conectar a la base de datos (revisa DATABASE_URL)")
+        return 1
+
+    ventas.SYNC_STATE_KEY = BENCH_TABLE
+    ventas.HTTP_CACHE_ENABLED = False
+    limit = ventas.LIMIT
+    loaded = set()
+
+    def process_window(invoices):
+        loaded.update(int(record.id) for record in invoices)
+        return True
+
+    async def run(api, start_id, end_id):
+        extractor.page_failures = {}
+        starts = extractor.plan_backfill_pages(start_id, end_id)
+        await ventas.extract_invoices_streaming(
+            start_id, end_id, process_window, starts=starts, checkpoint=extractor.save_page_checkpoints,
+            failures=extractor.page_failures, session=api,
+        )
+        return starts
+
+    first_total, second_total = 3 * limit + limit // 3, 3 * limit + 2 * limit // 3
+    extractor.clear_backfill_checkpoints()
+    try:
+        # 1ª corrida: falla la segunda página y la última llega incompleta
+        asyncio.run(run(_FakeInvoicesAPI(first_total, failing_starts={1 + limit}), 1, first_total))
+        # 2ª corrida: la API ya tiene más facturas; se reanuda desde MAX(id) + 1
+        starts = asyncio.run(run(_FakeInvoicesAPI(second_total), max(loaded) + 1, second_total))
+    finally:
+        extractor.clear_backfill_checkpoints()
+
+    missing = sorted(set(range(1, second_total + 1)) - loaded)
+    print(f"Páginas re-planificadas al reanudar: {starts}")
+    if missing:
+        print(f"❌ Facturas perdidas al reanudar: {missing}")
+        return 1
+    print(f"Reanudación OK: {len(loaded)} facturas, sin huecos")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    flatten = subparsers.add_parser("flatten", help="paridad y tiempos del aplanado de facturas")
+    flatten.add_argument("--invoices", type=int, default=20000)
+    flatten.set_defaults(func=bench_flatten)
+
+    memory = subparsers.add_parser("memory", help="bytes por factura retenidos: dicts vs InvoiceRecord")
+    memory.add_argument("--invoices", type=int, default=20000)
+    memory.set_defaults(func=bench_memory)
+
+    decode = subparsers.add_parser("decode", help="CPU por 1.000 facturas con cada decodificador JSON")
+    decode.add_argument("--cache", help="caché HTTP del extractor con páginas grabadas")
+    decode.add_argument("--invoices", type=int, default=20000, help="facturas sintéticas si no hay --cache")
+    decode.add_argument("--repeat", type=int, default=5)
+    decode.set_defaults(func=bench_decode)
+
+    load = subparsers.add_parser("load", help="to_sql vs COPY FROM STDIN contra DATABASE_URL")
+    load.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    load.add_argument("--methods", nargs="+", choices=["to_sql", "copy"], default=["to_sql", "copy"])
+    load.set_defaults(func=bench_load)
+
+    parallel = subparsers.add_parser("parallel", help="escalado de la carga paralela según conexiones")
+    parallel.add_argument("--rows", type=int, default=200000)
+    parallel.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parallel.set_defaults(func=bench_parallel)
+
+    resume = subparsers.add_parser("resume", help="reanudación del backfill con página fallida y cola incompleta")
+    resume.set_defaults(func=bench_resume)
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
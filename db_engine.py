@@ -0,0 +1,157 @@
+"""
+Engine compartido de PostgreSQL (Railway)
+-----------------------------------------
+
+Fábrica única de engines de SQLAlchemy para todos los scripts. Cada URL tiene un solo
+engine por proceso (`main.py` ejecuta los scripts uno tras otro con runpy, así que las
+conexiones calientes del pool se reutilizan entre scripts).
+
+▶ El engine se crea con:
+   - pool_pre_ping: cada checkout valida la conexión y reemplaza las muertas, así que
+     no hace falta un `SELECT 1` manual antes de cada inserción.
+   - pool_size / max_overflow / pool_recycle dimensionados para el proxy de Railway.
+   - TCP keepalives y connect_timeout (libpq: psycopg2 o psycopg 3), para detectar conexiones cortadas.
+   - statement_timeout por sesión, para que una consulta colgada no bloquee la corrida.
+
+▶ `wake_up(engine)` es la única compuerta de wake-up: si varios hilos detectan la BD
+   dormida a la vez, uno solo la despierta y los demás esperan su resultado.
+
+▶ Variables de entorno:
+   - DB_POOL_SIZE              Conexiones permanentes del pool (default 5)
+   - DB_MAX_OVERFLOW           Conexiones extra temporales (default 10)
+   - DB_POOL_RECYCLE           Segundos antes de reciclar una conexión (default 1800)
+   - DB_CONNECT_TIMEOUT        Segundos para abrir una conexión (default 10)
+   - DB_STATEMENT_TIMEOUT_MS   Tiempo máximo por sentencia en ms (default 600000; 0 desactiva)
+   - DB_KEEPALIVES_IDLE        Segundos de inactividad antes del primer keepalive (default 30)
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine, make_url
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_RECYCLE = 1800
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_STATEMENT_TIMEOUT_MS = 600000
+DEFAULT_KEEPALIVES_IDLE = 30
+
+# Drivers sobre libpq: aceptan los mismos parámetros de conexión
+LIBPQ_DRIVERS = ("psycopg2", "psycopg")
+
+WAKE_UP_RETRIES = 5
+WAKE_UP_INITIAL_DELAY = 5
+WAKE_UP_MAX_DELAY = 30
+
+RECOVERABLE_ERROR_MARKERS = ['503', 'timeout', 'connection', 'unavailable', 'sleeping', 'broken pipe']
+
+_ENGINES: Dict[str, Engine] = {}
+_ENGINES_LOCK = threading.Lock()
+_WAKE_LOCK = threading.Lock()
+_LAST_WAKE: Dict[int, float] = {}
+
+
+def _connect_args(db_url: str) -> dict:
+    """Parámetros de conexión de libpq: keepalives, timeout de conexión y statement_timeout."""
+    url = make_url(db_url)
+    if url.get_backend_name() != "postgresql":
+        return {}
+    if url.get_driver_name() not in LIBPQ_DRIVERS:
+        logging.warning(
+            f"Driver '{url.get_driver_name()}' no usa libpq: se omiten keepalives, "
+            f"connect_timeout y statement_timeout"
+        )
+        return {}
+
+    args = {
+        "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)),
+        "keepalives": 1,
+        "keepalives_idle": int(os.getenv("DB_KEEPALIVES_IDLE", DEFAULT_KEEPALIVES_IDLE)),
+        "keepalives_interval": 10,
+        "keepalives_count": 5,
+    }
+    statement_timeout = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", DEFAULT_STATEMENT_TIMEOUT_MS))
+    if statement_timeout:
+        args["options"] = f"-c statement_timeout={statement_timeout}"
+    return args
+
+
+def create_db_engine(db_url: str) -> Engine:
+    """Crear un engine nuevo con el pool y los parámetros de conexión ajustados."""
+    return create_engine(
+        db_url,
+        pool_pre_ping=True,
+        pool_size=int(os.getenv("DB_POOL_SIZE", DEFAULT_POOL_SIZE)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", DEFAULT_MAX_OVERFLOW)),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", DEFAULT_POOL_RECYCLE)),
+        connect_args=_connect_args(db_url),
+    )
+
+
+def get_engine(db_url: Optional[str] = None) -> Engine:
+    """
+    Engine compartido por el proceso para `db_url` (por defecto DATABASE_URL).
+    Lanza ValueError si no hay URL configurada.
+    """
+    db_url = db_url or os.getenv("DATABASE_URL")
+    if not db_url:
+        raise ValueError("DATABASE_URL no está configurada")
+
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(db_url)
+        if engine is None:
+            engine = create_db_engine(db_url)
+            _ENGINES[db_url] = engine
+        return engine
+
+
+def is_recoverable_error(error: Exception) -> bool:
+    """Errores de conexión/disponibilidad (BD dormida, proxy caído) que merecen reintento."""
+    error_str = str(error).lower()
+    return any(marker in error_str for marker in RECOVERABLE_ERROR_MARKERS)
+
+
+def wake_up(engine: Engine, retries: int = WAKE_UP_RETRIES, initial_delay: float = WAKE_UP_INITIAL_DELAY,
+            max_delay: float = WAKE_UP_MAX_DELAY) -> bool:
+    """
+    Despertar la BD con reintentos exponenciales (las BD de Railway duermen cuando no se
+    usan). Si otro hilo ya la despertó mientras este esperaba la compuerta, retorna de
+    inmediato sin volver a consultar.
+    """
+    requested_at = time.monotonic()
+    with _WAKE_LOCK:
+        if _LAST_WAKE.get(id(engine), 0.0) >= requested_at:
+            return True
+
+        delay = initial_delay
+        for attempt in range(1, retries + 1):
+            try:
+                logging.info(f"🔄 Intentando despertar BD (intento {attempt}/{retries})...")
+                with engine.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+                    conn.execute(text("SELECT current_timestamp"))
+                _LAST_WAKE[id(engine)] = time.monotonic()
+                logging.info("✅ Base de datos despierta y lista para recibir conexiones")
+                return True
+
+            except Exception as e:
+                if attempt < retries:
+                    if is_recoverable_error(e):
+                        logging.warning(
+                            f"⏳ BD posiblemente dormida (error: {type(e).__name__}). "
+                            f"Esperando {delay}s antes de reintentar..."
+                        )
+                    else:
+                        logging.warning(f"⚠️ Error conectando a BD: {e}. Esperando {delay}s antes de reintentar...")
+                    time.sleep(delay)
+                    delay = min(delay * 2, max_delay)
+                else:
+                    logging.error(f"❌ No se pudo despertar la BD después de {retries} intentos: {e}")
+
+        return False
@@ -4,18 +4,28 @@ Optimizado para concurrencia asíncrona y uso de la base de datos como fuente de
 """
 
 import os
-import requests
+import io
+import json
 import pandas as pd
 import datetime
 import logging
-from sqlalchemy import create_engine, types as sa_types, text
+from sqlalchemy import types as sa_types, text
 from sqlalchemy.exc import SQLAlchemyError
 from dotenv import load_dotenv
 import sys
 import asyncio
-import aiohttp
-import nest_asyncio
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+
+import alegra_http
+import alegra_json
+import db_engine
+from alegra_http_cache import ResponseCache
+from alegra_rate_limiter import get_alegra_rate_limiter
+import backup_facturas_parquet
+from run_metrics import RunMetrics
 
 # Cargar variables de entorno desde .env
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'))
@@ -32,6 +42,11 @@ logger = logging.getLogger(__name__)
 # Variable para controlar exportación a CSV al final
 EXPORT_TO_CSV = True  # Cambiar a True para exportar
 
+# Formato del respaldo: "parquet" agrega solo las líneas insertadas en la corrida a
+# particiones mensuales en BACKUP_DIR; "csv" reescribe facturas_backup.csv completo
+BACKUP_FORMAT = "parquet"
+BACKUP_DIR = "backup/facturas"
+
 # -----------------------------
 # Variables de configuración
 # -----------------------------
@@ -47,6 +62,14 @@ NETWORK_ERROR_DELAY = 5      # Segundos a esperar tras excepción de red
 MAX_RETRIES = 5              # Número máximo de reintentos por página
 RECOVERABLE_HTTP_ERRORS = [429, 500, 502, 503, 504]  # Errores HTTP que merecen reintento
 
+# -----------------------------
+# Control adaptativo de concurrencia (AIMD)
+# -----------------------------
+ADAPTIVE_MIN_CONCURRENCY = 1      # Piso de peticiones en vuelo
+ADAPTIVE_MAX_CONCURRENCY = 16     # Techo de peticiones en vuelo
+ADAPTIVE_LATENCY_TARGET = 5.0     # Segundos; por encima de esta latencia no se aumenta la concurrencia
+ADAPTIVE_DECREASE_FACTOR = 0.5    # Multiplicador del límite tras 429/5xx/timeout
+
 # -----------------------------
 # Configuración de BD robusta (wake-up e inserción garantizada)
 # -----------------------------
@@ -56,52 +79,345 @@ DB_WAKE_UP_MAX_DELAY = 30     # Máximo de segundos entre intentos de wake-up
 DB_INSERT_RETRIES = 5         # Intentos para inserción de datos
 DB_INSERT_INITIAL_DELAY = 3   # Segundos iniciales de espera entre intentos de inserción
 DB_INSERT_CHUNK_SIZE = 100    # Tamaño de chunk para inserción fallback
-DB_INSERT_INDIVIDUAL_RETRIES = 3  # Reintentos para inserción individual
+DB_BISECT_RETRIES = 3         # Reintentos de una misma parte ante errores de conexión durante la bisección
+DB_LOAD_WORKERS = 1           # Conexiones en paralelo para cargar lotes grandes (1 = carga secuencial)
+PARALLEL_LOAD_MIN_SHARD_ROWS = 200  # Filas mínimas por shard de la carga paralela (una ventana de streaming trae ~1.5k)
+QUARANTINE_TABLE = "facturas_quarantine"  # Filas que la BD rechaza, con el error, para revisión manual
+DB_INSERT_METHOD = "copy"     # "copy" (COPY FROM STDIN, un round trip por batch) o "to_sql" (executemany)
+DB_WRITE_MODE = "upsert"      # "upsert" (idempotente por id + linea) o "append" (solo agrega filas;
+                              # reanudar un backfill puede duplicar filas, ver extract_and_load_streaming)
+UPSERT_OVERLAP_INVOICES = 0   # En modo upsert, re-leer esta cantidad de facturas antes de MAX(id)
 
+# -----------------------------
+# Sincronización incremental por cursor
+# -----------------------------
+SYNC_MODE = "cursor"          # "cursor" (desde el último id/fecha sincronizados) o "offset" (start desde MAX(id))
+CURSOR_LOOKBACK_DAYS = 1      # Días hacia atrás desde la fecha del cursor (facturas creadas con fecha pasada)
+SYNC_STATE_KEY = "facturas"   # Llave de este extractor en la tabla sync_state
 
 # -----------------------------
-# Funciones asíncronas para extracción concurrente
+# Arranque en paralelo (wake-up de BD + descubrimiento en la API)
+# -----------------------------
+STARTUP_HINT_FILE = ".facturas_sync_hint.json"  # Último cursor conocido, para adelantar descargas
+PREFETCH_PAGES = CONCURRENT_REQUESTS             # Páginas a descargar mientras la BD despierta
+
+# -----------------------------
+# Métricas por corrida
+# -----------------------------
+METRICS_REPORT_FILE = "metrics/facturas_last_run.json"   # Reporte JSON de la última corrida
+METRICS_HISTORY_FILE = "metrics/facturas_runs.jsonl"     # Una línea por corrida, para comparar noche a noche
+METRICS_PROMETHEUS_FILE = os.getenv("FACTURAS_PROMETHEUS_TEXTFILE")  # Textfile para node_exporter (opcional)
+
+# -----------------------------
+# Páginas fallidas (dead-letter) y re-envío al final de la corrida
+# -----------------------------
+REDRIVE_FAILED_PAGES = True   # Reintentar las páginas fallidas al terminar la extracción
+REDRIVE_CONCURRENCY = 2       # Peticiones simultáneas durante el re-envío (menor que la normal)
+
 # -----------------------------
-async def fetch_invoice_batch(session, start, batch_size=LIMIT):
+# Caché en disco de páginas de la API
+# -----------------------------
+HTTP_CACHE_ENABLED = True                        # Reusar páginas ya descargadas (backfills reintentados)
+HTTP_CACHE_FILE = ".alegra_http_cache.sqlite"    # Archivo SQLite de la caché
+HTTP_CACHE_TTL_DAYS = 30                         # Días que una página se conserva en la caché
+HTTP_CACHE_MAX_MB = 200                          # Tamaño máximo (comprimido) antes de desalojar las más viejas
+HTTP_CACHE_TRUST_DAYS = 7                        # Páginas completas con facturas anteriores a esto se sirven sin red
+
+# -----------------------------
+# Configuración del modo streaming (página → BD)
+# -----------------------------
+STREAMING_MODE = True                          # Limpiar, transformar e insertar cada ventana apenas llega
+STREAM_WINDOW_PAGES = CONCURRENT_REQUESTS * 2  # Páginas por ventana (un commit por ventana)
+STREAM_QUEUE_SIZE = 2                          # Ventanas descargadas en espera de inserción (acota la memoria)
+
+# Motor de aplanado de facturas a líneas: "columnar" (una pasada sobre el JSON crudo)
+# o "legacy" (clean_invoice_data + transform_to_line_items sobre un DataFrame)
+FLATTEN_ENGINE = "columnar"
+
+# Columnas de la tabla facturas, en el orden en que se generan las líneas.
+# (id, linea) es la llave natural: factura + posición del item dentro de la factura
+FACTURAS_COLUMNS = [
+    'id', 'linea', 'item_id', 'fecha', 'hora', 'nombre', 'precio', 'cantidad',
+    'total', 'cliente', 'totalfact', 'metodo', 'vendedor'
+]
+
+# Métricas de la corrida en curso (se reinician en cada run_extraction)
+RUN_METRICS = RunMetrics(SYNC_STATE_KEY)
+
+
+# -----------------------------
+# Control adaptativo de concurrencia
+# -----------------------------
+def parse_retry_after(value):
+    """Interpretar la cabecera Retry-After (segundos o fecha HTTP). Retorna segundos o None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrencyLimiter:
     """
-    Extrae una página de facturas y maneja errores con reintento.
-    Reintenta automáticamente en errores 429, 500, 502, 503, 504 y timeouts.
+    Limitador AIMD compartido por todas las descargas de páginas de una extracción.
+
+    - Aumento aditivo: tras `limit` respuestas sanas seguidas (200 y latencia bajo
+      ADAPTIVE_LATENCY_TARGET) permite una petición más en vuelo.
+    - Reducción multiplicativa: un 429/5xx/timeout multiplica el límite por
+      ADAPTIVE_DECREASE_FACTOR (como máximo una vez por ventana de latencia objetivo,
+      para que una ráfaga de errores simultáneos no lo desplome a 1).
+    - Un 429 pausa a *todas* las corrutinas hasta que vence Retry-After (o RETRY_DELAY_429),
+      en lugar de que cada una duerma por su cuenta mientras las demás siguen golpeando la API.
     """
+
+    def __init__(self, initial=CONCURRENT_REQUESTS, min_limit=ADAPTIVE_MIN_CONCURRENCY,
+                 max_limit=ADAPTIVE_MAX_CONCURRENCY, latency_target=ADAPTIVE_LATENCY_TARGET,
+                 decrease_factor=ADAPTIVE_DECREASE_FACTOR):
+        self.limit = max(min_limit, min(initial, max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.peak_limit = self.limit
+        self.pages_ok = 0
+        self.throttle_events = 0
+        self._healthy_streak = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._started_at = time.monotonic()
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout=pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < self.limit:
+                    break
+                await self._condition.wait()
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def on_success(self, latency):
+        """Registrar una respuesta 200 y aumentar el límite si el sistema está sano."""
+        async with self._condition:
+            self.pages_ok += 1
+            if latency > self.latency_target:
+                self._healthy_streak = 0
+                return
+            self._healthy_streak += 1
+            if self._healthy_streak >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.peak_limit = max(self.peak_limit, self.limit)
+                self._healthy_streak = 0
+                logger.debug(f"📈 Concurrencia aumentada a {self.limit}")
+                self._condition.notify_all()
+
+    async def on_throttle(self, status, retry_after=None):
+        """
+        Registrar un 429/5xx/timeout: reducir el límite y, si corresponde, pausar a todos.
+        Retorna los segundos de pausa compartida aplicados (0 si no hay pausa).
+        """
+        async with self._condition:
+            now = time.monotonic()
+            self.throttle_events += 1
+            self._healthy_streak = 0
+
+            if now - self._last_decrease >= self.latency_target:
+                new_limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+                if new_limit < self.limit:
+                    logger.warning(f"📉 Concurrencia reducida de {self.limit} a {new_limit} (status {status})")
+                self.limit = new_limit
+                self._last_decrease = now
+
+            pause = retry_after if retry_after is not None else (RETRY_DELAY_429 if status == 429 else 0)
+            if pause > 0:
+                self._paused_until = max(self._paused_until, now + pause)
+            return pause
+
+    def summary(self):
+        """Resumen de rendimiento: páginas exitosas por segundo y evolución del límite."""
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        return (
+            f"{self.pages_ok} páginas en {elapsed:.1f}s ({self.pages_ok / elapsed:.2f} páginas/s), "
+            f"límite final {self.limit}, pico {self.peak_limit}, {self.throttle_events} eventos de throttling"
+        )
+
+
+# -----------------------------
+# Caché HTTP
+# -----------------------------
+_HTTP_CACHE = None
+
+
+def get_http_cache():
+    """Caché de páginas compartida por el proceso, o None si está desactivada o no se puede abrir."""
+    global _HTTP_CACHE
+    if not HTTP_CACHE_ENABLED:
+        return None
+    if _HTTP_CACHE is None:
+        try:
+            _HTTP_CACHE = ResponseCache(
+                HTTP_CACHE_FILE,
+                ttl_seconds=HTTP_CACHE_TTL_DAYS * 86400,
+                max_bytes=HTTP_CACHE_MAX_MB * 1024 * 1024,
+                trust_days=HTTP_CACHE_TRUST_DAYS,
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo abrir la caché HTTP ({HTTP_CACHE_FILE}): {e}. Se continúa sin caché.")
+            return None
+    return _HTTP_CACHE
+
+
+# -----------------------------
+# Funciones asíncronas para extracción concurrente
+# -----------------------------
+def build_invoices_url(start, batch_size=LIMIT, filters=None):
+    """Construir la URL de una página de facturas ordenadas por id, con filtros opcionales."""
     url = (
         f"https://api.alegra.com/api/v1/invoices"
         f"?start={start}&order_direction=ASC&order_field=id&limit={batch_size}"
     )
+    for key, value in (filters or {}).items():
+        url += f"&{key}={value}"
+    return url
+
+
+def classify_page_failure(status, error):
+    """Motivo de la pérdida de una página, para el resumen del dead-letter."""
+    if status == 429:
+        return 'rate_limited'
+    if status in RECOVERABLE_HTTP_ERRORS:
+        return 'server_error'
+    if status is not None:
+        return 'client_error'
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    return 'network_error'
+
+
+async def fetch_invoice_page(session, start, batch_size=LIMIT, limiter=None, filters=None,
+                             prefetched=None, failures=None):
+    """
+    Extrae una página de facturas como lista JSON cruda y maneja errores con reintento.
+    Reintenta automáticamente en errores 429, 500, 502, 503, 504 y timeouts.
+    Cada intento ocupa un cupo de `limiter`, que ajusta la concurrencia según las respuestas.
+    Si la página ya está en `prefetched` (descargada durante el arranque) se usa sin red.
+
+    Retorna None si la página no se pudo descargar, para distinguirla de una página vacía.
+    En ese caso, si se pasa `failures` (dict), se registra ahí por URL con el último
+    status, error, motivo y cantidad de intentos.
+    """
+    url = build_invoices_url(start, batch_size, filters)
+    if prefetched and url in prefetched:
+        return prefetched.pop(url)
+
+    # Páginas completas y antiguas ya no cambian: se sirven desde la caché sin consumir cuota.
+    # SQLite y zlib bloquean, así que la caché se consulta en un hilo y no en el event loop
+    cache = get_http_cache()
+    cached = await asyncio.to_thread(cache.get, url) if cache else None
+    if cached is not None and cache.is_trusted(cached):
+        cache.hits += 1
+        RUN_METRICS.incr('cache_hits')
+        logger.debug(f"💾 Página start={start} servida desde la caché.")
+        return alegra_json.loads(cached.body)
+    request_headers = cache.conditional_headers(cached) if cache else None
+
+    limiter = limiter or AdaptiveConcurrencyLimiter()
     delay = NETWORK_ERROR_DELAY
-    
+    last_status = None
+    last_error = None
+
+    def record_failure(attempts):
+        if failures is not None:
+            failures[url] = {
+                'url': url,
+                'start': start,
+                'batch_size': batch_size,
+                'filters': filters,
+                'status': last_status,
+                'reason': classify_page_failure(last_status, last_error),
+                'attempts': attempts,
+                'last_error': str(last_error) if last_error else f"HTTP {last_status}",
+            }
+
     for attempt in range(1, MAX_RETRIES + 1):
         try:
-            async with session.get(url, headers=HEADERS, timeout=30) as response:
-                status = response.status
-                if status == 200:
-                    data = await response.json()
-                    logger.info(f"✅ Página start={start} extraída con {len(data)} facturas.")
-                    return pd.DataFrame(data)
-                elif status in RECOVERABLE_HTTP_ERRORS:
-                    # Calcular delay según el tipo de error
-                    if status == 429:
-                        wait_time = RETRY_DELAY_429
-                    else:
-                        wait_time = delay
-                    
-                    logger.warning(
-                        f"⚠️ Error {status} en start={start}. "
-                        f"Esperando {wait_time}s antes de reintentar... "
-                        f"(Intento {attempt}/{MAX_RETRIES})"
-                    )
+            async with limiter:
+                await get_alegra_rate_limiter().acquire()
+                request_started = time.monotonic()
+                async with session.get(url, headers=request_headers) as response:
+                    status = response.status
+                    if status == 304 and cached is not None:
+                        await limiter.on_success(time.monotonic() - request_started)
+                        cache.revalidated += 1
+                        RUN_METRICS.incr('cache_revalidated')
+                        await asyncio.to_thread(cache.touch, url)
+                        logger.info(f"💾 Página start={start} sin cambios (304), tomada de la caché.")
+                        return alegra_json.loads(cached.body)
+                    if status == 200:
+                        body = await response.read()
+                        data = alegra_json.loads(body)
+                        await limiter.on_success(time.monotonic() - request_started)
+                        RUN_METRICS.incr('pages_fetched')
+                        RUN_METRICS.incr('bytes_downloaded', len(body))
+                        if cache:
+                            cache.misses += 1
+                            await asyncio.to_thread(
+                                cache.put, url, body,
+                                etag=response.headers.get('ETag'),
+                                last_modified=response.headers.get('Last-Modified'),
+                                newest_date=max((inv.get('date') or '' for inv in data), default=None),
+                                complete=len(data) >= batch_size,
+                            )
+                        logger.info(f"✅ Página start={start} extraída con {len(data)} facturas.")
+                        return data
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+            last_status, last_error = status, None
+            if status in RECOVERABLE_HTTP_ERRORS:
+                RUN_METRICS.retry(status)
+                pause = await limiter.on_throttle(status, retry_after)
+                if status == 429:
+                    # Avisar al limitador global para que los demás extractores también esperen
+                    get_alegra_rate_limiter().penalize(pause)
+                # El 429 pausa a todas las corrutinas en el limitador; los 5xx usan backoff propio
+                wait_time = pause if status == 429 else max(delay, pause)
+                logger.warning(
+                    f"⚠️ Error {status} en start={start}. "
+                    f"Esperando {wait_time:.1f}s antes de reintentar... "
+                    f"(Intento {attempt}/{MAX_RETRIES})"
+                )
+                if status != 429:
                     await asyncio.sleep(wait_time)
                     # Backoff exponencial para errores que no son 429
-                    if status != 429:
-                        delay = min(delay * 2, 60)
-                else:
-                    # Error no recuperable (4xx excepto 429)
-                    logger.error(f"❌ Error {status} en start={start}. Error no recuperable, no se reintentará.")
-                    return pd.DataFrame()
-        except asyncio.TimeoutError:
+                    delay = min(delay * 2, 60)
+            else:
+                # Error no recuperable (4xx excepto 429)
+                logger.error(f"❌ Error {status} en start={start}. Error no recuperable, no se reintentará.")
+                record_failure(attempt)
+                return None
+        except asyncio.TimeoutError as e:
+            last_status, last_error = None, e
+            RUN_METRICS.retry('timeout')
+            await limiter.on_throttle('timeout')
             logger.warning(
                 f"⏱️ Timeout en start={start}. "
                 f"Esperando {delay}s antes de reintentar... "
@@ -110,6 +426,8 @@ async def fetch_invoice_batch(session, start, batch_size=LIMIT):
             await asyncio.sleep(delay)
             delay = min(delay * 2, 60)
         except Exception as e:
+            last_status, last_error = None, e
+            RUN_METRICS.retry('exception')
             logger.warning(
                 f"💥 Excepción en start={start}: {e}. "
                 f"Esperando {delay}s antes de reintentar... "
@@ -119,26 +437,31 @@ async def fetch_invoice_batch(session, start, batch_size=LIMIT):
             delay = min(delay * 2, 60)
     
     logger.error(f"⛔ Fallo definitivo en start={start} tras {MAX_RETRIES} intentos.")
-    return pd.DataFrame()
+    record_failure(MAX_RETRIES)
+    return None
 
 
-async def extract_invoices_concurrent(start_id, end_id, batch_size=LIMIT, concurrency=CONCURRENT_REQUESTS):
+async def fetch_invoice_batch(session, start, batch_size=LIMIT, limiter=None):
+    """Extrae una página de facturas como DataFrame (vacío si la página falla)."""
+    return pd.DataFrame(await fetch_invoice_page(session, start, batch_size, limiter) or [])
+
+
+async def extract_invoices_concurrent(start_id, end_id, batch_size=LIMIT, concurrency=CONCURRENT_REQUESTS,
+                                      session=None):
     """
     Extrae facturas de Alegra API en paralelo usando asyncio.
+    `concurrency` es el límite inicial del controlador adaptativo.
     """
-    nest_asyncio.apply()
-    semaphore = asyncio.Semaphore(concurrency)
+    limiter = AdaptiveConcurrencyLimiter(initial=concurrency)
     all_dfs = []
 
-    async with aiohttp.ClientSession() as session:
-        async def bounded_fetch(start):
-            async with semaphore:
-                return await fetch_invoice_batch(session, start, batch_size)
-
+    async with alegra_http.session_scope(session, HEADERS) as session:
         starts = list(range(start_id, end_id + 1, batch_size))
-        tasks = [bounded_fetch(start) for start in starts]
+        tasks = [fetch_invoice_batch(session, start, batch_size, limiter) for start in starts]
         results = await asyncio.gather(*tasks)
 
+    logger.info(f"🚀 Throughput de descarga: {limiter.summary()}")
+
     # Concatenar todos los DataFrames no vacíos
     for df in results:
         if not df.empty:
@@ -151,6 +474,430 @@ async def extract_invoices_concurrent(start_id, end_id, batch_size=LIMIT, concur
         return pd.DataFrame()
 
 
+@dataclass(slots=True)
+class InvoiceLine:
+    """Item de una factura con solo los campos que van a la tabla facturas."""
+
+    item_id: int
+    nombre: str
+    precio: float
+    cantidad: int
+    total: float
+
+
+@dataclass(slots=True)
+class InvoiceRecord:
+    """Factura proyectada desde el JSON de la API: sin los campos que se descartan."""
+
+    id: int
+    fecha: str
+    hora: str
+    cliente: str
+    totalfact: float
+    metodo: str
+    vendedor: str
+    lines: tuple
+
+
+def text_or_default(value, default):
+    """
+    Texto de un campo de la API que puede venir como str o como {'name': str}; cualquier
+    otro valor (None, vacío, dict sin 'name', números) se reemplaza por `default`.
+    """
+    if isinstance(value, dict):
+        value = value.get('name')
+    return value if isinstance(value, str) and value else default
+
+
+def project_invoice(invoice):
+    """
+    Proyectar una factura cruda de la API a un InvoiceRecord compacto, aplicando los
+    mismos valores por defecto y validaciones que `clean_invoice_data` +
+    `transform_to_line_items`. Retorna None si la factura no es válida.
+    """
+    if not isinstance(invoice, dict):
+        return None
+    items = invoice.get('items')
+    if not isinstance(items, list):
+        return None
+
+    try:
+        invoice_id = int(invoice['id'])
+
+        fecha = invoice.get('date')
+        total_paid = invoice.get('totalPaid')
+        record = InvoiceRecord(
+            id=invoice_id,
+            fecha=sys.intern(fecha) if isinstance(fecha, str) else fecha,
+            hora=invoice.get('datetime') or f"{fecha} 00:00:00",
+            cliente=text_or_default(invoice.get('client'), 'Sin especificar'),
+            totalfact=float(total_paid) if total_paid is not None else 0.0,
+            # Valores con pocas variantes: se comparten entre facturas
+            metodo=sys.intern(text_or_default(invoice.get('paymentMethod'), 'Sin especificar')),
+            vendedor=sys.intern(text_or_default(invoice.get('seller'), 'No se ha registrado un vendedor')),
+            lines=(),
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning(f"Error procesando factura con ID {invoice.get('id', 'desconocido')}: {e}")
+        return None
+
+    lines = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            lines.append(InvoiceLine(
+                int(item.get('id') or 0),
+                item.get('name') or 'Sin nombre',
+                float(item.get('price', 0)),
+                int(item.get('quantity', 0)),
+                float(item.get('total', 0)),
+            ))
+        except (TypeError, ValueError) as e:
+            # Igual que la ruta legacy: un item inválido descarta el resto de la factura
+            logger.warning(f"Error procesando factura con ID {invoice_id}: {e}")
+            break
+    record.lines = tuple(lines)
+    return record
+
+
+def project_invoices(invoices):
+    """Proyectar una página de facturas crudas; las inválidas se descartan."""
+    return [record for record in map(project_invoice, invoices) if record is not None]
+
+
+def compact_page(page):
+    """
+    Proyectar una página recién descargada para que los dicts completos de la API no
+    se retengan mientras la ventana espera su turno. La ruta legacy necesita los dicts.
+    """
+    if page is None or FLATTEN_ENGINE != "columnar":
+        return page
+    with RUN_METRICS.phase('clean'):
+        return project_invoices(page)
+
+
+def flatten_records(records):
+    """Aplanar InvoiceRecord a líneas de items (una fila por InvoiceLine)."""
+    columns = {name: [] for name in FACTURAS_COLUMNS}
+    ids = columns['id']
+    lineas = columns['linea']
+    item_ids = columns['item_id']
+    fechas = columns['fecha']
+    horas = columns['hora']
+    nombres = columns['nombre']
+    precios = columns['precio']
+    cantidades = columns['cantidad']
+    totales = columns['total']
+    clientes = columns['cliente']
+    totalfacts = columns['totalfact']
+    metodos = columns['metodo']
+    vendedores = columns['vendedor']
+
+    for record in records:
+        for linea, line in enumerate(record.lines):
+            ids.append(record.id)
+            lineas.append(linea)
+            item_ids.append(line.item_id)
+            fechas.append(record.fecha)
+            horas.append(record.hora)
+            nombres.append(line.nombre)
+            precios.append(line.precio)
+            cantidades.append(line.cantidad)
+            totales.append(line.total)
+            clientes.append(record.cliente)
+            totalfacts.append(record.totalfact)
+            metodos.append(record.metodo)
+            vendedores.append(record.vendedor)
+
+    if not ids:
+        return pd.DataFrame()
+    return pd.DataFrame(columns)
+
+
+def flatten_invoices(invoices):
+    """
+    Aplanar facturas a líneas de items en una sola pasada.
+
+    Equivalente a `clean_invoice_data` + `transform_to_line_items`, pero construye
+    directamente los arreglos por columna, sin crear un DataFrame intermedio con los
+    dicts anidados ni Series por fila. Acepta facturas crudas de la API (se proyectan
+    con `project_invoice`) o InvoiceRecord ya proyectados.
+    """
+    if invoices and not isinstance(invoices[0], InvoiceRecord):
+        invoices = project_invoices(invoices)
+    return flatten_records(invoices)
+
+
+def invoice_ids_without_items(invoices):
+    """
+    Ids de las facturas que llegaron con la lista de items vacía (crudas o InvoiceRecord).
+    No generan líneas, pero en modo upsert hay que borrar las líneas que tenían antes.
+    """
+    ids = []
+    for invoice in invoices:
+        if isinstance(invoice, InvoiceRecord):
+            if not invoice.lines:
+                ids.append(invoice.id)
+        elif isinstance(invoice, dict) and isinstance(invoice.get('items'), list) and not invoice['items']:
+            try:
+                ids.append(int(invoice['id']))
+            except (KeyError, TypeError, ValueError):
+                continue
+    return ids
+
+
+def shard_by_invoice_id(df, shards):
+    """
+    Partir las líneas en hasta `shards` grupos por rangos contiguos de id de factura, con
+    una cantidad parecida de facturas cada uno. Todas las líneas de una factura quedan en
+    el mismo shard. Retorna [(id_desde, id_hasta, df_shard)].
+    """
+    ids = sorted(df['id'].unique())
+    size = -(-len(ids) // max(1, shards))
+    result = []
+    for i in range(0, len(ids), size):
+        low, high = ids[i], ids[min(i + size, len(ids)) - 1]
+        result.append((low, high, df[df['id'].between(low, high)]))
+    return result
+
+
+async def extract_invoices_streaming(start_id, end_id, process_window, batch_size=LIMIT,
+                                     concurrency=CONCURRENT_REQUESTS,
+                                     window_pages=STREAM_WINDOW_PAGES,
+                                     queue_size=STREAM_QUEUE_SIZE,
+                                     prefetched=None, starts=None, checkpoint=None, failures=None,
+                                     session=None):
+    """
+    Extrae facturas por ventanas de páginas y entrega cada ventana a `process_window`
+    (lista de facturas crudas) a medida que llega, a través de una cola acotada.
+
+    Un productor descarga las páginas de cada ventana concurrentemente y la encola; el
+    consumidor procesa las ventanas en orden en un hilo aparte (limpieza, transformación
+    e inserción) mientras el productor sigue descargando. La cola acotada limita cuántas
+    ventanas hay en memoria a la vez.
+
+    Si `process_window` retorna False la extracción se detiene: las ventanas ya
+    confirmadas quedan en la BD y, como se confirman en orden, MAX(id) sigue siendo
+    un punto de reanudación válido.
+
+    `starts` permite pedir una lista explícita de páginas (p. ej. las pendientes de un
+    backfill) en lugar del rango completo. Tras confirmar cada ventana se llama a
+    `checkpoint(starts_confirmados, starts_fallidos, starts_incompletos)` para registrar su
+    estado; el detalle de las páginas fallidas queda en `failures` (ver fetch_invoice_page).
+    Solo las páginas completas (`batch_size` facturas) cuentan como confirmadas: una página
+    incompleta (p. ej. la última del rango) puede recibir facturas nuevas y debe volver a
+    pedirse al reanudar.
+
+    Retorna (ventanas_insertadas, facturas_extraidas, exito).
+    """
+    limiter = AdaptiveConcurrencyLimiter(initial=concurrency)
+    queue = asyncio.Queue(maxsize=queue_size)
+    if starts is None:
+        starts = list(range(start_id, end_id + 1, batch_size))
+    windows = [starts[i:i + window_pages] for i in range(0, len(starts), window_pages)]
+    producer_errors = []
+
+    async with alegra_http.session_scope(session, HEADERS) as session:
+        async def producer():
+            try:
+                for window in windows:
+                    fetch_started = time.perf_counter()
+                    pages = await asyncio.gather(
+                        *(fetch_invoice_page(session, start, batch_size, limiter, prefetched=prefetched,
+                                             failures=failures)
+                          for start in window)
+                    )
+                    RUN_METRICS.add_phase_time('fetch', time.perf_counter() - fetch_started)
+                    # El tamaño se toma antes de proyectar (la proyección descarta facturas inválidas)
+                    sizes = [len(page) if page is not None else None for page in pages]
+                    await queue.put((window, [compact_page(page) for page in pages], sizes))
+            except Exception as e:
+                logger.error(f"💥 Error descargando ventanas de facturas: {e}")
+                producer_errors.append(e)
+            await queue.put(None)
+
+        producer_task = asyncio.create_task(producer())
+        windows_inserted = 0
+        invoices_extracted = 0
+        success = True
+
+        try:
+            while True:
+                window = await queue.get()
+                if window is None:
+                    break
+
+                window_starts, pages, sizes = window
+                window_start = window_starts[0]
+                invoices = [invoice for page in pages if page for invoice in page]
+                fetched = [start for start, size in zip(window_starts, sizes) if size is not None and size >= batch_size]
+                partial = [start for start, size in zip(window_starts, sizes) if size is not None and size < batch_size]
+                failed = [start for start, size in zip(window_starts, sizes) if size is None]
+
+                if not invoices:
+                    logger.info(f"Ventana start={window_start} sin facturas")
+                else:
+                    invoices_extracted += len(invoices)
+                    logger.info(f"📥 Ventana start={window_start}: {len(invoices)} facturas recibidas")
+
+                    if not await asyncio.to_thread(process_window, invoices):
+                        logger.error(f"❌ Falló el procesamiento de la ventana start={window_start}. Deteniendo extracción.")
+                        success = False
+                        break
+                    windows_inserted += 1
+
+                if checkpoint:
+                    await asyncio.to_thread(checkpoint, fetched, failed, partial)
+        finally:
+            if not producer_task.done():
+                producer_task.cancel()
+            try:
+                await producer_task
+            except asyncio.CancelledError:
+                pass
+
+    if producer_errors:
+        success = False
+
+    logger.info(f"🚀 Throughput de descarga: {limiter.summary()}")
+
+    return windows_inserted, invoices_extracted, success
+
+
+async def extract_invoices_by_cursor(filters, process_window, batch_size=LIMIT,
+                                     concurrency=CONCURRENT_REQUESTS, prefetched=None, session=None):
+    """
+    Extrae todas las facturas que cumplen `filters` (p. ej. date_afterOrNow) paginando
+    desde start=0 hasta encontrar una página incompleta, sin consultar antes el total.
+
+    La primera ola pide una sola página (el caso nocturno típico cabe en ella); las
+    siguientes piden tantas páginas como permita el limitador adaptativo. Cada ola se
+    entrega completa a `process_window`. Si alguna página falla se aborta sin procesar esa ola,
+    para que el cursor no avance sobre un hueco.
+
+    Retorna (facturas_procesadas, exito).
+    """
+    limiter = AdaptiveConcurrencyLimiter(initial=concurrency)
+    processed = 0
+    offset = 0
+    wave_pages = 1
+
+    async with alegra_http.session_scope(session, HEADERS) as session:
+        while True:
+            starts = [offset + i * batch_size for i in range(wave_pages)]
+            fetch_started = time.perf_counter()
+            pages = await asyncio.gather(
+                *(fetch_invoice_page(session, start, batch_size, limiter, filters, prefetched)
+                  for start in starts)
+            )
+            RUN_METRICS.add_phase_time('fetch', time.perf_counter() - fetch_started)
+            if any(page is None for page in pages):
+                logger.error(f"❌ Páginas fallidas desde start={offset}; el cursor no avanzará")
+                return processed, False
+
+            invoices = [invoice for page in pages for invoice in compact_page(page)]
+            if invoices:
+                if not await asyncio.to_thread(process_window, invoices):
+                    return processed, False
+                processed += len(invoices)
+
+            if any(len(page) < batch_size for page in pages):
+                break
+            offset = starts[-1] + batch_size
+            wave_pages = limiter.limit
+
+    logger.info(f"🚀 Throughput de descarga: {limiter.summary()}")
+    return processed, True
+
+
+async def redrive_failed_pages(entries, process_window, concurrency=REDRIVE_CONCURRENCY, failures=None,
+                               session=None):
+    """
+    Reintentar páginas del dead-letter con una concurrencia baja y fija, procesando cada
+    página recuperada con `process_window`. Retorna las entradas recuperadas e insertadas,
+    con `complete` indicando si la página vino llena.
+    """
+    limiter = AdaptiveConcurrencyLimiter(initial=concurrency, max_limit=concurrency)
+    recovered = []
+
+    async with alegra_http.session_scope(session, HEADERS) as session:
+        pages = await asyncio.gather(
+            *(fetch_invoice_page(session, entry['start'], entry['batch_size'], limiter, entry['filters'],
+                                 failures=failures)
+              for entry in entries)
+        )
+
+    for entry, page in zip(entries, pages):
+        if page is None:
+            continue
+        complete = len(page) >= entry['batch_size']
+        page = compact_page(page)
+        if page and not await asyncio.to_thread(process_window, page):
+            logger.error(f"❌ Falló la inserción de la página re-enviada start={entry['start']}")
+            continue
+        recovered.append({**entry, 'complete': complete})
+
+    logger.info(f"🔁 Re-envío: {len(recovered)}/{len(entries)} páginas recuperadas ({limiter.summary()})")
+    return recovered
+
+
+async def fetch_latest_invoice_id(session, has_history):
+    """
+    ID de la factura más reciente de la API (None si no hay). Sin historia en la BD se
+    busca desde la fecha inicial predeterminada (2022-11-01).
+    """
+    current_date = datetime.datetime.now()
+    search_date = current_date - datetime.timedelta(days=1)
+
+    if not has_history:
+        current_date = datetime.datetime(2022, 11, 1)
+        search_date = current_date + datetime.timedelta(days=30)
+        logger.info("Usando fecha inicial predeterminada: 2022-11-01")
+
+    url = (
+        f"https://api.alegra.com/api/v1/invoices"
+        f"?date_beforeOrNow={search_date.strftime('%Y-%m-%d')}"
+        f"&order_direction=DESC&limit=1"
+    )
+    await get_alegra_rate_limiter().acquire()
+    async with session.get(url) as response:
+        if response.status == 429:
+            get_alegra_rate_limiter().penalize(parse_retry_after(response.headers.get('Retry-After')) or RETRY_DELAY_429)
+        response.raise_for_status()
+        data = alegra_json.loads(await response.read())
+
+    if data and len(data) > 0:
+        latest_id = int(data[0]['id'])
+        logger.info(f"Última factura en API: {latest_id}")
+        return latest_id
+    logger.warning("No se encontraron facturas recientes en la API")
+    return None
+
+
+async def prefetch_invoice_pages(page_requests, batch_size=LIMIT, concurrency=CONCURRENT_REQUESTS, session=None):
+    """
+    Descargar por adelantado páginas (start, filtros). Retorna {url: página} solo con las
+    páginas obtenidas; las que fallen se volverán a pedir en la extracción normal.
+    """
+    if not page_requests:
+        return {}
+
+    limiter = AdaptiveConcurrencyLimiter(initial=concurrency)
+    fetch_started = time.perf_counter()
+    async with alegra_http.session_scope(session, HEADERS) as session:
+        pages = await asyncio.gather(
+            *(fetch_invoice_page(session, start, batch_size, limiter, filters) for start, filters in page_requests)
+        )
+    RUN_METRICS.add_phase_time('fetch', time.perf_counter() - fetch_started)
+
+    return {
+        build_invoices_url(start, batch_size, filters): page
+        for (start, filters), page in zip(page_requests, pages)
+        if page is not None
+    }
+
+
 # -----------------------------
 # Clase principal del extractor
 # -----------------------------
@@ -162,8 +909,10 @@ class AlegraFacturasExtractor:
     def __init__(self):
         self.engine = None
         self.headers = HEADERS
+        self.page_failures = {}  # Páginas fallidas de la corrida, por URL (ver fetch_invoice_page)
         self.dtype_mapping = {
             'id': sa_types.INTEGER(),
+            'linea': sa_types.INTEGER(),
             'item_id': sa_types.INTEGER(),
             'fecha': sa_types.DATE(),
             'hora': sa_types.TIMESTAMP(),
@@ -192,7 +941,8 @@ class AlegraFacturasExtractor:
                 db_name = os.getenv('DB_NAME', 'railway')
                 connection_string = f"postgresql+psycopg2://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
 
-            self.engine = create_engine(connection_string)
+            # Engine compartido: pool con pre-ping, keepalives y statement_timeout
+            self.engine = db_engine.get_engine(connection_string)
 
             # Despertar la BD con reintentos (maneja BD dormida en Railway)
             if not self.wake_up_database():
@@ -216,45 +966,13 @@ class AlegraFacturasExtractor:
             logger.error("No hay engine de base de datos configurado")
             return False
 
-        delay = DB_WAKE_UP_INITIAL_DELAY
-        
-        for attempt in range(1, DB_WAKE_UP_RETRIES + 1):
-            try:
-                logger.info(f"🔄 Intentando despertar BD (intento {attempt}/{DB_WAKE_UP_RETRIES})...")
-                
-                with self.engine.connect() as conn:
-                    # Query simple para despertar la BD
-                    conn.execute(text("SELECT 1"))
-                    # Query adicional para asegurar que la BD está completamente lista
-                    conn.execute(text("SELECT current_timestamp"))
-                
-                logger.info("✅ Base de datos despierta y lista para recibir conexiones")
-                return True
-                
-            except Exception as e:
-                error_str = str(e).lower()
-                is_sleep_error = any(x in error_str for x in ['503', 'timeout', 'connection', 'unavailable', 'sleeping'])
-                
-                if attempt < DB_WAKE_UP_RETRIES:
-                    if is_sleep_error:
-                        logger.warning(
-                            f"⏳ BD posiblemente dormida (error: {type(e).__name__}). "
-                            f"Esperando {delay}s antes de reintentar..."
-                        )
-                    else:
-                        logger.warning(
-                            f"⚠️ Error conectando a BD: {e}. "
-                            f"Esperando {delay}s antes de reintentar..."
-                        )
-                    
-                    time.sleep(delay)
-                    # Backoff exponencial con límite máximo
-                    delay = min(delay * 2, DB_WAKE_UP_MAX_DELAY)
-                else:
-                    logger.error(f"❌ No se pudo despertar la BD después de {DB_WAKE_UP_RETRIES} intentos: {e}")
-                    return False
-        
-        return False
+        # Compuerta única: si otro hilo ya la está despertando, se espera su resultado
+        return db_engine.wake_up(
+            self.engine,
+            retries=DB_WAKE_UP_RETRIES,
+            initial_delay=DB_WAKE_UP_INITIAL_DELAY,
+            max_delay=DB_WAKE_UP_MAX_DELAY
+        )
 
     def create_table_if_not_exists(self):
         """Crear tabla facturas si no existe o verificar estructura."""
@@ -283,6 +1001,7 @@ class AlegraFacturasExtractor:
                     CREATE TABLE facturas (
                         indx SERIAL PRIMARY KEY,
                         id INTEGER NOT NULL,
+                        linea INTEGER NOT NULL,
                         item_id INTEGER NOT NULL,
                         fecha DATE NOT NULL,
                         hora TIMESTAMP NOT NULL,
@@ -300,6 +1019,7 @@ class AlegraFacturasExtractor:
                     CREATE INDEX IF NOT EXISTS idx_facturas_id ON facturas(id);
                     CREATE INDEX IF NOT EXISTS idx_facturas_fecha ON facturas(fecha);
                     CREATE INDEX IF NOT EXISTS idx_facturas_item_id ON facturas(item_id);
+                    CREATE UNIQUE INDEX IF NOT EXISTS uq_facturas_id_linea ON facturas(id, linea);
                     """
                     conn.execute(text(create_table_sql))
                     conn.commit()
@@ -324,22 +1044,253 @@ class AlegraFacturasExtractor:
                         conn.commit()
                         logger.info("Columna item_id agregada exitosamente")
 
+                    self._migrate_linea_column(conn)
+
                     # Verificar si existen los índices básicos
                     create_indexes_sql = """
                     CREATE INDEX IF NOT EXISTS idx_facturas_id ON facturas(id);
                     CREATE INDEX IF NOT EXISTS idx_facturas_fecha ON facturas(fecha);
                     CREATE INDEX IF NOT EXISTS idx_facturas_item_id ON facturas(item_id);
+                    CREATE UNIQUE INDEX IF NOT EXISTS uq_facturas_id_linea ON facturas(id, linea);
                     """
                     conn.execute(text(create_indexes_sql))
                     conn.commit()
                     logger.info("Tabla facturas existe - índices verificados")
 
+                # Estado de sincronización incremental (cursor por extractor)
+                conn.execute(text("""
+                    CREATE TABLE IF NOT EXISTS sync_state (
+                        extractor VARCHAR(50) PRIMARY KEY,
+                        last_id INTEGER,
+                        last_date DATE,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """))
+                # Checkpoints del backfill por offsets: una fila por página (start) confirmada o fallida
+                conn.execute(text("""
+                    CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+                        extractor VARCHAR(50) NOT NULL,
+                        start_offset INTEGER NOT NULL,
+                        batch_size INTEGER NOT NULL,
+                        status VARCHAR(10) NOT NULL,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (extractor, start_offset)
+                    )
+                """))
+                # Filas rechazadas por la BD (aisladas por bisección), para revisión manual
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS {QUARANTINE_TABLE} (
+                        qid SERIAL PRIMARY KEY,
+                        id TEXT,
+                        linea TEXT,
+                        record JSONB NOT NULL,
+                        error TEXT,
+                        quarantined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """))
+                # Dead-letter de páginas que no se pudieron descargar
+                conn.execute(text("""
+                    CREATE TABLE IF NOT EXISTS dead_letter_pages (
+                        extractor VARCHAR(50) NOT NULL,
+                        url TEXT NOT NULL,
+                        start_offset INTEGER NOT NULL,
+                        batch_size INTEGER NOT NULL,
+                        filters TEXT,
+                        status INTEGER,
+                        reason VARCHAR(20) NOT NULL,
+                        attempts INTEGER NOT NULL,
+                        last_error TEXT,
+                        first_failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (extractor, url)
+                    )
+                """))
+                conn.commit()
+
             return True
 
         except Exception as e:
             logger.error(f"Error creando/verificando tabla: {e}")
             return False
 
+    def _migrate_linea_column(self, conn):
+        """
+        Agregar la columna linea a una tabla existente y poblarla con la posición de cada
+        fila dentro de su factura (según indx), para poder crear la llave única (id, linea).
+        """
+        column_exists = conn.execute(text("""
+            SELECT EXISTS (
+                SELECT FROM information_schema.columns
+                WHERE table_schema = 'public'
+                AND table_name = 'facturas'
+                AND column_name = 'linea'
+            );
+        """)).scalar()
+        if column_exists:
+            return
+
+        logger.info("Agregando columna linea a tabla existente (llave natural id + linea)...")
+        removed = self._delete_repeated_invoice_copies(conn)
+        if removed:
+            logger.warning(f"🧹 Eliminadas {removed} filas de facturas insertadas más de una vez")
+        conn.execute(text("ALTER TABLE facturas ADD COLUMN linea INTEGER"))
+        conn.execute(text("""
+            UPDATE facturas f
+            SET linea = n.linea
+            FROM (
+                SELECT indx, ROW_NUMBER() OVER (PARTITION BY id ORDER BY indx) - 1 AS linea
+                FROM facturas
+            ) n
+            WHERE f.indx = n.indx
+        """))
+        conn.execute(text("ALTER TABLE facturas ALTER COLUMN linea SET NOT NULL"))
+        conn.commit()
+        logger.info("Columna linea agregada y poblada exitosamente")
+
+    def _delete_repeated_invoice_copies(self, conn):
+        """
+        Antes de numerar las líneas, borrar las copias de facturas insertadas varias veces
+        (modo append): si la secuencia de líneas de un id (por indx) es la misma secuencia
+        de `periodo` líneas repetida, se conserva solo la primera copia. Para no borrar
+        items legítimamente repetidos, una factura de una sola línea repetida solo se
+        depura si sus copias vienen de inserciones distintas (created_at distinto).
+        Retorna la cantidad de filas eliminadas.
+        """
+        result = conn.execute(text("""
+            WITH numbered AS (
+                SELECT indx, id, created_at,
+                       ROW_NUMBER() OVER w - 1 AS rn,
+                       COUNT(*) OVER (PARTITION BY id) AS n,
+                       md5(concat_ws('|', item_id, fecha, hora, nombre, precio, cantidad, total,
+                                     cliente, totalfact, metodo, vendedor)) AS firma,
+                       FIRST_VALUE(md5(concat_ws('|', item_id, fecha, hora, nombre, precio, cantidad, total,
+                                                 cliente, totalfact, metodo, vendedor))) OVER w AS primera
+                FROM facturas
+                WINDOW w AS (PARTITION BY id ORDER BY indx)
+            ),
+            periods AS (
+                SELECT id, MIN(rn) AS periodo, MAX(n) AS n
+                FROM numbered
+                WHERE rn > 0 AND firma = primera
+                GROUP BY id
+            ),
+            repeated AS (
+                SELECT p.id, p.periodo
+                FROM periods p
+                JOIN numbered x ON x.id = p.id
+                JOIN numbered y ON y.id = x.id AND y.rn = x.rn % p.periodo
+                WHERE p.n % p.periodo = 0
+                GROUP BY p.id, p.periodo
+                HAVING BOOL_AND(x.firma = y.firma)
+                   AND (p.periodo > 1 OR COUNT(DISTINCT x.created_at) > 1)
+            )
+            DELETE FROM facturas f
+            USING numbered x, repeated r
+            WHERE f.indx = x.indx AND x.id = r.id AND x.rn >= r.periodo
+        """))
+        return result.rowcount or 0
+
+    def get_sync_cursor(self):
+        """
+        Leer el cursor de sincronización (último id y última fecha de factura sincronizados)
+        desde la tabla sync_state. Retorna None si aún no hay cursor.
+        """
+        try:
+            with self.engine.connect() as conn:
+                row = conn.execute(
+                    text("SELECT last_id, last_date FROM sync_state WHERE extractor = :key"),
+                    {'key': SYNC_STATE_KEY}
+                ).fetchone()
+            if row and row.last_id and row.last_date:
+                logger.info(f"Cursor de sincronización: id={row.last_id}, fecha={row.last_date}")
+                return {'last_id': row.last_id, 'last_date': row.last_date}
+            return None
+
+        except Exception as e:
+            logger.error(f"Error leyendo cursor de sincronización: {e}")
+            return None
+
+    def save_sync_cursor(self, last_id, last_date):
+        """Guardar el cursor de sincronización (upsert en sync_state)."""
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text("""
+                        INSERT INTO sync_state (extractor, last_id, last_date, updated_at)
+                        VALUES (:key, :last_id, :last_date, CURRENT_TIMESTAMP)
+                        ON CONFLICT (extractor) DO UPDATE
+                        SET last_id = EXCLUDED.last_id,
+                            last_date = EXCLUDED.last_date,
+                            updated_at = EXCLUDED.updated_at
+                    """),
+                    {'key': SYNC_STATE_KEY, 'last_id': last_id, 'last_date': last_date}
+                )
+            logger.info(f"Cursor de sincronización guardado: id={last_id}, fecha={last_date}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error guardando cursor de sincronización: {e}")
+            return False
+
+    def save_sync_cursor_from_table(self):
+        """Inicializar/actualizar el cursor a partir de lo que ya está en facturas."""
+        try:
+            with self.engine.connect() as conn:
+                row = conn.execute(text("SELECT MAX(id) AS max_id, MAX(fecha) AS max_fecha FROM facturas")).fetchone()
+            if row and row.max_id and row.max_fecha:
+                return self.save_sync_cursor(row.max_id, row.max_fecha)
+            return True
+
+        except Exception as e:
+            logger.error(f"Error inicializando cursor de sincronización: {e}")
+            return False
+
+    async def run_cursor_sync(self, cursor, prefetched=None, session=None):
+        """
+        Sincronizar solo las facturas nuevas o modificadas desde el cursor: se piden las
+        facturas con fecha >= fecha del cursor (menos CURSOR_LOOKBACK_DAYS), se fusionan con
+        upsert y el cursor avanza al mayor id/fecha vistos solo si todo se confirmó.
+        """
+        filters = self._cursor_filters(cursor)
+        seen = {'last_id': cursor['last_id'], 'last_date': cursor['last_date']}
+
+        def process_window(invoices):
+            for invoice in invoices:
+                try:
+                    if isinstance(invoice, InvoiceRecord):
+                        invoice_id, invoice_date = invoice.id, invoice.fecha
+                    else:
+                        invoice_id, invoice_date = invoice['id'], invoice['date']
+                    seen['last_id'] = max(seen['last_id'], int(invoice_id))
+                    invoice_date = datetime.date.fromisoformat(invoice_date)
+                    seen['last_date'] = max(seen['last_date'], invoice_date)
+                except (KeyError, TypeError, ValueError):
+                    continue
+            return self._process_window(invoices)
+
+        logger.info(f"🔁 Sincronización por cursor: facturas con fecha >= {filters['date_afterOrNow']}")
+        try:
+            processed, success = await extract_invoices_by_cursor(
+                filters=filters,
+                process_window=process_window,
+                prefetched=prefetched,
+                session=session
+            )
+        except Exception as e:
+            logger.error(f"Error en sincronización por cursor: {e}")
+            return False
+
+        logger.info(f"Sincronización por cursor: {processed} facturas procesadas")
+        if not success:
+            return False
+        return await asyncio.to_thread(self.save_sync_cursor, seen['last_id'], seen['last_date'])
+
+    def _cursor_filters(self, cursor):
+        """Filtros de la API para pedir las facturas desde el cursor (con días de margen)."""
+        since = cursor['last_date'] - datetime.timedelta(days=CURSOR_LOOKBACK_DAYS)
+        return {'date_afterOrNow': since.isoformat()}
+
     def get_last_invoice_id(self):
         """Obtener el ID de la última factura procesada desde la BD."""
         if not self.engine:
@@ -364,11 +1315,257 @@ class AlegraFacturasExtractor:
         """Determinar el ID de factura desde donde iniciar la extracción."""
         last_id = self.get_last_invoice_id()
         if last_id:
-            return last_id + 1
+            return self._start_after(last_id)
         else:
             logger.info("No hay facturas previas en la BD, iniciando desde ID 1 (modo pruebas)")
             return 1
 
+    def _start_after(self, last_id):
+        """Primer start a extraer cuando la última factura cargada es `last_id`."""
+        if DB_WRITE_MODE == "upsert" and UPSERT_OVERLAP_INVOICES:
+            # El upsert hace seguro re-leer facturas ya cargadas (captura ediciones tardías)
+            return max(1, last_id + 1 - UPSERT_OVERLAP_INVOICES)
+        return last_id + 1
+
+    def get_backfill_checkpoints(self):
+        """
+        Leer los checkpoints del backfill en curso: {'committed': set, 'failed': set} de
+        offsets `start`. Solo cuentan los registrados con el tamaño de página actual.
+        """
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(
+                    text("""
+                        SELECT start_offset, status FROM backfill_checkpoints
+                        WHERE extractor = :key AND batch_size = :batch_size
+                    """),
+                    {'key': SYNC_STATE_KEY, 'batch_size': LIMIT}
+                ).fetchall()
+            state = {'committed': set(), 'failed': set()}
+            for row in rows:
+                state[row.status].add(row.start_offset)
+            return state
+
+        except Exception as e:
+            logger.error(f"Error leyendo checkpoints del backfill: {e}")
+            return {'committed': set(), 'failed': set()}
+
+    def save_page_checkpoints(self, committed, failed, partial=()):
+        """
+        Registrar páginas completas confirmadas en la BD y páginas que fallaron tras
+        MAX_RETRIES (estas últimas también van al dead-letter con el detalle del fallo).
+        Las páginas incompletas (`partial`) se insertaron pero no se marcan como
+        confirmadas: se borra su checkpoint para que una reanudación las vuelva a pedir,
+        porque pueden recibir facturas creadas después. `attempts` solo cuenta fallos.
+        """
+        if failed:
+            failed_starts = set(failed)
+            self.save_dead_letters([f for f in self.page_failures.values() if f['start'] in failed_starts])
+        rows = [{'start': start, 'status': 'committed', 'attempts': 0} for start in committed]
+        rows += [{'start': start, 'status': 'failed', 'attempts': 1} for start in failed]
+        inserted = list(committed) + list(partial)
+        if not rows and not inserted:
+            return True
+        try:
+            with self.engine.begin() as conn:
+                if rows:
+                    conn.execute(
+                        text("""
+                            INSERT INTO backfill_checkpoints (extractor, start_offset, batch_size, status, attempts, updated_at)
+                            VALUES (:key, :start, :batch_size, :status, :attempts, CURRENT_TIMESTAMP)
+                            ON CONFLICT (extractor, start_offset) DO UPDATE
+                            SET batch_size = EXCLUDED.batch_size,
+                                status = EXCLUDED.status,
+                                attempts = backfill_checkpoints.attempts + EXCLUDED.attempts,
+                                updated_at = EXCLUDED.updated_at
+                        """),
+                        [{'key': SYNC_STATE_KEY, 'batch_size': LIMIT, **row} for row in rows]
+                    )
+                if partial:
+                    conn.execute(
+                        text("""
+                            DELETE FROM backfill_checkpoints
+                            WHERE extractor = :key AND start_offset = ANY(:starts)
+                        """),
+                        {'key': SYNC_STATE_KEY, 'starts': list(partial)}
+                    )
+                if inserted:
+                    # Una página insertada ya no está perdida
+                    conn.execute(
+                        text("""
+                            DELETE FROM dead_letter_pages
+                            WHERE extractor = :key AND batch_size = :batch_size AND filters IS NULL
+                            AND start_offset = ANY(:starts)
+                        """),
+                        {'key': SYNC_STATE_KEY, 'batch_size': LIMIT, 'starts': inserted}
+                    )
+            if failed:
+                logger.warning(f"📌 {len(failed)} páginas fallidas registradas para reintento: {sorted(failed)}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error guardando checkpoints del backfill: {e}")
+            return False
+
+    def save_dead_letters(self, failures):
+        """Guardar (o actualizar, sumando intentos) páginas fallidas en dead_letter_pages."""
+        if not failures:
+            return True
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text("""
+                        INSERT INTO dead_letter_pages
+                            (extractor, url, start_offset, batch_size, filters, status, reason, attempts, last_error)
+                        VALUES (:key, :url, :start, :batch_size, :filters, :status, :reason, :attempts, :last_error)
+                        ON CONFLICT (extractor, url) DO UPDATE
+                        SET status = EXCLUDED.status,
+                            reason = EXCLUDED.reason,
+                            attempts = dead_letter_pages.attempts + EXCLUDED.attempts,
+                            last_error = EXCLUDED.last_error,
+                            updated_at = CURRENT_TIMESTAMP
+                    """),
+                    [
+                        {**f, 'key': SYNC_STATE_KEY, 'filters': json.dumps(f['filters']) if f['filters'] else None}
+                        for f in failures
+                    ]
+                )
+            return True
+
+        except Exception as e:
+            logger.error(f"Error guardando páginas en el dead-letter: {e}")
+            return False
+
+    def get_dead_letters(self):
+        """Páginas pendientes en el dead-letter de este extractor."""
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(
+                    text("""
+                        SELECT url, start_offset, batch_size, filters, status, reason, attempts, last_error
+                        FROM dead_letter_pages WHERE extractor = :key ORDER BY start_offset
+                    """),
+                    {'key': SYNC_STATE_KEY}
+                ).fetchall()
+            return [
+                {
+                    'url': row.url,
+                    'start': row.start_offset,
+                    'batch_size': row.batch_size,
+                    'filters': json.loads(row.filters) if row.filters else None,
+                    'status': row.status,
+                    'reason': row.reason,
+                    'attempts': row.attempts,
+                    'last_error': row.last_error,
+                }
+                for row in rows
+            ]
+
+        except Exception as e:
+            logger.error(f"Error leyendo el dead-letter: {e}")
+            return []
+
+    async def redrive_dead_letters(self, session=None):
+        """
+        Reintentar, con REDRIVE_CONCURRENCY, las páginas del dead-letter. Las recuperadas
+        se insertan, salen del dead-letter y quedan como confirmadas en los checkpoints;
+        las que vuelven a fallar suman intentos. Al final se resume lo perdido por motivo.
+        """
+        entries = await asyncio.to_thread(self.get_dead_letters)
+        if not entries:
+            return True
+
+        logger.info(f"🔁 Re-enviando {len(entries)} páginas del dead-letter (concurrencia {REDRIVE_CONCURRENCY})")
+        failures = {}
+        try:
+            recovered = await redrive_failed_pages(entries, self._process_window, failures=failures, session=session)
+        except Exception as e:
+            logger.error(f"Error en el re-envío del dead-letter: {e}")
+            recovered = []
+
+        return await asyncio.to_thread(self._finish_redrive, recovered, failures)
+
+    def _finish_redrive(self, recovered, failures):
+        """Sacar del dead-letter las páginas recuperadas y registrar las que volvieron a fallar."""
+        if recovered:
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(
+                        text("DELETE FROM dead_letter_pages WHERE extractor = :key AND url = :url"),
+                        [{'key': SYNC_STATE_KEY, 'url': entry['url']} for entry in recovered]
+                    )
+            except Exception as e:
+                logger.error(f"Error limpiando el dead-letter: {e}")
+            offsets = [entry for entry in recovered if entry['batch_size'] == LIMIT and not entry['filters']]
+            self.save_page_checkpoints(
+                [entry['start'] for entry in offsets if entry['complete']],
+                [],
+                [entry['start'] for entry in offsets if not entry['complete']],
+            )
+        self.save_dead_letters(list(failures.values()))
+        self.log_dead_letter_summary()
+        return True
+
+    def log_dead_letter_summary(self):
+        """Resumen de páginas perdidas por motivo."""
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(
+                    text("""
+                        SELECT reason, COUNT(*) AS pages, SUM(attempts) AS attempts
+                        FROM dead_letter_pages WHERE extractor = :key
+                        GROUP BY reason ORDER BY pages DESC
+                    """),
+                    {'key': SYNC_STATE_KEY}
+                ).fetchall()
+        except Exception as e:
+            logger.error(f"Error resumiendo el dead-letter: {e}")
+            return
+
+        if not rows:
+            logger.info("✅ Dead-letter vacío: no hay páginas perdidas")
+            return
+        for row in rows:
+            logger.warning(f"📭 Páginas perdidas por {row.reason}: {row.pages} ({row.attempts} intentos acumulados)")
+
+    def clear_backfill_checkpoints(self):
+        """Borrar los checkpoints cuando el backfill terminó sin páginas pendientes."""
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text("DELETE FROM backfill_checkpoints WHERE extractor = :key"),
+                    {'key': SYNC_STATE_KEY}
+                )
+            return True
+
+        except Exception as e:
+            logger.error(f"Error limpiando checkpoints del backfill: {e}")
+            return False
+
+    def plan_backfill_pages(self, start_id, end_id):
+        """
+        Páginas (offsets `start`) que faltan para completar el backfill hasta `end_id`.
+
+        Sin checkpoints es el rango desde `start_id`. Con un backfill interrumpido se
+        recorre desde el primer offset registrado, saltando las páginas ya confirmadas:
+        se reintentan las fallidas y las que nunca llegaron a confirmarse, aunque estén
+        por debajo de MAX(id).
+        """
+        state = self.get_backfill_checkpoints()
+        recorded = state['committed'] | state['failed']
+        first = min(recorded) if recorded else start_id
+        base = first if first <= start_id else start_id
+        starts = [start for start in range(base, end_id + 1, LIMIT) if start not in state['committed']]
+        # Fallidas fuera del rango (p. ej. end_id menor que en la corrida anterior)
+        starts += sorted(start for start in state['failed'] if start > end_id)
+
+        if recorded:
+            logger.info(
+                f"♻️ Reanudando backfill: {len(starts)} páginas pendientes "
+                f"({len(state['failed'])} fallidas, {len(state['committed'])} ya confirmadas)"
+            )
+        return starts
+
     def check_table_exists(self):
         """Verificar si la tabla facturas existe y tiene datos."""
         if not self.engine:
@@ -396,53 +1593,40 @@ class AlegraFacturasExtractor:
             logger.error(f"Error verificando tabla: {e}")
             return False
 
-    def get_latest_invoice_id(self):
-        """Obtener el ID de la factura más reciente de la API."""
-        try:
-            current_date = datetime.datetime.now()
-            search_date = current_date - datetime.timedelta(days=1)
-
-            if not self.engine or not self.check_table_exists():
-                current_date = datetime.datetime(2022, 11, 1)
-                search_date = current_date + datetime.timedelta(days=30)
-                logger.info("Usando fecha inicial predeterminada: 2022-11-01")
-
-            url = (
-                f"https://api.alegra.com/api/v1/invoices"
-                f"?date_beforeOrNow={search_date.strftime('%Y-%m-%d')}"
-                f"&order_direction=DESC&limit=1"
-            )
-            response = requests.get(url, headers=self.headers)
-            response.raise_for_status()
-            data = response.json()
-
-            if data and len(data) > 0:
-                latest_id = int(data[0]['id'])
-                logger.info(f"Última factura en API: {latest_id}")
-                return latest_id
-            else:
-                logger.warning("No se encontraron facturas recientes en la API")
-                return None
+    def get_latest_invoice_id(self, has_history=None):
+        """
+        Obtener el ID de la factura más reciente de la API.
+        `has_history` indica si la tabla ya tiene datos; si es None se consulta la BD.
+        """
+        if has_history is None:
+            has_history = bool(self.engine) and self.check_table_exists()
+        return asyncio.run(self.discover_latest_invoice_id(has_history))
 
+    async def discover_latest_invoice_id(self, has_history, session=None):
+        """Versión asíncrona de get_latest_invoice_id, reutilizando `session` si se pasa."""
+        started = time.perf_counter()
+        try:
+            async with alegra_http.session_scope(session, HEADERS) as session:
+                return await fetch_latest_invoice_id(session, has_history)
         except Exception as e:
             logger.error(f"Error obteniendo última factura de API: {e}")
             return None
+        finally:
+            RUN_METRICS.add_phase_time('discovery', time.perf_counter() - started)
 
-    def extract_invoices_batch(self, start_id, end_id, batch_size=LIMIT):
+    async def extract_invoices_batch(self, start_id, end_id, batch_size=LIMIT, session=None):
         """
         Extraer facturas concurrentemente desde la API de Alegra.
         Reemplaza la versión síncrona original.
         """
         try:
-            async def async_extract():
-                return await extract_invoices_concurrent(
-                    start_id=start_id,
-                    end_id=end_id,
-                    batch_size=batch_size,
-                    concurrency=CONCURRENT_REQUESTS
-                )
-
-            df = asyncio.run(async_extract())
+            df = await extract_invoices_concurrent(
+                start_id=start_id,
+                end_id=end_id,
+                batch_size=batch_size,
+                concurrency=CONCURRENT_REQUESTS,
+                session=session
+            )
             logger.info(f"Total de facturas extraídas concurrentemente: {len(df)}")
             return df
 
@@ -450,6 +1634,89 @@ class AlegraFacturasExtractor:
             logger.error(f"Error en extracción concurrente: {e}")
             return pd.DataFrame()
 
+    async def extract_and_load_streaming(self, start_id, end_id, batch_size=LIMIT, prefetched=None, starts=None,
+                                         session=None):
+        """
+        Extraer, limpiar, transformar e insertar facturas ventana por ventana.
+        Cada ventana se confirma en la BD apenas llega, por lo que la memoria se mantiene
+        acotada y una caída a mitad de la ejecución conserva lo ya insertado.
+        El estado de cada página queda en backfill_checkpoints para poder reanudar. El
+        checkpoint se escribe después de confirmar la ventana, y al reanudar se vuelven a
+        pedir las páginas incompletas: reanudar es seguro con DB_WRITE_MODE="upsert"; en
+        modo "append" esas páginas se insertan de nuevo (filas duplicadas).
+        """
+        try:
+            windows_inserted, invoices_extracted, success = await extract_invoices_streaming(
+                start_id=start_id,
+                end_id=end_id,
+                process_window=self._process_window,
+                batch_size=batch_size,
+                concurrency=CONCURRENT_REQUESTS,
+                prefetched=prefetched,
+                starts=starts,
+                checkpoint=self.save_page_checkpoints,
+                failures=self.page_failures,
+                session=session
+            )
+            logger.info(
+                f"Streaming finalizado: {invoices_extracted} facturas extraídas, "
+                f"{windows_inserted} ventanas insertadas"
+            )
+            return success
+
+        except Exception as e:
+            logger.error(f"Error en extracción streaming: {e}")
+            return False
+
+    def _process_window(self, invoices):
+        """Aplanar e insertar una ventana de facturas crudas."""
+        line_items_df = self.flatten_to_line_items(invoices)
+        if line_items_df is None:
+            return False
+        empty_ids = invoice_ids_without_items(invoices)
+        if line_items_df.empty:
+            logger.warning("La ventana no generó líneas de items")
+            return self._delete_stale_lines(line_items_df, empty_ids=empty_ids)
+
+        return self.load_line_items(line_items_df, empty_ids)
+
+    def load_line_items(self, line_items_df, empty_ids=()):
+        """
+        Insertar las líneas en la BD y, si todo se confirmó, agregarlas al respaldo incremental.
+        `empty_ids` son las facturas del lote que ahora no tienen items (ver _delete_stale_lines).
+        Al respaldo solo van las filas que quedaron en la BD (no las enviadas a cuarentena).
+        """
+        rejected = []
+        with RUN_METRICS.phase('insert'):
+            inserted = self.insert_to_database(line_items_df, empty_ids, rejected=rejected)
+        if not inserted:
+            return False
+        loaded_df = line_items_df
+        if rejected:
+            loaded_df = line_items_df.drop(index=pd.concat(rejected).index)
+        with RUN_METRICS.phase('export'):
+            self.backup_delta(loaded_df)
+        return True
+
+    def flatten_to_line_items(self, invoices):
+        """
+        Convertir facturas (crudas o InvoiceRecord) a líneas de items con el motor
+        configurado en FLATTEN_ENGINE. Retorna None si la ruta legacy no pudo limpiar los datos.
+        """
+        if FLATTEN_ENGINE == "columnar":
+            with RUN_METRICS.phase('transform'):
+                line_items_df = flatten_invoices(invoices)
+            logger.info(f"Generadas {len(line_items_df)} líneas de items")
+            return line_items_df
+
+        with RUN_METRICS.phase('clean'):
+            cleaned_df = self.clean_invoice_data(pd.DataFrame(invoices))
+        if cleaned_df.empty:
+            logger.error("Error procesando datos de facturas")
+            return None
+        with RUN_METRICS.phase('transform'):
+            return self.transform_to_line_items(cleaned_df)
+
     def clean_invoice_data(self, df):
         """Limpiar y procesar los datos de facturas."""
         if df.empty:
@@ -519,19 +1786,18 @@ class AlegraFacturasExtractor:
             try:
                 items_val = row['items']
                 if isinstance(items_val, list):
-                    for item in items_val:
+                    for linea, item in enumerate(items_val):
                         # Asegurar que metodo_val nunca sea None para la BD
-                        payment_method_from_api = row.get('paymentMethod')
-                        metodo_val = payment_method_from_api if payment_method_from_api and pd.notna(payment_method_from_api) else 'Sin especificar'
-                        
-                        cliente_val = row.get('client') or 'Sin especificar'
-                        vendedor_val = row.get('seller') or 'No se ha registrado un vendedor'
+                        metodo_val = text_or_default(row.get('paymentMethod'), 'Sin especificar')
+                        cliente_val = text_or_default(row.get('client'), 'Sin especificar')
+                        vendedor_val = text_or_default(row.get('seller'), 'No se ha registrado un vendedor')
                         nombre_val = item.get('name') or 'Sin nombre'
                         hora_val = row.get('datetime') or f"{row.get('date')} 00:00:00"
                         item_id_val = item.get('id') or 0
 
                         line_item = {
                             'id': int(row['id']),
+                            'linea': linea,
                             'item_id': int(item_id_val),
                             'fecha': row.get('date'),
                             'hora': hora_val,
@@ -553,36 +1819,52 @@ class AlegraFacturasExtractor:
         logger.info(f"Generadas {len(result_df)} líneas de items")
         return result_df
 
-    def insert_to_database(self, df):
+    def insert_to_database(self, df, empty_ids=(), rejected=None):
         """
         Insertar datos en la base de datos con garantía de inserción.
         
         Estrategia de inserción robusta:
         1. Intentar inserción en batch completo con reintentos
         2. Si falla, dividir en chunks más pequeños
-        3. Si un chunk falla, insertar registro por registro
-        4. Registrar qué registros fallaron definitivamente
+        3. Si un chunk falla, aislar las filas malas por bisección (ver _bisect_insert)
+        4. Enviar las filas rechazadas a la tabla de cuarentena
+
+        Si se pasa la lista `rejected`, se le agregan las filas (con su índice de `df`) que
+        quedaron en cuarentena en lugar de en la tabla.
         """
         if df.empty:
             logger.info("No hay datos para insertar")
-            return True
+            return self._delete_stale_lines(df, empty_ids=empty_ids)
 
         total_records = len(df)
         logger.info(f"📊 Iniciando inserción garantizada de {total_records} registros...")
 
-        # Intentar inserción en batch completo
-        if self._insert_batch_with_retry(df):
-            logger.info(f"✅ Todos los {total_records} registros insertados exitosamente en batch")
-            return True
+        # Tantos shards como workers, sin bajar de PARALLEL_LOAD_MIN_SHARD_ROWS filas por shard,
+        # para que también las ventanas del modo streaming se carguen en paralelo
+        workers = min(DB_LOAD_WORKERS, total_records // PARALLEL_LOAD_MIN_SHARD_ROWS)
+        if workers > 1:
+            # Carga paralela: un shard por rango de ids en su propia conexión y transacción
+            shards, failed_shards = self._parallel_load(df, workers=workers)
+            if not failed_shards:
+                logger.info(f"✅ Todos los {total_records} registros insertados en {len(shards)} shards paralelos")
+                return self._delete_stale_lines(df, empty_ids=empty_ids) and self._verify_shard_counts(shards)
+
+            pending_df = pd.concat([shard_df for _, _, shard_df in failed_shards])
+            logger.warning(f"⚠️ {len(failed_shards)} shards fallaron. Intentando inserción por chunks...")
+        else:
+            # Intentar inserción en batch completo
+            if self._insert_batch_with_retry(df):
+                logger.info(f"✅ Todos los {total_records} registros insertados exitosamente en batch")
+                return self._delete_stale_lines(df, empty_ids=empty_ids)
 
-        # Si el batch completo falla, dividir en chunks
-        logger.warning("⚠️ Inserción en batch falló. Intentando inserción por chunks...")
-        
-        inserted_count = 0
+            pending_df = df
+            logger.warning("⚠️ Inserción en batch falló. Intentando inserción por chunks...")
+
+        inserted_count = total_records - len(pending_df)
         failed_records = []
         
         # Dividir en chunks
-        chunks = [df[i:i + DB_INSERT_CHUNK_SIZE] for i in range(0, len(df), DB_INSERT_CHUNK_SIZE)]
+        chunks = [pending_df[i:i + DB_INSERT_CHUNK_SIZE] for i in range(0, len(pending_df), DB_INSERT_CHUNK_SIZE)]
         logger.info(f"📦 Dividiendo en {len(chunks)} chunks de máximo {DB_INSERT_CHUNK_SIZE} registros")
         
         for chunk_idx, chunk_df in enumerate(chunks):
@@ -595,54 +1877,57 @@ class AlegraFacturasExtractor:
                 inserted_count += len(chunk_df)
                 logger.info(f"✅ Chunk {chunk_idx + 1} insertado exitosamente ({len(chunk_df)} registros)")
             else:
-                # Si el chunk falla, insertar registro por registro
-                logger.warning(f"⚠️ Chunk {chunk_idx + 1} falló. Insertando registro por registro...")
-                chunk_inserted, chunk_failed = self._insert_individual_records(chunk_df)
+                # Si el chunk falla, aislar las filas malas por bisección
+                logger.warning(f"⚠️ Chunk {chunk_idx + 1} falló. Aislando filas con error por bisección...")
+                chunk_inserted, chunk_failed, chunk_pending = self._bisect_insert(chunk_df)
                 inserted_count += chunk_inserted
                 failed_records.extend(chunk_failed)
+                if chunk_pending is not None:
+                    # Caída de la BD: no son filas malas; el lote se reintenta en la próxima corrida
+                    pending_rows = len(chunk_pending) + sum(len(rest) for rest in chunks[chunk_idx + 1:])
+                    logger.error(
+                        f"❌ Inserción interrumpida por la BD: {inserted_count} insertados, "
+                        f"{pending_rows} pendientes para reintentar"
+                    )
+                    if failed_records and not self._quarantine_records(failed_records):
+                        self._save_failed_records(pd.concat([rows for rows, _ in failed_records]))
+                    return False
         
         # Resumen final
         logger.info("=" * 60)
         logger.info(f"📊 RESUMEN DE INSERCIÓN:")
         logger.info(f"   Total de registros: {total_records}")
         logger.info(f"   Insertados exitosamente: {inserted_count}")
-        logger.info(f"   Fallidos: {len(failed_records)}")
+        logger.info(f"   En cuarentena: {sum(len(rows) for rows, _ in failed_records)}")
         
         if failed_records:
-            logger.error(f"❌ IDs de registros que NO se pudieron insertar: {failed_records[:50]}{'...' if len(failed_records) > 50 else ''}")
-            # Guardar registros fallidos en un archivo para revisión manual
-            self._save_failed_records(df[df['id'].isin(failed_records)])
-            return False
+            failed_ids = sorted({i for rows, _ in failed_records for i in rows['id'].tolist()})
+            logger.error(f"❌ IDs de facturas con filas rechazadas: {failed_ids[:50]}{'...' if len(failed_ids) > 50 else ''}")
+            if not self._quarantine_records(failed_records):
+                # Último recurso: guardar en un archivo para revisión manual
+                self._save_failed_records(pd.concat([rows for rows, _ in failed_records]))
+                return False
+            if rejected is not None:
+                rejected.extend(rows for rows, _ in failed_records)
         
         logger.info("=" * 60)
-        return True
+        return self._delete_stale_lines(df, empty_ids=empty_ids)
 
-    def _insert_batch_with_retry(self, df, is_chunk=False):
+    def _insert_batch_with_retry(self, df, is_chunk=False, table="facturas", batch_type=None):
         """
         Intentar inserción de un batch/chunk con reintentos exponenciales.
         """
         delay = DB_INSERT_INITIAL_DELAY
-        batch_type = "chunk" if is_chunk else "batch completo"
+        batch_type = batch_type or ("chunk" if is_chunk else "batch completo")
         
         for attempt in range(1, DB_INSERT_RETRIES + 1):
             try:
-                # Verificar que la conexión esté activa antes de insertar
-                with self.engine.connect() as conn:
-                    conn.execute(text("SELECT 1"))
-                
-                # Realizar la inserción
-                df.to_sql(
-                    "facturas",
-                    self.engine,
-                    if_exists="append",
-                    index=False,
-                    dtype=self.dtype_mapping
-                )
+                # pool_pre_ping valida la conexión al tomarla del pool; no hace falta un SELECT 1 previo
+                self._write_frame(df, table)
                 return True
                 
             except Exception as e:
-                error_str = str(e).lower()
-                is_recoverable = any(x in error_str for x in ['503', 'timeout', 'connection', 'unavailable', 'sleeping', 'broken pipe'])
+                is_recoverable = db_engine.is_recoverable_error(e)
                 
                 if attempt < DB_INSERT_RETRIES and is_recoverable:
                     logger.warning(
@@ -652,12 +1937,8 @@ class AlegraFacturasExtractor:
                     time.sleep(delay)
                     delay = min(delay * 2, DB_WAKE_UP_MAX_DELAY)
                     
-                    # Intentar reconectar
-                    try:
-                        self.engine.dispose()
-                        self.wake_up_database()
-                    except Exception:
-                        pass
+                    # Esperar a que la BD despierte (el pre-ping descarta las conexiones muertas)
+                    self.wake_up_database()
                 else:
                     if not is_recoverable:
                         logger.error(f"❌ Error no recuperable en inserción de {batch_type}: {e}")
@@ -667,58 +1948,280 @@ class AlegraFacturasExtractor:
         
         return False
 
-    def _insert_individual_records(self, df):
+    def _check_connection(self):
+        """Verificar la conexión con SELECT 1 y, si falla, esperar a que la BD despierte."""
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            return True
+        except Exception as e:
+            logger.warning(f"⚠️ Conexión no disponible ({type(e).__name__}). Reconectando...")
+            return self.wake_up_database()
+
+    def _parallel_load(self, df, table="facturas", workers=None):
+        """
+        Cargar df en `workers` conexiones del pool a la vez, partido en shards por rango de
+        id de factura. Los shards no comparten facturas, así que sus upserts nunca chocan;
+        cada uno se confirma en su propia transacción.
+
+        Retorna (shards, shards_fallidos), cada shard como (id_desde, id_hasta, df).
+        """
+        workers = workers or DB_LOAD_WORKERS
+        shards = shard_by_invoice_id(df, workers)
+        logger.info(f"🧵 Carga paralela: {len(shards)} shards en {workers} conexiones")
+
+        def load(shard):
+            low, high, shard_df = shard
+            return self._insert_batch_with_retry(shard_df, table=table, batch_type=f"shard {low}-{high}")
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(load, shards))
+
+        return shards, [shard for shard, ok in zip(shards, results) if not ok]
+
+    def _verify_shard_counts(self, shards, table="facturas"):
+        """
+        Verificación final de la carga paralela: por cada rango de ids, las líneas en la
+        tabla deben coincidir con las líneas únicas (id, linea) del shard.
+        """
+        mismatches = []
+        try:
+            with self.engine.connect() as conn:
+                for low, high, shard_df in shards:
+                    ids = [int(i) for i in shard_df['id'].unique()]
+                    expected = len(shard_df.drop_duplicates(subset=['id', 'linea']))
+                    actual = conn.execute(
+                        text(f"SELECT COUNT(*) FROM {table} WHERE id BETWEEN :low AND :high AND id = ANY(:ids)"),
+                        {'low': int(low), 'high': int(high), 'ids': ids}
+                    ).scalar()
+                    if actual < expected or (DB_WRITE_MODE == "upsert" and actual != expected):
+                        mismatches.append((low, high, expected, actual))
+        except Exception as e:
+            logger.error(f"Error verificando conteos por rango de ids: {e}")
+            return False
+
+        for low, high, expected, actual in mismatches:
+            logger.error(f"❌ Rango de ids {low}-{high}: se esperaban {expected} líneas y hay {actual}")
+        if not mismatches:
+            logger.info(f"✅ Conteos verificados en {len(shards)} rangos de ids")
+        return not mismatches
+
+    def _write_frame(self, df, table="facturas"):
+        """
+        Escribir un DataFrame en la tabla según DB_WRITE_MODE y DB_INSERT_METHOD.
+        En modo upsert las filas pasan por una tabla de staging y se fusionan por (id, linea).
+        Cada escritura exitosa se registra en RUN_METRICS (latencia y filas).
+        """
+        started = time.perf_counter()
+        if DB_WRITE_MODE == "upsert":
+            self._upsert_frame(df, table)
+        elif DB_INSERT_METHOD == "copy":
+            self._copy_frame(df, table)
+        else:
+            df.to_sql(
+                table,
+                self.engine,
+                if_exists="append",
+                index=False,
+                dtype=self.dtype_mapping
+            )
+        RUN_METRICS.observe_insert(time.perf_counter() - started, len(df))
+
+    def _copy_frame(self, df, table="facturas"):
+        """
+        Cargar un DataFrame con COPY FROM STDIN a través de un buffer CSV en memoria.
+        Todo el DataFrame viaja en un solo round trip y se confirma en una sola transacción.
+        """
+        raw_conn = self.engine.raw_connection()
+        try:
+            with raw_conn.cursor() as cursor:
+                self._copy_with_cursor(cursor, df, table)
+            raw_conn.commit()
+        except Exception:
+            raw_conn.rollback()
+            raise
+        finally:
+            raw_conn.close()
+
+    def _copy_with_cursor(self, cursor, df, table):
+        """Enviar df a `table` con COPY FROM STDIN sobre un cursor psycopg2 ya abierto."""
+        buffer = io.StringIO()
+        self._prepare_copy_frame(df).to_csv(buffer, index=False, header=False, na_rep='\\N')
+        buffer.seek(0)
+
+        columns = ", ".join(f'"{col}"' for col in df.columns)
+        cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+
+    def _upsert_frame(self, df, table="facturas"):
+        """
+        Cargar df en una tabla temporal con COPY y fusionarla con la tabla destino mediante
+        INSERT ... ON CONFLICT (id, linea) DO UPDATE, todo en una sola transacción.
+        Re-insertar las mismas facturas actualiza las filas en lugar de duplicarlas.
+        """
+        staging = f"{table}_staging"
+        columns = ", ".join(f'"{col}"' for col in df.columns)
+        updates = ", ".join(
+            f'"{col}" = EXCLUDED."{col}"' for col in df.columns if col not in ('id', 'linea')
+        )
+
+        raw_conn = self.engine.raw_connection()
+        try:
+            with raw_conn.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                    f"SELECT {columns} FROM {table} WITH NO DATA"
+                )
+                # Ordinal de llegada de cada fila, que COPY llena en el orden del lote
+                cursor.execute(f"ALTER TABLE {staging} ADD COLUMN _orden BIGINT GENERATED ALWAYS AS IDENTITY")
+                self._copy_with_cursor(cursor, df, staging)
+                # DISTINCT ON evita que un mismo (id, linea) repetido en el lote aborte el merge;
+                # entre repetidos gana la última fila del lote
+                cursor.execute(
+                    f"INSERT INTO {table} ({columns}) "
+                    f"SELECT DISTINCT ON (id, linea) {columns} FROM {staging} "
+                    f"ORDER BY id, linea, _orden DESC "
+                    f"ON CONFLICT (id, linea) DO UPDATE SET {updates}"
+                )
+            raw_conn.commit()
+        except Exception:
+            raw_conn.rollback()
+            raise
+        finally:
+            raw_conn.close()
+
+    def _delete_stale_lines(self, df, table="facturas", empty_ids=()):
+        """
+        En modo upsert, eliminar líneas sobrantes de las facturas re-cargadas (linea mayor a
+        la última línea recibida), p. ej. si una factura editada ahora tiene menos items.
+        Las facturas de `empty_ids` (editadas hasta quedar sin items) pierden todas sus líneas.
+        Se ejecuta sobre el lote completo para no confundir facturas partidas entre chunks.
+        """
+        if DB_WRITE_MODE != "upsert" or (df.empty and not empty_ids):
+            return True
+
+        last_lines = df.groupby('id')['linea'].max() if not df.empty else pd.Series(dtype='int64')
+        # linea empieza en 0: un máximo de -1 borra todas las líneas de la factura
+        last_lines = pd.concat([last_lines, pd.Series(-1, index=list(empty_ids), dtype='int64')])
+        try:
+            with self.engine.begin() as conn:
+                result = conn.execute(
+                    text(f"""
+                        DELETE FROM {table} f
+                        USING unnest(CAST(:ids AS integer[]), CAST(:lineas AS integer[])) AS s(id, max_linea)
+                        WHERE f.id = s.id AND f.linea > s.max_linea
+                    """),
+                    {'ids': [int(i) for i in last_lines.index], 'lineas': [int(n) for n in last_lines.values]}
+                )
+            if result.rowcount:
+                logger.info(f"🧹 Eliminadas {result.rowcount} líneas sobrantes de facturas re-cargadas")
+            return True
+        except Exception as e:
+            logger.error(f"Error eliminando líneas sobrantes: {e}")
+            return False
+
+    def _prepare_copy_frame(self, df):
         """
-        Insertar registros uno por uno como último recurso.
-        Retorna (cantidad_insertados, lista_ids_fallidos).
+        Normalizar columnas según dtype_mapping para que el texto CSV sea aceptado por COPY
+        igual que los parámetros de to_sql (p. ej. enteros sin decimales '1.0').
+        """
+        copy_df = df.copy()
+        for col, sql_type in self.dtype_mapping.items():
+            if col not in copy_df.columns:
+                continue
+            if isinstance(sql_type, sa_types.INTEGER):
+                copy_df[col] = pd.to_numeric(copy_df[col]).astype('Int64')
+            elif isinstance(sql_type, sa_types.FLOAT):
+                copy_df[col] = pd.to_numeric(copy_df[col]).astype('float64')
+        return copy_df
+
+    def _bisect_insert(self, df):
+        """
+        Insertar un chunk fallido partiéndolo por la mitad recursivamente: las mitades sanas
+        entran en un solo insert y solo se siguen partiendo las que fallan, hasta aislar
+        las filas malas en O(k log n) inserts para k filas malas.
+
+        Se recorre por niveles; la conexión se verifica una vez por nivel, no por fila.
+        Una parte que falla por un error de conexión se reintenta sin partir (hasta
+        DB_BISECT_RETRIES veces) para no confundir una caída de la BD con datos malos, con
+        una sola espera por nivel. Si la BD no responde al inicio de un nivel, la bisección
+        se aborta y las partes del nivel quedan pendientes (no son filas malas).
+
+        Retorna (cantidad_insertados, [(filas_rechazadas, error)], filas_pendientes o None).
         """
         inserted = 0
-        failed_ids = []
-        
-        for idx, row in df.iterrows():
-            record_df = pd.DataFrame([row])
-            record_id = row.get('id', f'idx_{idx}')
-            
-            success = False
-            for attempt in range(1, DB_INSERT_INDIVIDUAL_RETRIES + 1):
+        rejected = []
+        level = [(df, 0)]
+        depth = 0
+
+        while level:
+            if not self._check_connection():
+                pending = pd.concat([part for part, _ in level])
+                logger.error(f"❌ BD no disponible; bisección abortada con {len(pending)} filas pendientes")
+                return inserted, rejected, pending
+            next_level = []
+            retry_level = False
+            for part, retries in level:
                 try:
-                    # Verificar conexión
-                    with self.engine.connect() as conn:
-                        conn.execute(text("SELECT 1"))
-                    
-                    # Insertar registro individual
-                    record_df.to_sql(
-                        "facturas",
-                        self.engine,
-                        if_exists="append",
-                        index=False,
-                        dtype=self.dtype_mapping
-                    )
-                    success = True
-                    break
-                    
+                    self._write_frame(part)
+                    inserted += len(part)
+                    continue
                 except Exception as e:
-                    if attempt < DB_INSERT_INDIVIDUAL_RETRIES:
-                        time.sleep(DB_INSERT_INITIAL_DELAY)
-                        try:
-                            self.engine.dispose()
-                            self.wake_up_database()
-                        except Exception:
-                            pass
-                    else:
-                        logger.error(f"❌ No se pudo insertar registro ID={record_id}: {e}")
-            
-            if success:
-                inserted += 1
-            else:
-                failed_ids.append(record_id)
-        
-        logger.info(f"   Inserción individual: {inserted} exitosos, {len(failed_ids)} fallidos")
-        return inserted, failed_ids
+                    error = e
+
+                if db_engine.is_recoverable_error(error) and retries < DB_BISECT_RETRIES:
+                    retry_level = True
+                    next_level.append((part, retries + 1))
+                elif len(part) == 1:
+                    logger.error(f"❌ Fila rechazada (factura {part['id'].iloc[0]}): {error}")
+                    rejected.append((part, str(error)))
+                else:
+                    middle = len(part) // 2
+                    next_level.extend([(part.iloc[:middle], 0), (part.iloc[middle:], 0)])
+            if retry_level:
+                time.sleep(DB_INSERT_INITIAL_DELAY)
+            level = next_level
+            depth += 1
+
+        logger.info(
+            f"   Bisección: {inserted} insertados, {len(rejected)} filas rechazadas "
+            f"({depth} niveles)"
+        )
+        return inserted, rejected, None
+
+    def _quarantine_records(self, rejected):
+        """
+        Guardar las filas rechazadas en QUARANTINE_TABLE (fila como JSON + error) para
+        revisión manual. Retorna False si no se pudieron guardar.
+        """
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text(f"""
+                        INSERT INTO {QUARANTINE_TABLE} (id, linea, record, error)
+                        VALUES (:id, :linea, CAST(:record AS JSONB), :error)
+                    """),
+                    [
+                        {
+                            'id': str(record.get('id')),
+                            'linea': str(record.get('linea')),
+                            'record': json.dumps(record, default=str),
+                            'error': error,
+                        }
+                        for rows, error in rejected
+                        for record in json.loads(rows.to_json(orient='records', date_format='iso'))
+                    ]
+                )
+            logger.warning(f"🚧 {sum(len(rows) for rows, _ in rejected)} filas enviadas a {QUARANTINE_TABLE}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error guardando filas en cuarentena: {e}")
+            return False
 
     def _save_failed_records(self, failed_df):
         """
-        Guardar registros fallidos en un archivo CSV para revisión manual.
+        Guardar registros fallidos en un archivo CSV para revisión manual
+        (solo si no se pudo escribir la tabla de cuarentena).
         """
         if failed_df.empty:
             return
@@ -731,6 +2234,29 @@ class AlegraFacturasExtractor:
         except Exception as e:
             logger.error(f"Error guardando registros fallidos: {e}")
 
+    def backup_delta(self, line_items_df):
+        """Agregar al respaldo Parquet las líneas recién insertadas (solo con BACKUP_FORMAT='parquet')."""
+        if not EXPORT_TO_CSV or BACKUP_FORMAT != "parquet" or line_items_df.empty:
+            return
+        if not backup_facturas_parquet.PARQUET_AVAILABLE:
+            logger.warning("pyarrow no está instalado; se omite el respaldo Parquet")
+            return
+
+        try:
+            files = backup_facturas_parquet.append_partitioned(line_items_df, BACKUP_DIR)
+            logger.info(f"💾 Respaldo incremental: {len(line_items_df)} líneas en {files} archivos Parquet")
+        except Exception as e:
+            logger.error(f"Error escribiendo respaldo Parquet: {e}")
+
+    def export_backup(self):
+        """Respaldo al final de la corrida: volcado CSV completo solo si BACKUP_FORMAT='csv'."""
+        if not EXPORT_TO_CSV:
+            return
+        if BACKUP_FORMAT == "csv":
+            self.export_to_csv()
+        else:
+            logger.info(f"Respaldo incremental en {BACKUP_DIR} (compactar con: python backup_facturas_parquet.py compact)")
+
     def export_to_csv(self, filename="facturas_backup.csv"):
         """Exportar todos los datos de la BD a CSV."""
         if not self.engine:
@@ -748,54 +2274,230 @@ class AlegraFacturasExtractor:
             logger.error(f"Error exportando a CSV: {e}")
 
     def run_extraction(self):
-        """Ejecutar el proceso completo de extracción."""
+        """Ejecutar el proceso completo de extracción en un event loop propio."""
+        return asyncio.run(self.run_extraction_async())
+
+    async def run_extraction_async(self, connector=None):
+        """
+        Punto de entrada asíncrono: ejecuta la extracción completa en el loop actual con una
+        sola sesión HTTP (sobre `connector` si se comparte con otros extractores, ver
+        alegra_http) y exporta las métricas de la corrida.
+        """
+        RUN_METRICS.reset()
+        success = False
+        try:
+            async with alegra_http.create_session(HEADERS, connector) as session:
+                success = await self._run_extraction(session)
+            return success
+        finally:
+            self.write_run_metrics(success)
+
+    def write_run_metrics(self, success):
+        """Escribir el reporte JSON de la corrida (y el textfile de Prometheus si está configurado)."""
+        report = RUN_METRICS.report(success)
+        RUN_METRICS.write_json(METRICS_REPORT_FILE, report, METRICS_HISTORY_FILE)
+        if METRICS_PROMETHEUS_FILE:
+            RUN_METRICS.write_prometheus(METRICS_PROMETHEUS_FILE, report)
+
+        phases = ", ".join(
+            f"{name} {phase['seconds']:.1f}s" for name, phase in report['phases'].items() if phase['calls']
+        )
+        logger.info(f"📈 Métricas de la corrida ({report['duration_seconds']:.1f}s): {phases}")
+
+    async def _run_extraction(self, session):
         logger.info("=== Iniciando extracción de facturas Alegra ===")
 
-        if not self.connect_database():
-            logger.error("No se pudo conectar a la base de datos")
+        try:
+            startup = await self._startup(session)
+        except Exception as e:
+            logger.error(f"Error en el arranque: {e}")
             return False
-
-        if not self.create_table_if_not_exists():
-            logger.error("No se pudo crear/verificar la tabla")
+        if startup is None:
             return False
 
-        start_id = self.get_starting_invoice_id()
+        prefetched = startup['prefetched']
+        if startup['cursor']:
+            if not await self.run_cursor_sync(startup['cursor'], prefetched, session):
+                logger.error("Error en la sincronización por cursor; el cursor no avanzó")
+                return False
+        else:
+            if not await self._run_offset_extraction(startup['start_id'], startup['end_id'], prefetched, session):
+                return False
+            await asyncio.to_thread(self.save_sync_cursor_from_table)
+
+        if prefetched:
+            logger.info(f"Páginas adelantadas descartadas (no coincidieron con el punto de partida): {len(prefetched)}")
+        if _HTTP_CACHE is not None:
+            logger.info(f"💾 Caché HTTP: {_HTTP_CACHE.summary()}")
+
+        await asyncio.to_thread(self._finish_run)
+        logger.info("=== Extracción completada exitosamente ===")
+        return True
+
+    def _finish_run(self):
+        """Guardar la pista de arranque y exportar el respaldo."""
+        self._save_startup_hint()
+        with RUN_METRICS.phase('export'):
+            self.export_backup()
+
+    async def _startup(self, session=None):
+        """
+        Arranque con pasos independientes en paralelo:
+          - despertar/conectar la BD, verificar la tabla y leer el punto de partida (hilo aparte)
+          - consultar en la API la última factura (solo en modo offset)
+          - descargar las primeras páginas de forma optimista según el último cursor conocido
+            (STARTUP_HINT_FILE), mientras la BD todavía despierta
+
+        Retorna {'cursor', 'start_id', 'end_id', 'prefetched'} o None si la BD no está disponible.
+        Las páginas adelantadas solo se usan si su URL coincide con la que se pediría de todos modos.
+        """
+        hint = self._load_startup_hint()
+        use_cursor = SYNC_MODE == "cursor" and DB_WRITE_MODE == "upsert"
+        page_requests = []
+        probe_latest = False
+
+        if hint and use_cursor:
+            page_requests = [(0, self._cursor_filters(hint))]
+        elif hint:
+            first_start = self._start_after(hint['last_id'])
+            page_requests = [(first_start + i * LIMIT, None) for i in range(PREFETCH_PAGES)]
+            probe_latest = True
+
+        if page_requests:
+            logger.info(f"⚡ Adelantando {len(page_requests)} páginas mientras la BD despierta")
+
+        # Una sola sesión (conexiones TLS calientes) para el descubrimiento y las páginas adelantadas
+        async with alegra_http.session_scope(session, HEADERS) as session:
+            db_state, end_id, prefetched = await asyncio.gather(
+                asyncio.to_thread(self._prepare_database),
+                self.discover_latest_invoice_id(True, session) if probe_latest else asyncio.sleep(0),
+                prefetch_invoice_pages(page_requests, session=session)
+            )
+            if db_state is None:
+                return None
+
+            if not db_state['cursor'] and end_id is None:
+                # Sin pista local no se sabe si hay historia: la consulta va después de la BD
+                has_history = await asyncio.to_thread(self.check_table_exists)
+                end_id = await self.discover_latest_invoice_id(has_history, session)
+
+        return {
+            'cursor': db_state['cursor'],
+            'start_id': db_state['start_id'],
+            'end_id': end_id,
+            'prefetched': prefetched,
+        }
+
+    def _prepare_database(self):
+        """Conectar/despertar la BD, verificar la tabla y leer el cursor o el ID de inicio."""
+        with RUN_METRICS.phase('connect'):
+            if not self.connect_database():
+                logger.error("No se pudo conectar a la base de datos")
+                return None
+
+            if not self.create_table_if_not_exists():
+                logger.error("No se pudo crear/verificar la tabla")
+                return None
+
+        with RUN_METRICS.phase('discovery'):
+            cursor = None
+            if SYNC_MODE == "cursor":
+                if DB_WRITE_MODE == "upsert":
+                    cursor = self.get_sync_cursor()
+                else:
+                    logger.warning("La sincronización por cursor requiere DB_WRITE_MODE='upsert'; usando offsets")
+
+            start_id = None if cursor else self.get_starting_invoice_id()
+        return {'cursor': cursor, 'start_id': start_id}
+
+    def _load_startup_hint(self):
+        """Leer el último cursor conocido desde STARTUP_HINT_FILE (None si no existe o es inválido)."""
+        try:
+            with open(STARTUP_HINT_FILE) as f:
+                hint = json.load(f)
+            return {
+                'last_id': int(hint['last_id']),
+                'last_date': datetime.date.fromisoformat(hint['last_date']),
+            }
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Pista de arranque inválida ({STARTUP_HINT_FILE}): {e}")
+            return None
+
+    def _save_startup_hint(self):
+        """Guardar el cursor vigente en STARTUP_HINT_FILE para adelantar el próximo arranque."""
+        cursor = self.get_sync_cursor()
+        if not cursor:
+            return
+        try:
+            with open(STARTUP_HINT_FILE, 'w') as f:
+                json.dump({'last_id': cursor['last_id'], 'last_date': cursor['last_date'].isoformat()}, f)
+        except OSError as e:
+            logger.warning(f"No se pudo guardar la pista de arranque: {e}")
+
+    async def _run_offset_extraction(self, start_id=None, end_id=None, prefetched=None, session=None):
+        """Extraer desde MAX(id) + 1 hasta la última factura de la API (backfill / primera carga)."""
+        start_id = start_id or await asyncio.to_thread(self.get_starting_invoice_id)
         if not start_id:
             logger.error("No se pudo determinar el ID de inicio")
             return False
 
-        end_id = self.get_latest_invoice_id()
+        if not end_id:
+            has_history = await asyncio.to_thread(self.check_table_exists)
+            end_id = await self.discover_latest_invoice_id(has_history, session)
         if not end_id:
             logger.error("No se pudo determinar el ID final")
             return False
 
+        if STREAMING_MODE:
+            starts = await asyncio.to_thread(self.plan_backfill_pages, start_id, end_id)
+            if not starts:
+                logger.info("No hay nuevas facturas para procesar")
+                return True
+            if not await self.extract_and_load_streaming(start_id, end_id, prefetched=prefetched, starts=starts,
+                                                         session=session):
+                logger.error("Error en la extracción streaming; las ventanas previas quedaron insertadas")
+                return False
+            if REDRIVE_FAILED_PAGES:
+                await self.redrive_dead_letters(session)
+            pending = (await asyncio.to_thread(self.get_backfill_checkpoints))['failed']
+            if pending:
+                logger.warning(f"⚠️ Quedan {len(pending)} páginas fallidas; se reintentarán en la próxima ejecución")
+            else:
+                await asyncio.to_thread(self.clear_backfill_checkpoints)
+            return True
+
         if start_id > end_id:
             logger.info("No hay nuevas facturas para procesar")
-            self.export_to_csv()
             return True
 
-        raw_df = self.extract_invoices_batch(start_id, end_id)
+        raw_df = await self.extract_invoices_batch(start_id, end_id, session=session)
         if raw_df.empty:
             logger.info("No se extrajeron nuevas facturas")
-            self.export_to_csv()
             return True
 
+        return await asyncio.to_thread(self._load_raw_frame, raw_df)
+
+    def _load_raw_frame(self, raw_df):
+        """Limpiar, transformar e insertar un DataFrame de facturas crudas (modo no streaming)."""
         cleaned_df = self.clean_invoice_data(raw_df)
         if cleaned_df.empty:
             logger.error("Error procesando datos de facturas")
             return False
 
         line_items_df = self.transform_to_line_items(cleaned_df)
+        empty_ids = invoice_ids_without_items(raw_df[['id', 'items']].to_dict('records')) if 'items' in raw_df else []
         if line_items_df.empty:
+            if empty_ids:
+                return self._delete_stale_lines(line_items_df, empty_ids=empty_ids)
             logger.error("Error transformando a líneas de items")
             return False
 
-        if not self.insert_to_database(line_items_df):
+        if not self.load_line_items(line_items_df, empty_ids):
             logger.error("Error insertando datos en la base de datos")
             return False
 
-        self.export_to_csv()
-        logger.info("=== Extracción completada exitosamente ===")
         return True
 
 
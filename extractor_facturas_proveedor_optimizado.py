@@ -22,7 +22,7 @@ Extractor optimizado de facturas de proveedores desde la API de Alegra
 
 Requisitos:
 ```bash
-pip install pandas requests sqlalchemy psycopg2-binary python-dotenv aiohttp nest_asyncio
+pip install pandas requests sqlalchemy psycopg2-binary python-dotenv aiohttp
 ```
 """
 from __future__ import annotations
@@ -32,20 +32,29 @@ import os
 import sys
 import time
 import asyncio
-import aiohttp
-import nest_asyncio
+import csv
+import hashlib
+import json
+import math
+from contextlib import nullcontext
 from dataclasses import dataclass
+from decimal import ROUND_HALF_UP, Decimal
 from datetime import datetime, date, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
 import requests
 from dotenv import load_dotenv
 
+import alegra_http
+import alegra_json
+from alegra_rate_limiter import get_alegra_rate_limiter
+
 # Importaciones opcionales para PostgreSQL
 try:
-    from sqlalchemy import create_engine, types as sa_types, text
+    from sqlalchemy import types as sa_types, text
+    from db_engine import get_engine, wake_up
     SQLALCHEMY_AVAILABLE = True
 except ImportError:
     SQLALCHEMY_AVAILABLE = False
@@ -76,14 +85,26 @@ class Config:
     network_error_delay: int = 5  # Segundos a esperar tras excepción de red
     max_retries_per_date: int = 5 # Máximo de reintentos por fecha
 
+    # Pagination settings
+    page_size: int = 30               # Facturas por página (máximo que permite Alegra)
+    use_metadata_total: bool = True   # Pedir el total del día para pedir sus páginas a la vez
+    range_query_days: int = 31        # Días por consulta con date_afterOrNow/date_beforeOrNow (0 = una consulta por día)
+    history_start: date = date(2023, 1, 2)  # Primer día con facturas reales (antes solo están los datos iniciales)
+
+    # Consistency settings
+    fingerprint_table: str = "facturas_proveedor_fingerprints"  # Huella por día tomada de la API al cargar
+    verify_days_per_run: int = 31     # Días pasados a re-verificar contra la API por corrida (0 = desactivado)
+
     # File settings
     csv_filename: str = "facturas_proveedor.csv"
     workspace_dir: str = "."
     require_csv: bool = True
+    csv_compaction_days: int = 7      # Cada cuántos días se re-exporta el CSV completo desde la BD
 
     # Database settings
     db_url_env: str = "DATABASE_URL"
     db_table_name: str = "facturas_proveedor"
+    db_ordered_view: str = "facturas_proveedor_ordenadas"  # Vista con `orden` consecutivo calculado al leer
 
     # Processing settings
     log_level: int = logging.INFO
@@ -95,61 +116,184 @@ CFG = Config()
 # Funciones asíncronas para extracción concurrente
 # ---------------------------------------------------------------------------
 
-async def fetch_bills_by_date_async(session, target_date: date) -> List[Dict[str, Any]]:
+def build_bills_url(filters: Dict[str, Any], start: int = 0, metadata: bool = False) -> str:
     """
-    Extrae facturas de una fecha específica de manera asíncrona con reintentos.
+    URL de una página de facturas que cumplen `filters` (p. ej. {'date': d} o
+    {'date_afterOrNow': a, 'date_beforeOrNow': b}); con `metadata` la API incluye el total.
+    Se ordena por id: las páginas se piden por offset y en paralelo, y ordenando por fecha
+    el orden entre facturas del mismo día no es estable entre páginas.
     """
-    url = f"{CFG.base_url}?limit=30&order_field=date&type=bill&date={target_date}"
+    query = "".join(f"&{key}={value}" for key, value in filters.items())
+    url = f"{CFG.base_url}?start={start}&limit={CFG.page_size}&order_direction=ASC&order_field=id&type=bill{query}"
+    return f"{url}&metadata=true" if metadata else url
+
+
+def split_bills_payload(payload: Any) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """Separar una respuesta en (facturas, total de la consulta); el total es None si no vino metadata."""
+    if isinstance(payload, dict):
+        total = (payload.get('metadata') or {}).get('total')
+        return payload.get('data') or [], int(total) if total is not None else None
+    return payload if isinstance(payload, list) else [], None
+
+
+def dedup_bills_by_id(bills: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Quitar facturas repetidas entre páginas (se conserva la primera aparición de cada id)."""
+    seen = set()
+    unique = []
+    for bill in bills:
+        bill_id = bill.get('id') if isinstance(bill, dict) else None
+        if bill_id is not None:
+            if bill_id in seen:
+                continue
+            seen.add(bill_id)
+        unique.append(bill)
+    if len(unique) < len(bills):
+        logging.warning(f"⚠️ {len(bills) - len(unique)} facturas repetidas entre páginas descartadas")
+    return unique
 
+
+async def fetch_bills_page_async(session, url: str, label: Any) -> Any:
+    """
+    Descarga una página de facturas con reintentos. Retorna la respuesta decodificada,
+    o None si la página falló definitivamente.
+    """
     for attempt in range(1, CFG.max_retries_per_date + 1):
         try:
-            async with session.get(url, headers={
-                "accept": "application/json",
-                "authorization": f"Basic {get_api_key()}"
-            }, timeout=CFG.timeout_seconds) as response:
+            await get_alegra_rate_limiter().acquire()
+            async with session.get(url) as response:
 
                 status = response.status
                 if status == 200:
-                    data = await response.json()
-                    logging.info(f"✅ Fecha {target_date} extraída con {len(data) if data else 0} facturas.")
-                    return data if data else []
+                    return alegra_json.loads(await response.read())
                 elif status == 429:
                     logging.warning(
-                        f"⚠️ Error 429 en fecha {target_date}. "
+                        f"⚠️ Error 429 en fecha {label}. "
                         f"Esperando {CFG.retry_delay_429}s antes de reintentar... "
                         f"(Intento {attempt}/{CFG.max_retries_per_date})"
                     )
-                    await asyncio.sleep(CFG.retry_delay_429)
+                    # La pausa la aplica el limitador global antes del próximo intento
+                    get_alegra_rate_limiter().penalize(CFG.retry_delay_429)
                 else:
-                    logging.error(f"❌ Error {status} en fecha {target_date}. No se reintentará.")
-                    return []
+                    logging.error(f"❌ Error {status} en fecha {label}. No se reintentará.")
+                    return None
 
         except Exception as e:
             logging.error(
-                f"💥 Excepción en fecha {target_date}: {e}. "
+                f"💥 Excepción en fecha {label}: {e}. "
                 f"Esperando {CFG.network_error_delay}s antes de reintentar... "
                 f"(Intento {attempt}/{CFG.max_retries_per_date})"
             )
             await asyncio.sleep(CFG.network_error_delay)
 
-    logging.error(f"⛔ Fallo definitivo en fecha {target_date} tras {CFG.max_retries_per_date} intentos.")
-    return []
+    logging.error(f"⛔ Fallo definitivo en fecha {label} tras {CFG.max_retries_per_date} intentos.")
+    return None
 
 
-async def fetch_bills_concurrent(dates: List[date], concurrency: int = CFG.concurrent_requests) -> Dict[date, List[Dict[str, Any]]]:
+async def fetch_all_bill_pages_async(session, filters: Dict[str, Any], label: Any,
+                                    semaphore=None, failed: Optional[set] = None) -> List[Dict[str, Any]]:
+    """
+    Extrae todas las facturas que cumplen `filters`, paginando. La primera página trae
+    también el total (metadata=true) y las páginas restantes se piden todas a la vez; si la
+    API no informa el total, se sigue paginando hasta recibir una página incompleta.
+    `semaphore` limita las peticiones en vuelo (se comparte entre todas las consultas).
+    Si alguna página falla, `label` se agrega a `failed`.
+    """
+    semaphore = semaphore or nullcontext()
+
+    async def fetch_page(start, metadata=False):
+        async with semaphore:
+            return await fetch_bills_page_async(session, build_bills_url(filters, start, metadata), label)
+
+    first = await fetch_page(0, metadata=CFG.use_metadata_total)
+    if first is None:
+        if failed is not None:
+            failed.add(label)
+        return []
+    bills, total = split_bills_payload(first)
+    pages = 1
+    complete = True
+
+    if total is not None:
+        rest = await asyncio.gather(*(fetch_page(start) for start in range(CFG.page_size, total, CFG.page_size)))
+        for page in rest:
+            if page is None:
+                complete = False
+                continue
+            bills.extend(split_bills_payload(page)[0])
+        pages += len(rest)
+    else:
+        page_bills = bills
+        while len(page_bills) >= CFG.page_size:
+            page = await fetch_page(pages * CFG.page_size)
+            if page is None:
+                complete = False
+                break
+            page_bills = split_bills_payload(page)[0]
+            bills.extend(page_bills)
+            pages += 1
+
+    bills = dedup_bills_by_id(bills)
+    if not complete:
+        logging.error(f"⛔ Fecha {label} incompleta: falló al menos una de sus {pages} páginas.")
+        if failed is not None:
+            failed.add(label)
+    logging.info(f"✅ Fecha {label} extraída con {len(bills)} facturas ({pages} páginas).")
+    return bills
+
+
+async def fetch_bills_by_date_async(session, target_date: date, semaphore=None,
+                                    failed: Optional[set] = None) -> List[Dict[str, Any]]:
+    """Extrae todas las facturas de una fecha (ver fetch_all_bill_pages_async)."""
+    return await fetch_all_bill_pages_async(session, {'date': target_date}, target_date, semaphore, failed)
+
+
+async def fetch_bills_by_range_async(session, start_date: date, end_date: date, semaphore=None,
+                                     failed: Optional[set] = None) -> Dict[date, List[Dict[str, Any]]]:
+    """
+    Extrae con una sola consulta paginada las facturas entre `start_date` y `end_date`
+    (inclusive) y las reparte localmente por su fecha. Todas las fechas del rango quedan
+    en el resultado, con lista vacía si no tuvieron facturas; si alguna página falla,
+    todas las fechas del rango se agregan a `failed`.
+    """
+    label = f"{start_date}..{end_date}"
+    window_failed = set()
+    bills = await fetch_all_bill_pages_async(
+        session, {'date_afterOrNow': start_date, 'date_beforeOrNow': end_date}, label, semaphore, window_failed
+    )
+
+    by_date = {start_date + timedelta(days=offset): [] for offset in range((end_date - start_date).days + 1)}
+    if window_failed and failed is not None:
+        failed.update(by_date)
+    for bill in bills:
+        try:
+            bill_date = date.fromisoformat(str(bill.get('date'))[:10])
+        except (AttributeError, ValueError):
+            logging.warning(f"Factura {bill.get('id') if isinstance(bill, dict) else bill} sin fecha válida en {label}")
+            continue
+        if bill_date in by_date:
+            by_date[bill_date].append(bill)
+        else:
+            logging.warning(f"Factura {bill.get('id')} con fecha {bill_date} fuera de la ventana {label}")
+    return by_date
+
+
+async def fetch_bills_concurrent(dates: List[date], concurrency: int = CFG.concurrent_requests,
+                                 session=None, failed: Optional[set] = None) -> Dict[date, List[Dict[str, Any]]]:
     """
     Extrae facturas de múltiples fechas de manera concurrente usando asyncio.
+    Reutiliza `session` si se pasa; si no, abre una sesión de alegra_http. Las fechas con
+    páginas fallidas se agregan a `failed`.
     """
-    nest_asyncio.apply()
     semaphore = asyncio.Semaphore(concurrency)
     results = {}
 
     async def bounded_fetch(target_date):
-        async with semaphore:
-            bills = await fetch_bills_by_date_async(session, target_date)
-            return target_date, bills
+        # El semáforo se aplica por página, para que las páginas de un día ocupado se pidan en paralelo
+        bills = await fetch_bills_by_date_async(session, target_date, semaphore, failed)
+        return target_date, bills
 
-    async with aiohttp.ClientSession() as session:
+    headers = None if session else {"accept": "application/json", "authorization": f"Basic {get_api_key()}"}
+    async with alegra_http.session_scope(session, headers) as session:
         tasks = [bounded_fetch(target_date) for target_date in dates]
         completed_tasks = await asyncio.gather(*tasks)
 
@@ -160,6 +304,33 @@ async def fetch_bills_concurrent(dates: List[date], concurrency: int = CFG.concu
     return results
 
 
+async def fetch_bills_windows_concurrent(start_date: date, end_date: date, window_days: int,
+                                         concurrency: int = CFG.concurrent_requests, session=None,
+                                         failed: Optional[set] = None) -> Dict[date, List[Dict[str, Any]]]:
+    """
+    Extrae las facturas de `start_date` a `end_date` en ventanas de `window_days` días
+    (una consulta paginada por ventana, ver fetch_bills_by_range_async), de forma concurrente.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        window_end = min(window_start + timedelta(days=window_days - 1), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + timedelta(days=1)
+
+    headers = None if session else {"accept": "application/json", "authorization": f"Basic {get_api_key()}"}
+    async with alegra_http.session_scope(session, headers) as session:
+        partials = await asyncio.gather(
+            *(fetch_bills_by_range_async(session, first, last, semaphore, failed) for first, last in windows)
+        )
+
+    results = {}
+    for partial in partials:
+        results.update(partial)
+    return results
+
+
 def process_bills_data_async(bills_data: List[Dict[str, Any]], target_date: date) -> List[Dict[str, Any]]:
     """
     Procesa los datos de facturas para una fecha específica (versión síncrona para compatibilidad).
@@ -236,16 +407,19 @@ def safe_request(session: requests.Session, url: str, params: Optional[Dict[str,
     """Realiza una petición HTTP con reintentos y manejo de errores."""
     for attempt in range(1, CFG.max_retries + 1):
         try:
+            get_alegra_rate_limiter().acquire_sync()
             response = session.get(url, params=params, timeout=CFG.timeout_seconds)
+            if response.status_code == 429:
+                get_alegra_rate_limiter().penalize(CFG.retry_delay_429)
             response.raise_for_status()
             
             if not response.text.strip():
                 logging.warning("Respuesta vacía recibida")
                 return []
                 
-            return response.json()
+            return alegra_json.loads(response.content)
             
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, alegra_json.DecodeError) as e:
             if attempt == CFG.max_retries:
                 raise ExtractorError(f"Error en petición después de {CFG.max_retries} intentos: {e}")
             
@@ -298,59 +472,29 @@ def get_last_date_from_db(engine) -> Optional[date]:
         return None
 
 
-def ensure_sequential_ids(engine):
-    """Asegura que los registro_id sean secuenciales sin huecos."""
+def ensure_ordered_view(engine):
+    """
+    Crea (si no existen) la vista con el orden consecutivo de las líneas y el índice que la
+    sirve. `registro_id` es solo de inserción (nunca se renumera ni se reinicia la secuencia);
+    el número consecutivo por fecha se calcula al leer, como `orden` en la vista.
+    """
     if engine is None:
         return
 
     try:
         with engine.begin() as conn:
-            # Verificar si hay huecos en los IDs
-            gaps_query = text(f"""
-                SELECT COUNT(*) as gaps
-                FROM (
-                    SELECT registro_id, ROW_NUMBER() OVER (ORDER BY registro_id) as expected_id
-                    FROM {CFG.db_table_name}
-                ) t
-                WHERE registro_id != expected_id
-            """)
-
-            gaps = conn.execute(gaps_query).scalar()
-
-            if gaps > 0:
-                logging.info(f"Detectados {gaps} huecos en registro_id. Reasignando IDs secuenciales...")
-
-                # Crear tabla temporal con IDs secuenciales
-                conn.execute(text(f"""
-                    CREATE TEMP TABLE temp_facturas_proveedor AS
-                    SELECT ROW_NUMBER() OVER (ORDER BY fecha, registro_id) as new_id,
-                           id, fecha, nombre, precio, cantidad, total, total_fact, proveedor
-                    FROM {CFG.db_table_name}
-                    ORDER BY fecha, registro_id
-                """))
-
-                # Limpiar tabla original
-                conn.execute(text(f"TRUNCATE TABLE {CFG.db_table_name}"))
-
-                # Insertar con IDs secuenciales
-                conn.execute(text(f"""
-                    INSERT INTO {CFG.db_table_name} (registro_id, id, fecha, nombre, precio, cantidad, total, total_fact, proveedor)
-                    SELECT new_id, id, fecha, nombre, precio, cantidad, total, total_fact, proveedor
-                    FROM temp_facturas_proveedor
-                """))
-
-                # Resetear secuencia
-                max_id_query = text(f"SELECT MAX(registro_id) FROM {CFG.db_table_name}")
-                max_id = conn.execute(max_id_query).scalar() or 0
-                sequence_name = f"{CFG.db_table_name}_registro_id_seq"
-                conn.execute(text(f"ALTER SEQUENCE {sequence_name} RESTART WITH {max_id + 1}"))
-
-                logging.info(f"IDs reasignados secuencialmente. Máximo ID: {max_id}")
-            else:
-                logging.debug("Los registro_id ya son secuenciales")
-
+            conn.execute(text(f"""
+                CREATE INDEX IF NOT EXISTS idx_{CFG.db_table_name}_fecha_registro
+                ON {CFG.db_table_name} (fecha, registro_id)
+            """))
+            conn.execute(text(f"""
+                CREATE OR REPLACE VIEW {CFG.db_ordered_view} AS
+                SELECT ROW_NUMBER() OVER (ORDER BY fecha, registro_id) AS orden,
+                       registro_id, id, fecha, nombre, precio, cantidad, total, total_fact, proveedor
+                FROM {CFG.db_table_name}
+            """))
     except Exception as e:
-        logging.error(f"Error asegurando IDs secuenciales: {e}")
+        logging.error(f"Error creando la vista ordenada {CFG.db_ordered_view}: {e}")
 
 
 def export_db_to_csv(engine):
@@ -360,9 +504,6 @@ def export_db_to_csv(engine):
         return
 
     try:
-        # Asegurar que los IDs sean secuenciales antes de exportar
-        ensure_sequential_ids(engine)
-
         with engine.connect() as conn:
             # Verificar si la tabla existe y tiene datos
             table_exists_query = text("""
@@ -379,6 +520,9 @@ def export_db_to_csv(engine):
                 logging.info("Tabla no existe, no hay datos para exportar.")
                 return
 
+        ensure_ordered_view(engine)
+
+        with engine.connect() as conn:
             # Contar registros
             count_query = text(f"SELECT COUNT(*) FROM {CFG.db_table_name}")
             count = conn.execute(count_query).scalar()
@@ -387,11 +531,11 @@ def export_db_to_csv(engine):
                 logging.info("Tabla existe pero no tiene registros.")
                 return
 
-            # Exportar datos ordenados por fecha e id
+            # Exportar datos ordenados por fecha e id; el CSV conserva registro_id consecutivo (orden de la vista)
             export_query = text(f"""
-                SELECT registro_id, id, fecha, nombre, precio, cantidad, total, total_fact, proveedor
-                FROM {CFG.db_table_name}
-                ORDER BY registro_id
+                SELECT orden AS registro_id, id, fecha, nombre, precio, cantidad, total, total_fact, proveedor
+                FROM {CFG.db_ordered_view}
+                ORDER BY orden
             """)
 
             df = pd.read_sql(export_query, conn)
@@ -399,6 +543,7 @@ def export_db_to_csv(engine):
             # Guardar a CSV
             csv_path = Path(CFG.workspace_dir) / CFG.csv_filename
             df.to_csv(csv_path, index=False)
+            save_csv_state(len(df), df['fecha'].max(), compacted=True)
             logging.info(f"Exportados {len(df)} registros desde BD a {CFG.csv_filename}")
 
     except Exception as e:
@@ -420,30 +565,166 @@ def create_initial_dataframe() -> pd.DataFrame:
     return pd.DataFrame(data)
 
 
+CSV_COLUMNS = ['registro_id', 'id', 'fecha', 'nombre', 'precio', 'cantidad', 'total', 'total_fact', 'proveedor']
+
+
+def _csv_state_path() -> Path:
+    return Path(CFG.workspace_dir) / f"{CFG.csv_filename}.state.json"
+
+
+def load_csv_state() -> Optional[Dict[str, Any]]:
+    """Estado del CSV (filas, última fecha, fecha de la última compactación), o None si no existe."""
+    try:
+        state = json.loads(_csv_state_path().read_text())
+        return {
+            'rows': int(state['rows']),
+            'last_fecha': date.fromisoformat(state['last_fecha']),
+            'compacted_on': date.fromisoformat(state['compacted_on']),
+        }
+    except FileNotFoundError:
+        return None
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        logging.warning(f"Estado del CSV inválido ({_csv_state_path()}): {e}")
+        return None
+
+
+def save_csv_state(rows: int, last_fecha: Any, compacted: bool = False):
+    """Registrar filas y última fecha del CSV; `compacted` marca una re-exportación completa."""
+    previous = load_csv_state()
+    compacted_on = date.today() if compacted or previous is None else previous['compacted_on']
+    last = pd.to_datetime(last_fecha).date() if last_fecha is not None else CFG.history_start
+    try:
+        _csv_state_path().write_text(json.dumps({
+            'rows': int(rows),
+            'last_fecha': last.isoformat(),
+            'compacted_on': compacted_on.isoformat(),
+        }))
+    except OSError as e:
+        logging.warning(f"No se pudo guardar el estado del CSV: {e}")
+
+
+def read_csv_header(csv_path: Path) -> Optional[List[str]]:
+    """Columnas del CSV leyendo solo su primera línea (None si no existe o está vacío)."""
+    try:
+        with open(csv_path, newline='', encoding='utf-8') as f:
+            first_line = f.readline()
+    except FileNotFoundError:
+        return None
+    if not first_line.strip():
+        return None
+    return next(csv.reader([first_line]))
+
+
+def append_rows_to_csv(df: pd.DataFrame, csv_path: Optional[Path] = None) -> int:
+    """
+    Agregar `df` al final del CSV sin leerlo: se lee solo el encabezado y las filas se
+    escriben en modo append en ese orden de columnas (las que falten quedan vacías, las
+    que sobren se descartan). Si el archivo no existe se crea con encabezado.
+    Retorna las filas escritas.
+    """
+    csv_path = csv_path or Path(CFG.workspace_dir) / CFG.csv_filename
+    header = read_csv_header(csv_path)
+    if header is None:
+        df.to_csv(csv_path, index=False)
+        return len(df)
+
+    extra = [column for column in df.columns if column not in header]
+    if extra:
+        logging.warning(f"Columnas ausentes en el encabezado de {csv_path.name}, no se escriben: {extra}")
+
+    # Si el archivo quedó sin salto de línea final, la primera fila nueva no debe pegarse a la última
+    with open(csv_path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        needs_newline = f.read(1) != b'\n'
+    with open(csv_path, 'a', newline='', encoding='utf-8') as f:
+        if needs_newline:
+            f.write('\n')
+        df.reindex(columns=header).to_csv(f, header=False, index=False)
+    return len(df)
+
+
 def save_to_csv(df: pd.DataFrame, append: bool = True):
-    """Guarda el DataFrame en CSV."""
+    """Guarda el DataFrame en CSV (en modo append sin releer el archivo existente)."""
     csv_path = Path(CFG.workspace_dir) / CFG.csv_filename
 
     try:
-        # Preparar DataFrame para CSV (sin registro_id ya que es generado por BD)
-        df_csv = df.copy()
-
-        if append and csv_path.exists():
-            # Leer CSV existente y concatenar
-            existing_df = pd.read_csv(csv_path)
-            combined_df = pd.concat([existing_df, df_csv], ignore_index=True)
-            combined_df.to_csv(csv_path, index=False)
-            logging.info(f"Agregadas {len(df_csv)} filas al CSV existente")
+        if append:
+            written = append_rows_to_csv(df, csv_path)
+            logging.info(f"Agregadas {written} filas al CSV")
         else:
             # Crear nuevo CSV
-            df_csv.to_csv(csv_path, index=False)
-            logging.info(f"Creado nuevo CSV con {len(df_csv)} filas")
+            df.to_csv(csv_path, index=False)
+            logging.info(f"Creado nuevo CSV con {len(df)} filas")
 
     except Exception as e:
         logging.error(f"Error guardando CSV: {e}")
         raise ExtractorError(f"No se pudo guardar en CSV: {e}")
 
 
+def sync_csv_with_db(engine, since: date, force_compaction: bool = False):
+    """
+    Mantener el CSV al día con la BD. Normalmente solo agrega al final las líneas con
+    fecha >= `since` (con `registro_id` consecutivo, igual que la exportación completa).
+    Compacta, re-exportando todo desde la BD, si:
+      - el CSV o su estado no existen
+      - `force_compaction` (se reemplazaron días pasados)
+      - `since` no es posterior a la última fecha del CSV (se recargó una fecha ya exportada)
+      - pasaron CFG.csv_compaction_days desde la última compactación
+      - las filas del CSV no cuadran con las de la BD anteriores a `since`
+    """
+    if engine is None:
+        logging.warning("No hay conexión a BD para exportar.")
+        return
+
+    csv_path = Path(CFG.workspace_dir) / CFG.csv_filename
+    state = load_csv_state()
+    if (
+        state is None
+        or not csv_path.exists()
+        or force_compaction
+        or since <= state['last_fecha']
+        or (date.today() - state['compacted_on']).days >= CFG.csv_compaction_days
+    ):
+        logging.info("Compactando CSV: re-exportación completa desde la BD")
+        export_db_to_csv(engine)
+        return
+
+    try:
+        with engine.connect() as conn:
+            offset = conn.execute(
+                text(f"SELECT COUNT(*) FROM {CFG.db_table_name} WHERE fecha < :since"), {'since': since}
+            ).scalar()
+        if offset != state['rows']:
+            logging.warning(
+                f"CSV desalineado con la BD ({state['rows']} filas vs {offset} antes de {since}); compactando"
+            )
+            export_db_to_csv(engine)
+            return
+
+        with engine.connect() as conn:
+            new_rows = pd.read_sql(
+                text(f"""
+                    SELECT registro_id, id, fecha, nombre, precio, cantidad, total, total_fact, proveedor
+                    FROM {CFG.db_table_name}
+                    WHERE fecha >= :since
+                    ORDER BY fecha, registro_id
+                """),
+                conn,
+                params={'since': since},
+            )
+
+        if new_rows.empty:
+            logging.info("CSV al día: no hay líneas nuevas que agregar")
+            return
+        new_rows['registro_id'] = range(offset + 1, offset + 1 + len(new_rows))
+        written = append_rows_to_csv(new_rows[CSV_COLUMNS], csv_path)
+        save_csv_state(offset + written, new_rows['fecha'].max())
+        logging.info(f"Agregadas {written} líneas a {CFG.csv_filename} (sin reescribir el archivo)")
+
+    except Exception as e:
+        logging.error(f"Error agregando líneas al CSV: {e}")
+
+
 # ---------------------------------------------------------------------------
 # Validación de fechas y datos
 # ---------------------------------------------------------------------------
@@ -458,8 +739,9 @@ def validate_and_get_start_date(session: requests.Session, engine) -> date:
         initial_df = create_initial_dataframe()
         save_to_database(initial_df, engine)
         # Exportar a CSV después de guardar en BD
-        export_db_to_csv(engine)
-        return date(2023, 1, 2)  # Empezar desde el día siguiente
+        if CFG.require_csv:
+            export_db_to_csv(engine)
+        return CFG.history_start  # Empezar desde el día siguiente
 
     # Obtener cantidad de facturas de ese día desde la BD
     try:
@@ -500,35 +782,25 @@ def validate_and_get_start_date(session: requests.Session, engine) -> date:
                 deleted_count = result.rowcount
                 logging.info(f"Eliminados {deleted_count} registros del {last_date} de la BD")
 
-                # Resetear la secuencia para mantener IDs secuenciales
-                # Obtener el máximo ID actual después de la eliminación
-                max_id_query = text(f"SELECT COALESCE(MAX(registro_id), 0) FROM {CFG.db_table_name}")
-                max_id = conn.execute(max_id_query).scalar()
-
-                # Resetear la secuencia para que el próximo ID sea max_id + 1
-                sequence_name = f"{CFG.db_table_name}_registro_id_seq"
-                reset_sequence_query = text(f"ALTER SEQUENCE {sequence_name} RESTART WITH {max_id + 1}")
-                conn.execute(reset_sequence_query)
-                logging.info(f"Secuencia {sequence_name} reseteada a {max_id + 1} para mantener IDs secuenciales")
-
         except Exception as e:
-            logging.error(f"Error eliminando registros o reseteando secuencia: {e}")
-
-        # Re-exportar CSV desde BD actualizada
-        export_db_to_csv(engine)
+            logging.error(f"Error eliminando registros: {e}")
 
+        # El CSV se compacta al final de la corrida (sync_csv_with_db), ya que la fecha vuelve a cargarse
         logging.info(f"Recomenzando desde: {last_date}")
         return last_date
 
 
 def fetch_bills_by_date(session: requests.Session, target_date: date) -> List[Dict[str, Any]]:
-    """Obtiene todas las facturas de una fecha específica desde la API."""
-    url = f"{CFG.base_url}?limit=30&order_field=date&type=bill&date={target_date}"
-    
+    """Obtiene todas las facturas de una fecha específica desde la API (paginando hasta una página incompleta)."""
     try:
-        data = safe_request(session, url)
-        
-        if not data or not isinstance(data, list):
+        data = []
+        page = None
+        while page is None or len(page) >= CFG.page_size:
+            page, _ = split_bills_payload(safe_request(session, build_bills_url({'date': target_date}, len(data))))
+            data.extend(page)
+        data = dedup_bills_by_id(data)
+
+        if not data:
             return []
         
         # Procesar facturas y extraer items
@@ -571,8 +843,18 @@ def fetch_bills_by_date(session: requests.Session, target_date: date) -> List[Di
 # Descarga y procesamiento de facturas
 # ---------------------------------------------------------------------------
 
-def fetch_bills_range(session: requests.Session, start_date: date, end_date: date) -> pd.DataFrame:
-    """Descarga facturas en un rango de fechas usando concurrencia."""
+async def fetch_bills_range(start_date: date, end_date: date, http_session=None,
+                            fingerprints: Optional[Dict[date, DayFingerprint]] = None,
+                            failed: Optional[set] = None) -> pd.DataFrame:
+    """
+    Descarga facturas en un rango de fechas usando concurrencia (reutiliza `http_session` si se pasa).
+    Si se pasa `fingerprints`, se llena con la huella de cada día descargado completo.
+
+    Los días de una ventana fallida se vuelven a pedir uno por uno. Si aun así alguno falla,
+    se descartan ese día y todos los posteriores (la próxima corrida empieza desde la fecha
+    máxima en la BD, así que no debe avanzar más allá de un día sin datos) y las fechas
+    fallidas se agregan a `failed`.
+    """
     # Generar lista de fechas a procesar
     dates_to_process = []
     current_date = start_date
@@ -584,23 +866,52 @@ def fetch_bills_range(session: requests.Session, start_date: date, end_date: dat
         logging.info("No hay fechas para procesar")
         return pd.DataFrame()
 
-    logging.info(f"Procesando {len(dates_to_process)} fechas concurrentemente con {CFG.concurrent_requests} hilos")
-
-    # Ejecutar extracción concurrente
-    async def async_fetch():
-        return await fetch_bills_concurrent(dates_to_process, CFG.concurrent_requests)
-
-    concurrent_results = asyncio.run(async_fetch())
+    # Ejecutar extracción concurrente: por ventanas de fechas o una consulta por día
+    failed_dates = set()
+    if CFG.range_query_days > 0:
+        logging.info(
+            f"Procesando {len(dates_to_process)} fechas en ventanas de {CFG.range_query_days} días "
+            f"con {CFG.concurrent_requests} peticiones simultáneas"
+        )
+        concurrent_results = await fetch_bills_windows_concurrent(
+            start_date, end_date, CFG.range_query_days, CFG.concurrent_requests, http_session, failed_dates
+        )
+    else:
+        logging.info(f"Procesando {len(dates_to_process)} fechas concurrentemente con {CFG.concurrent_requests} hilos")
+        concurrent_results = await fetch_bills_concurrent(
+            dates_to_process, CFG.concurrent_requests, http_session, failed_dates
+        )
+
+    if failed_dates and CFG.range_query_days > 0:
+        retry_dates = sorted(failed_dates)
+        logging.warning(f"🔁 Reintentando día por día {len(retry_dates)} fechas de ventanas fallidas")
+        failed_dates = set()
+        concurrent_results.update(
+            await fetch_bills_concurrent(retry_dates, CFG.concurrent_requests, http_session, failed_dates)
+        )
+
+    if failed_dates:
+        first_failed = min(failed_dates)
+        logging.error(
+            f"⛔ {len(failed_dates)} fechas sin descargar (la primera: {first_failed}); "
+            f"se descartan las fechas desde {first_failed} para reintentarlas en la próxima corrida"
+        )
+        concurrent_results = {d: bills for d, bills in concurrent_results.items() if d < first_failed}
+        if failed is not None:
+            failed.update(failed_dates)
 
     # Procesar resultados de cada fecha
     all_bills = []
     for target_date, bills_data in concurrent_results.items():
+        processed_bills = []
         if bills_data:
             processed_bills = process_bills_data_async(bills_data, target_date)
             all_bills.extend(processed_bills)
             logging.info(f"Fecha {target_date}: {len(processed_bills)} líneas procesadas")
         else:
             logging.info(f"Fecha {target_date}: No hay facturas")
+        if fingerprints is not None and target_date not in failed_dates:
+            fingerprints[target_date] = compute_fingerprint(bills_data, processed_bills)
 
     if not all_bills:
         logging.info("No se encontraron facturas en el rango especificado")
@@ -660,10 +971,11 @@ def get_database_engine():
         return None
     
     try:
-        engine = create_engine(db_url)
-        # Probar conexión
-        with engine.connect():
-            pass
+        engine = get_engine(db_url)
+        # Probar conexión (despierta la BD si está dormida)
+        if not wake_up(engine):
+            logging.error("No se pudo despertar PostgreSQL")
+            return None
         logging.info("Conexión a PostgreSQL establecida")
         return engine
     except Exception as e:
@@ -671,24 +983,28 @@ def get_database_engine():
         return None
 
 
-def save_to_database(df: pd.DataFrame, engine):
-    """Guarda el DataFrame en PostgreSQL con tipos de datos optimizados y manejo de reconexión."""
+# Mapeo de tipos de columna para optimización
+DB_DTYPES = {
+    'registro_id': sa_types.INTEGER(),
+    'id': sa_types.INTEGER(),
+    'fecha': sa_types.DATE(),
+    'nombre': sa_types.String(length=500),
+    'precio': sa_types.NUMERIC(precision=12, scale=2),
+    'cantidad': sa_types.NUMERIC(precision=10, scale=2),
+    'total': sa_types.NUMERIC(precision=12, scale=2),
+    'total_fact': sa_types.NUMERIC(precision=12, scale=2),
+    'proveedor': sa_types.String(length=300)
+} if SQLALCHEMY_AVAILABLE else {}
+
+
+def save_to_database(df: pd.DataFrame, engine, fingerprints: Optional[Dict[date, DayFingerprint]] = None):
+    """
+    Guarda el DataFrame en PostgreSQL con tipos de datos optimizados y manejo de reconexión.
+    Las huellas de `fingerprints` se guardan en la misma transacción que las líneas.
+    """
     if engine is None or df.empty:
         return
 
-    # Mapeo de tipos de columna para optimización
-    dtype_mapping = {
-        'registro_id': sa_types.INTEGER(),
-        'id': sa_types.INTEGER(),
-        'fecha': sa_types.DATE(),
-        'nombre': sa_types.String(length=500),
-        'precio': sa_types.NUMERIC(precision=12, scale=2),
-        'cantidad': sa_types.NUMERIC(precision=10, scale=2),
-        'total': sa_types.NUMERIC(precision=12, scale=2),
-        'total_fact': sa_types.NUMERIC(precision=12, scale=2),
-        'proveedor': sa_types.String(length=300)
-    }
-
     max_db_retries = 3
     for attempt in range(1, max_db_retries + 1):
         try:
@@ -734,8 +1050,10 @@ def save_to_database(df: pd.DataFrame, engine):
                     conn,
                     if_exists="append",
                     index=False,
-                    dtype=dtype_mapping
+                    dtype=DB_DTYPES
                 )
+                if fingerprints:
+                    _upsert_fingerprints(conn, fingerprints)
                 logging.info(f"Guardadas {len(df_db)} facturas en PostgreSQL")
                 return  # Éxito, salir de la función
 
@@ -748,77 +1066,290 @@ def save_to_database(df: pd.DataFrame, engine):
                 logging.info(f"Reintentando en {wait_time} segundos...")
                 time.sleep(wait_time)
 
-                # Intentar reconectar el engine
-                try:
-                    engine.dispose()  # Cerrar conexiones existentes
-                    db_url = os.getenv(CFG.db_url_env)
-                    if db_url:
-                        from sqlalchemy import create_engine
-                        engine = create_engine(db_url)
-                        logging.info("Engine reconectado exitosamente")
-                    else:
-                        logging.error("No se puede reconectar: DATABASE_URL no encontrada")
-                        break
-                except Exception as reconn_error:
-                    logging.error(f"Error reconectando engine: {reconn_error}")
+                # Esperar a que la BD despierte; el pre-ping del pool descarta las conexiones muertas
+                if wake_up(engine):
+                    logging.info("Conexión a PostgreSQL restablecida")
             else:
                 logging.error(f"Fallaron todos los {max_db_retries} intentos de guardar en PostgreSQL")
                 raise  # Re-lanzar la excepción después de todos los intentos
 
 
+# ---------------------------------------------------------------------------
+# Huellas por día y verificación de consistencia
+# ---------------------------------------------------------------------------
+
+@dataclass(slots=True)
+class DayFingerprint:
+    """Huella de un día: cantidad de líneas, suma de totales y hash de los ids de factura."""
+
+    lineas: int
+    suma_total: Decimal  # Centavos exactos, como la suma NUMERIC de la BD
+    hash_facturas: Optional[str] = None  # None si la huella se derivó de la BD (no guarda ids de factura)
+
+    def matches(self, other: DayFingerprint) -> bool:
+        if self.lineas != other.lineas or self.suma_total != other.suma_total:
+            return False
+        return self.hash_facturas is None or other.hash_facturas is None or self.hash_facturas == other.hash_facturas
+
+
+CENT = Decimal("0.01")
+
+
+def _to_amount(value: Any) -> Decimal:
+    """
+    Monto de una línea redondeado a centavos como lo guarda la columna DECIMAL(12,2): el
+    float se envía con su repr y PostgreSQL redondea la mitad alejándose de cero.
+    """
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        return Decimal("0.00")
+    if not math.isfinite(amount):
+        return Decimal("0.00")  # NaN -> 0, como clean_bills_data
+    return Decimal(repr(amount)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def compute_fingerprint(bills: List[Dict[str, Any]], lines: List[Dict[str, Any]]) -> DayFingerprint:
+    """Huella de un día a partir de sus facturas de la API y las líneas procesadas de ellas."""
+    bill_ids = sorted(str(bill.get('id')) for bill in bills if isinstance(bill, dict))
+    return DayFingerprint(
+        lineas=len(lines),
+        suma_total=sum((_to_amount(line.get('total')) for line in lines), Decimal("0.00")),
+        hash_facturas=hashlib.md5("\n".join(bill_ids).encode()).hexdigest(),
+    )
+
+
+def _ensure_fingerprint_table(conn):
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {CFG.fingerprint_table} (
+            fecha DATE PRIMARY KEY,
+            lineas INTEGER NOT NULL,
+            suma_total DECIMAL(14,2) NOT NULL,
+            hash_facturas VARCHAR(32),
+            verified_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+
+def _upsert_fingerprints(conn, fingerprints: Dict[date, DayFingerprint]):
+    _ensure_fingerprint_table(conn)
+    conn.execute(
+        text(f"""
+            INSERT INTO {CFG.fingerprint_table} (fecha, lineas, suma_total, hash_facturas, verified_at)
+            VALUES (:fecha, :lineas, :suma_total, :hash_facturas, CURRENT_TIMESTAMP)
+            ON CONFLICT (fecha) DO UPDATE SET
+                lineas = EXCLUDED.lineas,
+                suma_total = EXCLUDED.suma_total,
+                hash_facturas = EXCLUDED.hash_facturas,
+                verified_at = EXCLUDED.verified_at
+        """),
+        [
+            {'fecha': day, 'lineas': fp.lineas, 'suma_total': fp.suma_total, 'hash_facturas': fp.hash_facturas}
+            for day, fp in fingerprints.items()
+        ],
+    )
+
+
+def save_fingerprints(engine, fingerprints: Dict[date, DayFingerprint]):
+    """Guardar (o refrescar) la huella de los días cargados o verificados."""
+    if engine is None or not fingerprints:
+        return
+    try:
+        with engine.begin() as conn:
+            _upsert_fingerprints(conn, fingerprints)
+        logging.info(f"Huellas guardadas para {len(fingerprints)} días")
+    except Exception as e:
+        logging.error(f"Error guardando huellas por día: {e}")
+
+
+def select_days_to_verify(engine, before: date, limit: int) -> List[Tuple[date, DayFingerprint]]:
+    """
+    Días anteriores a `before` con la verificación más antigua (los nunca verificados
+    primero), con su huella esperada: la guardada, o la derivada de la BD si aún no tienen.
+    Los candidatos salen del calendario y de la tabla de huellas; la tabla de líneas solo
+    se agrega para los días elegidos que aún no tienen huella.
+    """
+    with engine.begin() as conn:
+        _ensure_fingerprint_table(conn)
+        candidates = conn.execute(
+            text(f"""
+                SELECT CAST(c.fecha AS DATE), f.lineas, f.suma_total, f.hash_facturas
+                FROM generate_series(CAST(:desde AS DATE), CAST(:hasta AS DATE) - 1, INTERVAL '1 day') AS c(fecha)
+                LEFT JOIN {CFG.fingerprint_table} f ON f.fecha = CAST(c.fecha AS DATE)
+                ORDER BY f.verified_at NULLS FIRST, 1 DESC
+                LIMIT :limit
+            """),
+            {'desde': CFG.history_start, 'hasta': before, 'limit': limit},
+        ).fetchall()
+
+        missing = [day for day, lineas, _, _ in candidates if lineas is None]
+        aggregates = {}
+        if missing:
+            aggregates = {
+                day: (lineas, suma)
+                for day, lineas, suma in conn.execute(
+                    text(f"""
+                        SELECT fecha, COUNT(*), SUM(total)
+                        FROM {CFG.db_table_name}
+                        WHERE fecha = ANY(:days)
+                        GROUP BY fecha
+                    """),
+                    {'days': missing},
+                )
+            }
+
+    days = []
+    for day, lineas, suma, hash_facturas in candidates:
+        if lineas is None:
+            db_lineas, db_suma = aggregates.get(day, (0, 0))
+            days.append((day, DayFingerprint(int(db_lineas), Decimal(db_suma or 0).quantize(CENT))))
+        else:
+            days.append((day, DayFingerprint(int(lineas), Decimal(suma).quantize(CENT), hash_facturas)))
+    return days
+
+
+def replace_days_in_database(df: pd.DataFrame, days: List[date], fingerprints: Dict[date, DayFingerprint], engine):
+    """Reemplazar, en una sola transacción, las líneas de `days` por las de `df` y guardar sus huellas."""
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM {CFG.db_table_name} WHERE fecha = ANY(:days)"), {'days': list(days)})
+        if not df.empty:
+            df_db = df.copy()
+            df_db['fecha'] = pd.to_datetime(df_db['fecha'], errors='coerce').dt.date
+            df_db.to_sql(CFG.db_table_name, conn, if_exists="append", index=False, dtype=DB_DTYPES)
+        _upsert_fingerprints(conn, fingerprints)
+
+
+async def verify_past_days(engine, http_session, before: date) -> int:
+    """
+    Verificador en segundo plano: re-descarga hasta CFG.verify_days_per_run días anteriores a
+    `before` (barrido por antigüedad de la última verificación) y compara su huella con la
+    esperada. Solo los días que difieren se reemplazan en la BD. Retorna los días reemplazados.
+    """
+    if engine is None or CFG.verify_days_per_run <= 0:
+        return 0
+
+    try:
+        candidates = await asyncio.to_thread(select_days_to_verify, engine, before, CFG.verify_days_per_run)
+        if not candidates:
+            return 0
+
+        failed = set()
+        results = await fetch_bills_concurrent(
+            [day for day, _ in candidates], CFG.concurrent_requests, http_session, failed
+        )
+
+        verified, diverged, lines = {}, {}, []
+        for day, expected in candidates:
+            if day in failed:
+                continue
+            bills = results.get(day, [])
+            day_lines = process_bills_data_async(bills, day) if bills else []
+            actual = compute_fingerprint(bills, day_lines)
+            if expected.matches(actual):
+                verified[day] = actual
+            else:
+                logging.warning(
+                    f"🔎 Fecha {day} difiere de la API: BD/huella={expected.lineas} líneas, "
+                    f"${expected.suma_total:,.2f} → API={actual.lineas} líneas, ${actual.suma_total:,.2f}"
+                )
+                diverged[day] = actual
+                lines.extend(day_lines)
+
+        if diverged:
+            await asyncio.to_thread(
+                replace_days_in_database, clean_bills_data(pd.DataFrame(lines)), list(diverged), diverged, engine
+            )
+        await asyncio.to_thread(save_fingerprints, engine, verified)
+        logging.info(
+            f"🔎 Verificación: {len(verified)} días consistentes, {len(diverged)} reemplazados, "
+            f"{len(failed)} sin verificar por errores de la API"
+        )
+        return len(diverged)
+
+    except Exception as e:
+        logging.error(f"Error en la verificación de días pasados: {e}")
+        return 0
+
+
 # ---------------------------------------------------------------------------
 # Función principal
 # ---------------------------------------------------------------------------
 
-def main():
-    """Función principal del extractor de facturas de proveedores."""
-    setup_logging(CFG.log_level)
+async def main_async(connector=None) -> bool:
+    """
+    Punto de entrada asíncrono: ejecuta el extractor en el event loop actual. Con un
+    `connector` de alegra_http compartido, la descarga usa el mismo pool de conexiones que
+    los demás extractores. Las partes bloqueantes (HTTP síncrono, BD, CSV) corren en hilos.
+    Retorna True si el proceso terminó bien.
+    """
     logging.info("Iniciando extractor de facturas de proveedores optimizado")
-    
+
     try:
         # Configurar sesión HTTP
         api_key = get_api_key()
         session = create_session(api_key)
-        
+
         # Configurar conexión a base de datos (opcional)
-        engine = get_database_engine()
-        
+        engine = await asyncio.to_thread(get_database_engine)
+
         # Validar datos existentes y determinar fecha de inicio
-        start_date = validate_and_get_start_date(session, engine)
+        start_date = await asyncio.to_thread(validate_and_get_start_date, session, engine)
         end_date = date.today()
 
         if start_date > end_date:
             logging.info("No hay fechas nuevas para procesar")
-            # Aún así exportar CSV desde BD existente
-            export_db_to_csv(engine)
-            return
+            # Aún así conciliar el CSV con la BD existente
+            if CFG.require_csv:
+                await asyncio.to_thread(sync_csv_with_db, engine, start_date)
+            return True
 
         logging.info(f"Procesando facturas desde {start_date} hasta {end_date}")
 
-        # Descargar y procesar facturas
-        df = fetch_bills_range(session, start_date, end_date)
+        # Descargar y procesar facturas; en paralelo se verifican días pasados contra sus huellas
+        headers = {"accept": "application/json", "authorization": f"Basic {api_key}"}
+        fingerprints = {}
+        failed_dates = set()
+        async with alegra_http.create_session(headers, connector) as http_session:
+            verifier = asyncio.create_task(verify_past_days(engine, http_session, start_date))
+            try:
+                df = await fetch_bills_range(start_date, end_date, http_session, fingerprints, failed_dates)
+            finally:
+                replaced_days = await verifier
 
         if df.empty:
             logging.info("No se encontraron facturas nuevas para procesar")
-            # Aún así exportar CSV desde BD existente
-            export_db_to_csv(engine)
-            return
+            await asyncio.to_thread(save_fingerprints, engine, fingerprints)
+            # Aún así conciliar el CSV con la BD existente
+            if CFG.require_csv:
+                await asyncio.to_thread(sync_csv_with_db, engine, start_date, replaced_days > 0)
+            return not failed_dates
 
         # Guardar PRIMERO en PostgreSQL (fuente de verdad)
         if engine:
-            save_to_database(df, engine)
+            await asyncio.to_thread(save_to_database, df, engine, fingerprints)
 
-        # Luego exportar CSV desde BD actualizada
+        # Luego agregar al CSV las líneas nuevas (o compactarlo si cambiaron días ya exportados)
         if CFG.require_csv:
-            export_db_to_csv(engine)
+            await asyncio.to_thread(sync_csv_with_db, engine, start_date, replaced_days > 0)
 
+        if failed_dates:
+            logging.error(f"Proceso incompleto: {len(failed_dates)} fechas quedaron pendientes para la próxima corrida.")
+            return False
         logging.info(f"Proceso completado exitosamente. Procesadas {len(df)} líneas de facturas.")
-        
+        return True
+
     except ExtractorError as e:
         logging.error(f"Error del extractor: {e}")
-        sys.exit(1)
+        return False
     except Exception as e:
         logging.error(f"Error inesperado: {e}")
+        return False
+
+
+def main():
+    """Función principal del extractor de facturas de proveedores."""
+    setup_logging(CFG.log_level)
+    if not asyncio.run(main_async()):
         sys.exit(1)
 
 
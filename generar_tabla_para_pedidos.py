@@ -37,7 +37,8 @@ from dotenv import load_dotenv
 
 # Importaciones para PostgreSQL
 try:
-    from sqlalchemy import create_engine, types as sa_types, text
+    from sqlalchemy import types as sa_types, text
+    from db_engine import get_engine, wake_up
     SQLALCHEMY_AVAILABLE = True
 except ImportError:
     SQLALCHEMY_AVAILABLE = False
@@ -82,10 +83,10 @@ def get_database_engine():
         raise PedidosError(f"Variable {DB_URL_ENV} no encontrada. Configura la URL de la base de datos.")
     
     try:
-        engine = create_engine(db_url)
-        # Probar conexión
-        with engine.connect() as conn:
-            conn.execute(text("SELECT 1"))
+        engine = get_engine(db_url)
+        # Probar conexión (despierta la BD si está dormida)
+        if not wake_up(engine):
+            raise RuntimeError("la base de datos no respondió")
         logging.info("Conexión a PostgreSQL establecida")
         return engine
     except Exception as e:
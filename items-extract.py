@@ -27,14 +27,18 @@ from datetime import datetime, date
 from pathlib import Path
 from typing import Any, Dict, List, Literal, Optional, Tuple
 
-import nest_asyncio
 import pandas as pd
 import requests
 from dotenv import load_dotenv
 
+import alegra_http
+import alegra_json
+from alegra_rate_limiter import get_alegra_rate_limiter
+
 # Dependencias opcionales para PostgreSQL
 try:
-    from sqlalchemy import create_engine, types as sa_types, text
+    from sqlalchemy import types as sa_types, text
+    from db_engine import get_engine, wake_up
     SQLALCHEMY_AVAILABLE = True
 except ImportError:
     SQLALCHEMY_AVAILABLE = False
@@ -122,9 +126,10 @@ async def fetch_item_page(
     url = f"{CFG.base_url}?start={start}&limit={limit}&order_field=id"
     for attempt in range(1, CFG.max_retries + 1):
         try:
-            async with session.get(url, timeout=CFG.timeout_seconds) as resp:
+            await get_alegra_rate_limiter().acquire()
+            async with session.get(url) as resp:
                 if resp.status == 200:
-                    data = await resp.json()
+                    data = alegra_json.loads(await resp.read())
                     logging.info(f"✅ start={start} → {len(data)} items")
                     return data
                 if resp.status == 429:
@@ -132,7 +137,8 @@ async def fetch_item_page(
                         f"⚠️ 429 en start={start}. "
                         f"Esperando {CFG.retry_delay_429}s (intento {attempt}/{CFG.max_retries})"
                     )
-                    await asyncio.sleep(CFG.retry_delay_429)
+                    # La pausa la aplica el limitador global antes del próximo intento
+                    get_alegra_rate_limiter().penalize(CFG.retry_delay_429)
                 else:
                     logging.error(f"❌ Error {resp.status} en start={start}.")
                     return []
@@ -146,16 +152,16 @@ async def fetch_item_page(
     return []
 
 
-async def fetch_all_items_concurrent(total_items: int, api_key: str) -> List[Dict[str, Any]]:
-    """Descarga todos los items en paralelo respetando CFG.concurrent_requests."""
-    nest_asyncio.apply()
+async def fetch_all_items_concurrent(total_items: int, api_key: str, connector=None) -> List[Dict[str, Any]]:
+    """
+    Descarga todos los items en paralelo respetando CFG.concurrent_requests.
+    Con `connector` (alegra_http) comparte el pool de conexiones con otros extractores.
+    """
     sem = asyncio.Semaphore(CFG.concurrent_requests)
     all_pages: List[List[Dict[str, Any]]] = []
 
-    import aiohttp
-
-    async with aiohttp.ClientSession(
-        headers={"accept": "application/json", "authorization": f"Basic {api_key}"}
+    async with alegra_http.create_session(
+        {"accept": "application/json", "authorization": f"Basic {api_key}"}, connector
     ) as session:
 
         async def bounded_fetch(offset):
@@ -239,9 +245,9 @@ def get_database_engine():
     if not db_url:
         raise ExtractorError(f"Variable {CFG.db_url_env} no configurada.")
     try:
-        engine = create_engine(db_url)
-        with engine.connect():
-            pass
+        engine = get_engine(db_url)
+        if not wake_up(engine):
+            raise RuntimeError("la base de datos no respondió")
         logging.info("Conexión a PostgreSQL OK.")
         return engine
     except Exception as e:
@@ -311,40 +317,53 @@ def save_dataframe_to_csv(df: pd.DataFrame):
 # ───────────────────────────────────────────────────────────────────────────────
 # Main
 # ───────────────────────────────────────────────────────────────────────────────
-def main():
-    setup_logging(CFG.log_level)
-    load_dotenv()
+async def main_async(connector=None) -> bool:
+    """
+    Punto de entrada asíncrono: ejecuta el extractor en el event loop actual. Las partes
+    bloqueantes (metadata por HTTP síncrono, BD, CSV) corren en hilos.
+    """
     logging.info(">> Extractor concurrente de items (Alegra) <<")
 
     api_key = get_api_key()
     sync_session = create_sync_session(api_key)
 
     # 1. Total de items
-    meta = sync_session.get(CFG.metadata_url, timeout=CFG.timeout_seconds).json()
+    def fetch_metadata():
+        get_alegra_rate_limiter().acquire_sync()
+        return alegra_json.loads(sync_session.get(CFG.metadata_url, timeout=CFG.timeout_seconds).content)
+
+    meta = await asyncio.to_thread(fetch_metadata)
     total_items = int(meta["metadata"]["total"])
     logging.info(f"Total items reportados por la API: {total_items}")
 
     # 2. Conexión BD
-    engine = get_database_engine()
+    engine = await asyncio.to_thread(get_database_engine)
 
     # 3. Tabla con 3 ítems base
-    save_to_database(create_initial_dataframe(), engine, "replace")
+    await asyncio.to_thread(save_to_database, create_initial_dataframe(), engine, "replace")
 
     # 4. Descarga concurrente
     logging.info("Descargando items de la API en paralelo...")
-    all_items = asyncio.run(fetch_all_items_concurrent(total_items, api_key))
+    all_items = await fetch_all_items_concurrent(total_items, api_key, connector)
     if not all_items:
         logging.warning("No se obtuvieron items desde la API.")
     else:
         df_items = clean_items_data(all_items)
-        save_to_database(df_items, engine, "append")
+        await asyncio.to_thread(save_to_database, df_items, engine, "append")
 
     # 5. CSV de respaldo
     if CFG.require_csv:
-        df_total = load_entire_database(engine)
+        df_total = await asyncio.to_thread(load_entire_database, engine)
         save_dataframe_to_csv(df_total)
 
     logging.info("Proceso finalizado OK.")
+    return True
+
+
+def main():
+    setup_logging(CFG.log_level)
+    load_dotenv()
+    asyncio.run(main_async())
 
 
 if __name__ == "__main__":
@@ -22,16 +22,24 @@ Requisitos
 Uso
 ---
 ```bash
-python combined_alegra_extract.py        # ejecuta todo en secuencia
+python combined_alegra_extract.py          # ejecuta todo en secuencia
+python combined_alegra_extract.py --async  # extractores a la vez en un solo event loop
 ```
 
+En modo asíncrono (`--async` o ALEGRA_ORCHESTRATION=async) los tres extractores corren
+concurrentemente en un único event loop y comparten un conector HTTP (pool de conexiones
+y caché de DNS, ver alegra_http.py); los reportes se generan después, en secuencia.
+
 El script detiene la ejecución si alguno de los sub‑procesos devuelve un código
 de error distinto de 0 o lanza una excepción no controlada.
 """
 
 from __future__ import annotations
 
+import asyncio
+import importlib.util
 import logging
+import os
 import pathlib
 import runpy
 import sys
@@ -46,6 +54,16 @@ EXTRACTORS = [
     "generar_tabla_para_pedidos.py",  # Generador de tabla para pedidos (SIEMPRE AL FINAL)
 ]
 
+# Entradas asíncronas de los extractores: (módulo, conector HTTP compartido) -> corrutina que retorna bool.
+# Los scripts que no aparecen aquí se ejecutan después con runpy, en el orden de EXTRACTORS.
+ASYNC_ENTRY_POINTS = {
+    "extractor_facturas_alegra_sagrado.py": lambda module, connector: (
+        module.AlegraFacturasExtractor().run_extraction_async(connector)
+    ),
+    "extractor_facturas_proveedor_optimizado.py": lambda module, connector: module.main_async(connector),
+    "items-extract.py": lambda module, connector: module.main_async(connector),
+}
+
 
 def run_script(path: pathlib.Path) -> None:
     """Ejecuta un script como si fuese `python <script>` y maneja errores."""
@@ -70,6 +88,47 @@ def run_script(path: pathlib.Path) -> None:
     logger.info("=== %s finalizado en %s ===", path.name, duration)
 
 
+def load_script_module(path: pathlib.Path):
+    """Importa un script por ruta (sirve también para nombres con guiones como items-extract.py)."""
+    name = path.stem.replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Registrado antes de ejecutarlo: las dataclasses resuelven sus anotaciones vía sys.modules
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+async def run_extractor_async(path: pathlib.Path, connector) -> bool:
+    """Ejecuta la entrada asíncrona de un extractor en el loop actual."""
+    logger = logging.getLogger(__name__)
+    logger.info("=== Ejecutando %s (asíncrono) ===", path.name)
+    start_time = datetime.now()
+
+    try:
+        module = load_script_module(path)
+        ok = await ASYNC_ENTRY_POINTS[path.name](module, connector)
+    except Exception as exc:  # noqa: BLE001
+        logger.exception("Error al ejecutar %s: %s", path.name, exc)
+        return False
+
+    duration = datetime.now() - start_time
+    if ok is False:
+        logger.error("%s terminó con errores tras %s", path.name, duration)
+        return False
+    logger.info("=== %s finalizado en %s ===", path.name, duration)
+    return True
+
+
+async def run_extractors_async(paths: list[pathlib.Path]) -> bool:
+    """Ejecuta los extractores concurrentemente en un solo event loop con un conector HTTP compartido."""
+    import alegra_http
+
+    async with alegra_http.shared_connector() as connector:
+        results = await asyncio.gather(*(run_extractor_async(path, connector) for path in paths))
+    return all(results)
+
+
 def main() -> None:
     """Punto de entrada principal."""
     logging.basicConfig(
@@ -88,7 +147,21 @@ def main() -> None:
             logger.error("No se encontró el script %s", script_path)
             sys.exit(1)
 
-        run_script(script_path)
+    async_mode = "--async" in sys.argv[1:] or os.getenv("ALEGRA_ORCHESTRATION") == "async"
+    sequential = EXTRACTORS
+    if async_mode:
+        # En modo secuencial cada script carga el .env en su `__main__`; aquí se importan
+        # como módulos, así que se carga antes de importarlos
+        from dotenv import load_dotenv
+
+        load_dotenv(dotenv_path=script_dir / ".env")
+        sys.path.insert(0, str(script_dir))
+        if not asyncio.run(run_extractors_async([script_dir / name for name in ASYNC_ENTRY_POINTS])):
+            sys.exit(1)
+        sequential = [name for name in EXTRACTORS if name not in ASYNC_ENTRY_POINTS]
+
+    for script_name in sequential:
+        run_script(script_dir / script_name)
 
     logger.info(">>> Proceso completo: facturas, facturas proveedor, ítems extraídos, reporte de ventas y tabla para pedidos generados correctamente <<<")
 
@@ -21,7 +21,8 @@ import sys
 import os
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from db_engine import get_engine
 from datetime import datetime, timedelta
 import warnings
 warnings.filterwarnings('ignore')
@@ -42,7 +43,7 @@ print(" " * 30 + "AÑO 2025")
 print("=" * 100)
 
 try:
-    engine = create_engine(DB_URL)
+    engine = get_engine(DB_URL)
     
     # ========================================================================
     # CARGA DE DATOS
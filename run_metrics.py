@@ -0,0 +1,175 @@
+"""
+Métricas por ejecución de los extractores
+-----------------------------------------
+
+Acumula, durante una corrida, el tiempo por fase (connect, discovery, fetch, clean,
+transform, insert, export), páginas y bytes descargados, reintentos por status, filas
+insertadas y la latencia de cada escritura en la BD, y al final las exporta como:
+
+  - un reporte JSON de la corrida (y una línea por corrida en un historial JSONL, para
+    comparar noche a noche)
+  - opcionalmente, un textfile de Prometheus para el textfile collector de node_exporter
+
+Las fases pueden solaparse (en modo streaming la descarga y la inserción corren a la
+vez), así que el tiempo por fase es tiempo acumulado, no una partición de la duración total.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+PHASES = ["connect", "discovery", "fetch", "clean", "transform", "insert", "export"]
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Percentil por rango más cercano (0 si no hay valores)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(q * len(ordered)) - 1)
+    return ordered[index]
+
+
+class RunMetrics:
+    """Métricas de una corrida, seguras para usar desde varios hilos."""
+
+    def __init__(self, extractor: str):
+        self.extractor = extractor
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Empezar una corrida nueva."""
+        with self._lock:
+            self.started_at = datetime.now()
+            self._started = time.monotonic()
+            self.phase_seconds: Dict[str, float] = defaultdict(float)
+            self.phase_calls: Dict[str, int] = defaultdict(int)
+            self.counters: Dict[str, int] = defaultdict(int)
+            self.retries: Dict[str, int] = defaultdict(int)
+            self.insert_latencies: List[float] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        """Medir un bloque como parte de la fase `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase_time(name, time.perf_counter() - start)
+
+    def add_phase_time(self, name: str, seconds: float):
+        with self._lock:
+            self.phase_seconds[name] += seconds
+            self.phase_calls[name] += 1
+
+    def incr(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def retry(self, status: Any):
+        """Registrar un reintento por status HTTP (o 'timeout' / 'exception')."""
+        with self._lock:
+            self.retries[str(status)] += 1
+
+    def observe_insert(self, seconds: float, rows: int):
+        """Registrar una escritura exitosa en la BD."""
+        with self._lock:
+            self.insert_latencies.append(seconds)
+            self.counters["rows_inserted"] += rows
+            self.counters["insert_batches"] += 1
+
+    # ------------------------------------------------------------------
+    # Exportación
+    # ------------------------------------------------------------------
+    def report(self, success: Optional[bool] = None) -> Dict[str, Any]:
+        """Reporte de la corrida como dict serializable a JSON."""
+        with self._lock:
+            latencies = list(self.insert_latencies)
+            return {
+                "extractor": self.extractor,
+                "started_at": self.started_at.isoformat(timespec="seconds"),
+                "duration_seconds": round(time.monotonic() - self._started, 3),
+                "success": success,
+                "phases": {
+                    name: {
+                        "seconds": round(self.phase_seconds.get(name, 0.0), 3),
+                        "calls": self.phase_calls.get(name, 0),
+                    }
+                    for name in PHASES + sorted(set(self.phase_seconds) - set(PHASES))
+                },
+                "counters": dict(self.counters),
+                "retries_by_status": dict(self.retries),
+                "insert_latency_seconds": {
+                    **{f"p{int(q * 100)}": round(percentile(latencies, q), 4) for q in QUANTILES},
+                    "max": round(max(latencies, default=0.0), 4),
+                    "count": len(latencies),
+                },
+            }
+
+    def write_json(self, path: str, report: Dict[str, Any], history_path: Optional[str] = None):
+        """Escribir el reporte de la corrida y agregarlo al historial JSONL."""
+        try:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            Path(path).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+            if history_path:
+                Path(history_path).parent.mkdir(parents=True, exist_ok=True)
+                with open(history_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(report, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logging.warning(f"No se pudo escribir el reporte de métricas ({path}): {e}")
+
+    def write_prometheus(self, path: str, report: Dict[str, Any]):
+        """
+        Escribir el reporte en formato de exposición de Prometheus. Se escribe a un archivo
+        temporal y se renombra, para que el collector nunca lea un archivo a medias.
+        """
+        label = f'extractor="{self.extractor}"'
+        lines = [
+            "# TYPE alegra_extractor_last_run_success gauge",
+            f"alegra_extractor_last_run_success{{{label}}} {int(bool(report['success']))}",
+            "# TYPE alegra_extractor_last_run_timestamp_seconds gauge",
+            f"alegra_extractor_last_run_timestamp_seconds{{{label}}} {int(time.time())}",
+            "# TYPE alegra_extractor_run_duration_seconds gauge",
+            f"alegra_extractor_run_duration_seconds{{{label}}} {report['duration_seconds']}",
+            "# TYPE alegra_extractor_phase_seconds gauge",
+        ]
+        lines += [
+            f'alegra_extractor_phase_seconds{{{label},phase="{name}"}} {phase["seconds"]}'
+            for name, phase in report["phases"].items()
+        ]
+        lines.append("# TYPE alegra_extractor_count gauge")
+        lines += [
+            f'alegra_extractor_count{{{label},counter="{name}"}} {value}'
+            for name, value in sorted(report["counters"].items())
+        ]
+        lines.append("# TYPE alegra_extractor_retries gauge")
+        lines += [
+            f'alegra_extractor_retries{{{label},status="{status}"}} {value}'
+            for status, value in sorted(report["retries_by_status"].items())
+        ]
+        lines.append("# TYPE alegra_extractor_insert_latency_seconds gauge")
+        lines += [
+            f'alegra_extractor_insert_latency_seconds{{{label},quantile="{q}"}} '
+            f'{report["insert_latency_seconds"][f"p{int(q * 100)}"]}'
+            for q in QUANTILES
+        ]
+
+        try:
+            target = Path(path)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            tmp = target.with_suffix(target.suffix + ".tmp")
+            tmp.write_text("\n".join(lines) + "\n")
+            os.replace(tmp, target)
+        except OSError as e:
+            logging.warning(f"No se pudo escribir el textfile de Prometheus ({path}): {e}")